@@ -0,0 +1,298 @@
+"""Module to benchmark the pipeline stages on synthetic data.
+
+For each scenario (number of years, and zonal vs. generator-level LMP
+nodes), synthetic raw data is generated (see synthetic_data.py) and
+each stage is run in a fresh Python process from the scenario's
+directory. Each stage's wall time, CPU time, and peak memory (resident
+set size, for the stage's process and for any worker processes it
+starts) are recorded.
+
+Results are appended to a JSON lines file, and can be compared to a
+previous run's results to catch regressions.
+
+Usage:
+    python benchmark.py --scenarios 1:zonal 3:zonal 10:zonal 1:gen
+    python benchmark.py --compare baseline.jsonl --tolerance 0.25
+"""
+# Built-in:
+import argparse
+import importlib
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+
+# Imports from get_nyiso_data.py
+from get_nyiso_data import END_YEAR
+
+# This directory, so stage processes can import the pipeline modules.
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Where scenario data is generated. Data is kept between runs since it
+# takes a while to generate.
+WORK_DIR = 'benchmark_data'
+RESULTS_FILE = 'benchmark_results.jsonl'
+
+# Stages, in the order they have to run. Each entry is
+# (stage name, module, function).
+STAGES = [('combine_lmp_day_ahead', 'combine_nyiso_data',
+           'combine_lmp_day_ahead'),
+          ('combine_lmp_realtime', 'combine_nyiso_data',
+           'combine_lmp_realtime'),
+          ('combine_load_forecast', 'combine_nyiso_data',
+           'combine_load_forecast'),
+          ('combine_load_realtime', 'combine_nyiso_data',
+           'combine_load_realtime'),
+          ('clean_weather_data', 'clean_weather_data', 'main'),
+          ('combine_all_data', 'combine_all_data', 'main')]
+
+# Modules which hold the START_YEAR/END_YEAR the stages use.
+YEAR_MODULES = ('get_nyiso_data', 'combine_nyiso_data', 'combine_all_data')
+
+# Default scenarios: (years, nodes). nodes is 'zonal' or 'gen'.
+SCENARIOS = [(1, 'zonal'), (3, 'zonal'), (10, 'zonal'), (1, 'gen')]
+
+# Default fraction a stage may get slower (or bigger) before it's
+# flagged as a regression.
+TOLERANCE = 0.25
+
+
+def peak_rss_mb(who):
+    """Peak resident set size in MB for resource.RUSAGE_SELF or
+    RUSAGE_CHILDREN.
+    """
+    rss = resource.getrusage(who).ru_maxrss
+    # Linux reports kilobytes, macOS bytes.
+    if sys.platform == 'darwin':
+        rss /= 1024
+    return rss / 1024
+
+
+def cpu_seconds():
+    """User plus system CPU time of this process and its children."""
+    t = os.times()
+    return t.user + t.system + t.children_user + t.children_system
+
+
+def run_stage(module, func, start_year, end_year, from_zip, out_file):
+    """Run one stage in this process and write its measurements to
+    out_file. Called in a fresh process by time_stage.
+    """
+    sys.path.insert(0, REPO_DIR)
+
+    # The stages read the years to process (and where to read the NYISO
+    # files from) from module constants.
+    for name in YEAR_MODULES:
+        mod = importlib.import_module(name)
+        mod.START_YEAR = start_year
+        mod.END_YEAR = end_year
+    importlib.import_module('combine_nyiso_data').FROM_ZIP = from_zip
+
+    stage = getattr(importlib.import_module(module), func)
+
+    # Measure from here so imports aren't counted.
+    rss_before = peak_rss_mb(resource.RUSAGE_SELF)
+    cpu = cpu_seconds()
+    t0 = time.perf_counter()
+    stage()
+    wall = time.perf_counter() - t0
+
+    result = {'wall_s': wall,
+              'cpu_s': cpu_seconds() - cpu,
+              'peak_rss_mb': peak_rss_mb(resource.RUSAGE_SELF),
+              'import_rss_mb': rss_before,
+              'peak_worker_rss_mb': peak_rss_mb(resource.RUSAGE_CHILDREN)}
+
+    with open(out_file, 'w') as f:
+        json.dump(result, f)
+
+
+def time_stage(stage, module, func, data_dir, start_year, end_year,
+               from_zip=False):
+    """Run a stage in a fresh process from data_dir and return its
+    measurements.
+    """
+    out_file = os.path.join(data_dir, '.{}.json'.format(stage))
+    log_file = os.path.join(data_dir, '{}.log'.format(stage))
+    cmd = [sys.executable, os.path.abspath(__file__), '--run-stage',
+           module, func, str(start_year), str(end_year), str(int(from_zip)),
+           os.path.abspath(out_file)]
+
+    with open(log_file, 'w') as log:
+        proc = subprocess.run(cmd, cwd=data_dir, stdout=log,
+                              stderr=subprocess.STDOUT)
+
+    if proc.returncode != 0:
+        raise UserWarning('Stage {} failed, see {}.'.format(stage, log_file))
+
+    with open(out_file) as f:
+        result = json.load(f)
+    os.remove(out_file)
+
+    return result
+
+
+def scenario_name(years, nodes):
+    return '{}y_{}'.format(years, nodes)
+
+
+def prepare_scenario(years, nodes, work_dir=WORK_DIR, gen_nodes=None,
+                     keep_zip=False):
+    """Generate the data for a scenario, unless it's already there.
+
+    :returns: (data_dir, start_year, end_year)
+    """
+    # Imported here since it pulls in the pipeline modules.
+    from synthetic_data import generate, GEN_NODES
+
+    end_year = END_YEAR
+    start_year = end_year - years + 1
+    data_dir = os.path.abspath(os.path.join(work_dir,
+                                            scenario_name(years, nodes)))
+    done = os.path.join(data_dir, '.generated')
+
+    if not os.path.exists(done):
+        print('Generating {}...'.format(data_dir), flush=True)
+        n = 'zonal' if nodes == 'zonal' else (gen_nodes or GEN_NODES)
+        generate(data_dir, start_year, end_year, nodes=n, keep_zip=keep_zip)
+        open(done, 'w').close()
+
+    return data_dir, start_year, end_year
+
+
+def run_scenario(years, nodes, stages=None, keep_zip=False, **kwargs):
+    """Time each stage (see STAGES) for a scenario.
+
+    :param stages: Optional list of stage names to report. Every stage
+        up to the last one requested is run, since each needs the
+        outputs of the ones before it.
+
+    :returns: List of result dictionaries.
+    """
+    data_dir, start_year, end_year = prepare_scenario(
+        years, nodes, keep_zip=keep_zip, **kwargs)
+    names = [s[0] for s in STAGES]
+    stages = names if stages is None else stages
+    last = max(names.index(s) for s in stages)
+
+    results = []
+    for stage, module, func in STAGES[:last + 1]:
+        r = time_stage(stage, module, func, data_dir, start_year, end_year,
+                       from_zip=keep_zip)
+        r.update({'scenario': scenario_name(years, nodes), 'stage': stage,
+                  'years': years, 'nodes': nodes,
+                  'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                  'python': platform.python_version(),
+                  'cpus': os.cpu_count()})
+        print('{:>10} {:<24} {:8.2f} s wall {:8.2f} s cpu {:9.1f} MB'
+              .format(r['scenario'], stage, r['wall_s'], r['cpu_s'],
+                      r['peak_rss_mb']), flush=True)
+        if stage in stages:
+            results.append(r)
+
+    return results
+
+
+def write_results(results, path=RESULTS_FILE):
+    with open(path, 'a') as f:
+        for r in results:
+            f.write(json.dumps(r) + '\n')
+
+
+def read_results(path):
+    """Read a results file, keeping the latest result for each
+    (scenario, stage).
+    """
+    out = {}
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                r = json.loads(line)
+                out[(r['scenario'], r['stage'])] = r
+    return out
+
+
+def compare(results, baseline, tolerance=TOLERANCE):
+    """Compare results to a baseline.
+
+    :param results: List of result dictionaries.
+    :param baseline: Dictionary from read_results.
+    :param tolerance: Fraction a measurement may grow by before it's
+        flagged.
+
+    :returns: List of strings describing each regression.
+    """
+    regressions = []
+    for r in results:
+        base = baseline.get((r['scenario'], r['stage']))
+        if base is None:
+            continue
+
+        for key in ('wall_s', 'peak_rss_mb'):
+            if r[key] > base[key] * (1 + tolerance):
+                regressions.append(
+                    '{} {}: {} went from {:.2f} to {:.2f} (+{:.0%})'.format(
+                        r['scenario'], r['stage'], key, base[key], r[key],
+                        r[key] / base[key] - 1))
+
+    return regressions
+
+
+def parse_scenario(s):
+    years, _, nodes = s.partition(':')
+    nodes = nodes or 'zonal'
+    if nodes not in ('zonal', 'gen'):
+        raise argparse.ArgumentTypeError(
+            "Nodes must be 'zonal' or 'gen', not {}.".format(nodes))
+    return int(years), nodes
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--scenarios', nargs='+', type=parse_scenario,
+                        default=SCENARIOS,
+                        help='Scenarios like 3:zonal or 1:gen.')
+    parser.add_argument('--stages', nargs='+',
+                        choices=[s[0] for s in STAGES],
+                        help='Stages to report (default all).')
+    parser.add_argument('--work-dir', default=WORK_DIR)
+    parser.add_argument('--results', default=RESULTS_FILE)
+    parser.add_argument('--gen-nodes', type=int,
+                        help='Number of generator nodes for gen scenarios.')
+    parser.add_argument('--keep-zip', action='store_true',
+                        help='Generate monthly archives (see KEEP_ZIP).')
+    parser.add_argument('--compare',
+                        help='Results file to compare against.')
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE)
+    args = parser.parse_args(argv)
+
+    # Load the baseline first, in case it's also the results file.
+    baseline = read_results(args.compare) if args.compare else None
+
+    results = []
+    for years, nodes in args.scenarios:
+        results.extend(run_scenario(years, nodes, stages=args.stages,
+                                    work_dir=args.work_dir,
+                                    gen_nodes=args.gen_nodes,
+                                    keep_zip=args.keep_zip))
+    write_results(results, args.results)
+
+    if baseline is not None:
+        regressions = compare(results, baseline, tolerance=args.tolerance)
+        for r in regressions:
+            print('REGRESSION: ' + r)
+        if regressions:
+            return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == '--run-stage':
+        run_stage(sys.argv[2], sys.argv[3], int(sys.argv[4]),
+                  int(sys.argv[5]), bool(int(sys.argv[6])), sys.argv[7])
+    else:
+        sys.exit(main())
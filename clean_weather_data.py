@@ -5,9 +5,18 @@ https://drive.google.com/open?id=1PyXQ1l-J2OHQd5P5tts8QCoLZC7R9e6w
 
 Then, extract the archive here and name it rename the directory
 "Weather_Data"
+
+Long gaps in the data are filled from the previous day/week or the
+nearest zone (see gap_fill.py), and a mask of which cells were filled
+is saved alongside the data. Set FILL_GAPS to False to instead drop
+features with long gaps.
 """
 import pandas as pd
 import os
+from columnar_store import save_frame
+from gap_analysis import gap_report, print_max_runs
+from gap_fill import fill_gaps, suffix_neighbors, describe_mask
+from instrumentation import stage, step, count_read
 
 # Extracting the archive led to nesting.
 WEATHER_DIR = os.path.join("Weather_Data", "Weather Data")
@@ -24,84 +33,127 @@ COLUMNS = ['DATE', 'HourlyDryBulbTemperature', 'HourlyRelativeHumidity',
 # this data.
 TIMEZONE = 'EST'
 
-# Output file.
+# Output store (see columnar_store.py), and optional CSV export.
+OUT_STORE = 'all_weather.store'
 OUT_FILE = 'all_weather.csv'
+EXPORT_CSV = False
+
+# Store for the mask saying how each cell was filled (see gap_fill.py).
+MASK_STORE = 'all_weather_fill_mask.store'
 
-# For simplicity, drop features with more than 15 consecutive NaNs.
-# TODO: Rather than dropping we should consider copying in the previous
-#   day or something.
+# Gaps of more than 15 consecutive NaNs are too long to interpolate.
 NAN_THRESHOLD = 15
 
+# If True, fill long gaps (see below) rather than dropping features
+# which have them.
+FILL_GAPS = True
+
+# The raw data is roughly hourly, so NAN_THRESHOLD observations is
+# about NAN_THRESHOLD hours. Longer gaps are filled from the same time
+# on a previous day, then week, then from the nearest zone.
+MAX_INTERPOLATE = pd.Timedelta(hours=NAN_THRESHOLD)
+FILL_LAGS = ['1D', '7D']
+
+# Neighboring zones, nearest first.
+ZONE_NEIGHBORS = {'A': ['B', 'C'], 'B': ['A', 'C'], 'C': ['B', 'E', 'D'],
+                  'D': ['E', 'C', 'F'], 'E': ['C', 'F', 'D'],
+                  'F': ['E', 'G'], 'G': ['F', 'I'], 'I': ['J', 'G', 'K'],
+                  'J': ['I', 'K'], 'K': ['J', 'I']}
 
+
+@stage('clean_weather_data')
 def main():
     # Read all the data.
-    dfs = [pd.read_csv(os.path.join(WEATHER_DIR, 'Zone{}.csv'.format(z)),
-                       index_col=0, parse_dates=True, usecols=COLUMNS,
-                       infer_datetime_format=True, low_memory=False)
-           for z in ZONES]
+    files = [os.path.join(WEATHER_DIR, 'Zone{}.csv'.format(z))
+             for z in ZONES]
+    with step('read'):
+        dfs = [pd.read_csv(f, index_col=0, parse_dates=True, usecols=COLUMNS,
+                           infer_datetime_format=True, low_memory=False)
+               for f in files]
+        count_read(rows=sum(len(df) for df in dfs),
+                   nbytes=sum(os.path.getsize(f) for f in files), files=files)
 
     # Rename columns, force data to be numeric, localize time, and
     # drop duplicates.
-    for idx, df in enumerate(dfs):
-        # Grab zone information based on the index.
-        zone = ZONES[idx]
-
-        # Cast to numeric.
-        # 'coerce' will return NaN for values which can't be cast.
-        for c in COLUMNS[1:]:
-            df[c] = pd.to_numeric(df[c], errors='coerce')
-
-        # Rename columns.
-        df.rename(lambda x: x + '_' + zone, axis='columns',
-                  inplace=True)
-
-        # Localize time.
-        df.index = df.index.tz_localize(TIMEZONE, ambiguous='raise')
-
-        # Drop duplicates.
-        # TODO: should probably make a more educated decision about what
-        #   to drop.
-        dup_ind = df.index.duplicated(keep='first')
-        df.drop(labels=df.index[dup_ind], axis=0, inplace=True)
-
-        # Display NaN information:
-        print('*' * 80)
-        print('Zone {} NaN information:'.format(zone))
-        print(df.isna().sum())
-
-        # Display consecutive NaNs.
-        # https://stackoverflow.com/questions/29007830/identifying-consecutive-nans-with-pandas
-        for c in df.columns:
-            n = df[c].isnull().astype(int).groupby(df[c].notnull().astype(
-                int).cumsum()).sum().max()
-            print('Max consecutive NaNs in {}: {:d}'.format(c, n))
-
-            # If we've exceeded the NaN threshold, drop the feature.
-            # TODO: we should use a more sophisticated method here, like
-            #   filling spots with data from the previous day.
-            if n > NAN_THRESHOLD:
-                print('DROPPING {}.'.format(c))
-                df.drop(labels=c, axis=1, inplace=True)
+    with step('clean'):
+        for idx, df in enumerate(dfs):
+            # Grab zone information based on the index.
+            zone = ZONES[idx]
+
+            # Cast to numeric.
+            # 'coerce' will return NaN for values which can't be cast.
+            for c in COLUMNS[1:]:
+                df[c] = pd.to_numeric(df[c], errors='coerce')
+
+            # Rename columns.
+            df.rename(lambda x: x + '_' + zone, axis='columns',
+                      inplace=True)
+
+            # Localize time.
+            df.index = df.index.tz_localize(TIMEZONE, ambiguous='raise')
+
+            # Drop duplicates.
+            # TODO: should probably make a more educated decision about what
+            #   to drop.
+            dup_ind = df.index.duplicated(keep='first')
+            df.drop(labels=df.index[dup_ind], axis=0, inplace=True)
+
+            # Display NaN information:
+            print('*' * 80)
+            print('Zone {} NaN information:'.format(zone))
+            print(df.isna().sum())
+
+            # Display consecutive NaNs.
+            report = gap_report(df)
+            print_max_runs(report)
+
+            # If we've exceeded the NaN threshold and aren't filling gaps,
+            # drop the feature.
+            if not FILL_GAPS:
+                drop = report.index[report['max_run'] > NAN_THRESHOLD]
+                for c in drop:
+                    print('DROPPING {}.'.format(c))
+                df.drop(labels=drop, axis=1, inplace=True)
 
     # Join our DataFrames into one.
     # TODO: I think outer join is the most appropriate here?
-    all_weather = dfs[0].join(other=dfs[1:], how='outer', sort=True)
+    with step('join'):
+        all_weather = dfs[0].join(other=dfs[1:], how='outer', sort=True)
 
     # Drop duplicates that stem from the outer join.
     # all_weather.drop_duplicates(keep='first', inplace=True)
 
     # Resample.
-    all_weather = all_weather.resample('5min').asfreq()
-
-    # Fill nan's by interpolating.
-    # TODO: should we impose a limit via the 'limit' input?
-    all_weather.interpolate(method='time', inplace=True)
+    with step('resample'):
+        all_weather = all_weather.resample('5min').asfreq()
+
+    if FILL_GAPS:
+        # Fill long gaps from the previous day/week or a neighboring
+        # zone, interpolate short ones, and back fill the rest.
+        with step('fill'):
+            all_weather, mask = fill_gaps(
+                all_weather, max_interpolate=MAX_INTERPOLATE, lags=FILL_LAGS,
+                neighbors=suffix_neighbors(all_weather.columns,
+                                           ZONE_NEIGHBORS))
 
-    # Back fill the rest of the NaNs.
-    all_weather.fillna(method='backfill', inplace=True)
+        print('*' * 80)
+        print('Filled cells:')
+        print(describe_mask(mask, lags=FILL_LAGS))
+        with step('write_mask'):
+            save_frame(mask, MASK_STORE)
+    else:
+        # Fill nan's by interpolating.
+        # TODO: should we impose a limit via the 'limit' input?
+        with step('fill'):
+            all_weather.interpolate(method='time', inplace=True)
+
+            # Back fill the rest of the NaNs.
+            all_weather.fillna(method='backfill', inplace=True)
 
     # Save to file.
-    all_weather.to_csv(OUT_FILE)
+    with step('write'):
+        save_frame(all_weather, OUT_STORE,
+                   csv_file=OUT_FILE if EXPORT_CSV else None)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,627 @@
+"""Module for storing DataFrames in a binary, columnar format.
+
+CSV files are slow to parse and lose information (dtypes, time zones),
+so the pipeline stages hand data to each other with this format instead.
+
+A store is a directory containing:
+    - meta.json: Column labels (including MultiIndex levels), dtypes,
+        categories, and index information.
+    - index.npy: The index. DatetimeIndexes are stored as int64
+        nanoseconds since the epoch (UTC) plus the time zone in
+        meta.json.
+    - One .npy file per column. Categorical columns are stored as their
+        integer codes, with the categories in meta.json.
+
+Columns are memory-mapped when read, so opening a store is nearly free
+and only the columns (and rows) which are used are actually read from
+disk.
+
+Large, time-indexed DataFrames can also be partitioned by month (see
+write_partitioned). A partitioned store is a directory holding one store
+per month (named like 2018-01) plus a small index, partitions.json,
+recording each partition's time range and row count. Reads only open the
+partitions which overlap the requested time range.
+
+Stages which update stores in place can keep a note of what a store was
+built from in it (see read_sources).
+
+Usage:
+    write_frame(df, 'lmp_realtime.store')
+    df = read_frame('lmp_realtime.store', columns=['LBMP ($/MWHr)'],
+                    start='2018-01-01', end='2018-02-01')
+
+read_frame works the same on partitioned and plain stores.
+"""
+# Third-party:
+import numpy as np
+import pandas as pd
+
+# Standard library:
+import hashlib
+import json
+import os
+import shutil
+
+# Imports from instrumentation.py
+from instrumentation import count_read, count_written, path_size
+
+# Name of the metadata file in each store.
+META_FILE = 'meta.json'
+INDEX_FILE = 'index.npy'
+
+# Name of the index file in partitioned stores.
+PARTITIONS_FILE = 'partitions.json'
+
+# Name of the file recording what a store was built from (see
+# read_sources).
+SOURCES_FILE = 'sources.json'
+
+# Bump if the layout changes.
+VERSION = 1
+
+
+def column_file(i):
+    """File name for the i'th column."""
+    return 'c{:05d}.npy'.format(i)
+
+
+def to_label(key):
+    """Convert a column label to something JSON can hold."""
+    if isinstance(key, tuple):
+        return list(key)
+    return key
+
+
+def from_label(key):
+    """Inverse of to_label."""
+    if isinstance(key, list):
+        return tuple(key)
+    return key
+
+
+def encode_index(index):
+    """Convert an index to (array, metadata)."""
+    if isinstance(index, pd.DatetimeIndex):
+        tz = None if index.tz is None else str(index.tz)
+        if tz is not None:
+            index = index.tz_convert('UTC')
+        values = index.asi8
+        meta = {'kind': 'datetime', 'tz': tz}
+    else:
+        values = np.asarray(index)
+        meta = {'kind': 'array'}
+
+    meta['name'] = index.name
+    meta['sorted'] = bool(index.is_monotonic_increasing)
+    return values, meta
+
+
+def decode_index(values, meta):
+    """Inverse of encode_index."""
+    if meta['kind'] == 'datetime':
+        index = pd.DatetimeIndex(np.asarray(values).view('M8[ns]'),
+                                 name=meta['name'])
+        if meta['tz'] is not None:
+            index = index.tz_localize('UTC').tz_convert(meta['tz'])
+        return index
+
+    return pd.Index(values, name=meta['name'])
+
+
+def replace_store(tmp, path):
+    """Move a newly written store (or any directory) from tmp to path.
+
+    A store already at path is moved aside first, and only deleted once
+    the new one is in place, so a failure never leaves neither.
+    """
+    old = path + '.old'
+    if os.path.exists(old):
+        shutil.rmtree(old)
+    if os.path.exists(path):
+        os.replace(path, old)
+    os.replace(tmp, path)
+    if os.path.exists(old):
+        shutil.rmtree(old)
+
+
+def write_frame(df, path):
+    """Write a DataFrame to a store.
+
+    The store is written next to path and then moved into place, so
+    readers never see a half-written store.
+
+    :param df: DataFrame to write.
+    :param path: String. Directory for the store. Will be replaced if it
+        already exists.
+    """
+    tmp = path + '.tmp'
+    if os.path.exists(tmp):
+        shutil.rmtree(tmp)
+    os.makedirs(tmp)
+
+    index_values, index_meta = encode_index(df.index)
+    np.save(os.path.join(tmp, INDEX_FILE), index_values)
+
+    columns = []
+    for i, key in enumerate(df.columns):
+        col = df.iloc[:, i]
+        col_meta = {'key': to_label(key), 'file': column_file(i),
+                    'categories': None, 'object': False}
+
+        if isinstance(col.dtype, pd.CategoricalDtype):
+            values = col.cat.codes.values
+            col_meta['categories'] = col.cat.categories.tolist()
+        elif col.dtype == object:
+            # Store strings as categoricals, convert back on read.
+            cat = col.astype('category')
+            values = cat.cat.codes.values
+            col_meta['categories'] = cat.cat.categories.tolist()
+            col_meta['object'] = True
+        else:
+            values = col.values
+
+        col_meta['dtype'] = str(values.dtype)
+        np.save(os.path.join(tmp, col_meta['file']), values)
+        columns.append(col_meta)
+
+    meta = {'version': VERSION,
+            'rows': len(df),
+            'index': index_meta,
+            'column_names': list(df.columns.names),
+            'columns': columns}
+
+    with open(os.path.join(tmp, META_FILE), 'w') as f:
+        json.dump(meta, f, indent=1)
+
+    replace_store(tmp, path)
+
+    count_written(rows=len(df), nbytes=path_size(path), files=path)
+
+
+def read_meta(path):
+    """Read the metadata for a store. For partitioned stores, this is
+    the metadata of the first partition (so row counts and the like
+    will not be for the whole store).
+    """
+    if is_partitioned(path):
+        parts = read_partitions(path)['partitions']
+        if not parts:
+            raise ValueError('Partitioned store {} is empty.'.format(path))
+        path = os.path.join(path, parts[0]['key'])
+
+    with open(os.path.join(path, META_FILE), 'r') as f:
+        return json.load(f)
+
+
+def column_labels(path):
+    """Get the column labels of a store, in order."""
+    return [from_label(c['key']) for c in read_meta(path)['columns']]
+
+
+def select_columns(meta, columns=None):
+    """Get the metadata for the requested columns, in store order.
+
+    :param meta: Dictionary from read_meta.
+    :param columns: List of column labels, or None for all columns.
+        For MultiIndex columns, labels may be full tuples or first-level
+        labels (which select every column under them).
+    """
+    if columns is None:
+        return meta['columns']
+
+    wanted = set(columns)
+    out = []
+    for c in meta['columns']:
+        key = from_label(c['key'])
+        if key in wanted or (isinstance(key, tuple) and key[0] in wanted):
+            out.append(c)
+
+    return out
+
+
+def open_columns(path, columns=None):
+    """Memory-map a store's index and columns without building a
+    DataFrame.
+
+    :param path: String. Directory of the store.
+    :param columns: See select_columns.
+
+    :returns: Tuple (meta, index_values, {label: array}). Arrays are
+        read-only memory maps; categorical columns are their codes.
+    """
+    meta = read_meta(path)
+    index_values = np.load(os.path.join(path, INDEX_FILE), mmap_mode='r')
+    arrays = {from_label(c['key']):
+              np.load(os.path.join(path, c['file']), mmap_mode='r')
+              for c in select_columns(meta, columns)}
+
+    return meta, index_values, arrays
+
+
+def to_ns(t, tz):
+    """Convert a time to int64 nanoseconds (UTC).
+
+    :param t: Anything pd.Timestamp accepts.
+    :param tz: String. Time zone to assume for naive times, or None.
+    """
+    t = pd.Timestamp(t)
+    if t.tz is None and tz is not None:
+        t = t.tz_localize(tz)
+    return t.value
+
+
+def row_range(meta, index_values, start=None, end=None):
+    """Find the rows of a sorted datetime index in [start, end).
+
+    :returns: Tuple (first, last) of row positions for slicing.
+    """
+    first, last = 0, len(index_values)
+    if start is None and end is None:
+        return first, last
+
+    if not meta['index']['sorted']:
+        raise ValueError('Can only slice stores with a sorted index.')
+
+    tz = meta['index']['tz']
+    if start is not None:
+        first = int(np.searchsorted(index_values, to_ns(start, tz), 'left'))
+    if end is not None:
+        last = int(np.searchsorted(index_values, to_ns(end, tz), 'left'))
+
+    return first, max(first, last)
+
+
+def read_frame(path, columns=None, start=None, end=None):
+    """Read a store into a DataFrame.
+
+    Only the requested columns and rows are read from disk.
+
+    :param path: String. Directory of the store.
+    :param columns: See select_columns.
+    :param start: Anything pd.Timestamp accepts. First time to read
+        (inclusive). Naive times are taken to be in the store's time
+        zone.
+    :param end: Like start, but exclusive.
+    """
+    if is_partitioned(path):
+        return read_partitioned(path, columns=columns, start=start, end=end)
+
+    meta = read_meta(path)
+    index_values = np.load(os.path.join(path, INDEX_FILE), mmap_mode='r')
+    first, last = row_range(meta, index_values, start=start, end=end)
+
+    index = decode_index(index_values[first:last], meta['index'])
+
+    col_meta = select_columns(meta, columns)
+    data = {}
+    nbytes = index_values[first:last].nbytes
+    for i, c in enumerate(col_meta):
+        values = np.load(os.path.join(path, c['file']),
+                         mmap_mode='r')[first:last]
+        nbytes += values.nbytes
+
+        if c['categories'] is not None:
+            values = pd.Categorical.from_codes(np.array(values),
+                                               categories=c['categories'])
+            if c['object']:
+                values = np.asarray(values, dtype=object)
+        else:
+            values = np.array(values)
+
+        data[i] = values
+
+    df = pd.DataFrame(data, index=index)
+
+    # Restore the column labels.
+    keys = [from_label(c['key']) for c in col_meta]
+    if len(meta['column_names']) > 1:
+        df.columns = pd.MultiIndex.from_tuples(
+            keys, names=meta['column_names'])
+    else:
+        df.columns = pd.Index(keys, name=meta['column_names'][0])
+
+    count_read(rows=len(df), nbytes=nbytes, files=path)
+
+    return df
+
+
+def save_frame(df, path, csv_file=None):
+    """Write a DataFrame to a store, and optionally export it to CSV.
+
+    :param df: DataFrame to write.
+    :param path: String. Directory for the store.
+    :param csv_file: String. If given, also write the DataFrame to this
+        CSV file.
+    """
+    write_frame(df, path)
+
+    if csv_file is not None:
+        df.to_csv(csv_file)
+        count_written(rows=len(df), nbytes=path_size(csv_file),
+                      files=csv_file)
+
+
+def is_partitioned(path):
+    """Check if a store is partitioned (see write_partitioned)."""
+    return os.path.isfile(os.path.join(path, PARTITIONS_FILE))
+
+
+def read_partitions(path):
+    """Read the partition index of a partitioned store.
+
+    :returns: Dictionary with a 'partitions' key holding a list (sorted
+        by time) of dictionaries with 'key', 'start', 'end', and 'rows'
+        keys. start and end are int64 nanoseconds (UTC); end is the last
+        time in the partition (inclusive).
+    """
+    with open(os.path.join(path, PARTITIONS_FILE), 'r') as f:
+        return json.load(f)
+
+
+def write_partitions(path, partitions):
+    """Write the partition index, replacing it atomically."""
+    tmp = os.path.join(path, PARTITIONS_FILE + '.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(partitions, f, indent=1)
+    os.replace(tmp, os.path.join(path, PARTITIONS_FILE))
+
+
+def month_codes(index):
+    """Integer month codes (like 201801) for each row of a
+    DatetimeIndex, in the index's own time zone.
+    """
+    return np.asarray(index.year) * 100 + np.asarray(index.month)
+
+
+def split_months(df):
+    """Split a DataFrame with a sorted DatetimeIndex into months.
+
+    :returns: List of (key, DataFrame) tuples, in time order.
+    """
+    if not df.index.is_monotonic_increasing:
+        raise ValueError('Can only partition DataFrames with a sorted '
+                         'index.')
+
+    codes = month_codes(df.index)
+    # The index is sorted, so each month is one contiguous block.
+    bounds = np.flatnonzero(np.diff(codes)) + 1
+    starts = np.concatenate([[0], bounds])
+    ends = np.concatenate([bounds, [len(df)]])
+
+    return [('{:04d}-{:02d}'.format(codes[a] // 100, codes[a] % 100),
+             df.iloc[a:b]) for a, b in zip(starts, ends) if b > a]
+
+
+def write_partitioned(df, path, update=False):
+    """Write a DataFrame to a month-partitioned store.
+
+    :param df: DataFrame with a sorted DatetimeIndex.
+    :param path: String. Directory for the store.
+    :param update: Boolean. If False, the store is replaced entirely
+        (written next to path and swapped in, see replace_store). If
+        True, only the months present in df are (re)written and all
+        other existing partitions are kept.
+    """
+    if update and is_partitioned(path):
+        existing = {p['key']: p for p in read_partitions(path)['partitions']}
+    elif os.path.exists(path):
+        tmp = path + '.tmp'
+        if os.path.exists(tmp):
+            shutil.rmtree(tmp)
+        write_partitioned(df, tmp)
+        replace_store(tmp, path)
+        return
+    else:
+        existing = {}
+
+    os.makedirs(path, exist_ok=True)
+
+    for key, sub in split_months(df):
+        write_frame(sub, os.path.join(path, key))
+        existing[key] = {'key': key,
+                         'start': int(sub.index[0].value),
+                         'end': int(sub.index[-1].value),
+                         'rows': len(sub)}
+
+    partitions = {'version': VERSION,
+                  'partitions': sorted(existing.values(),
+                                       key=lambda p: p['start'])}
+    write_partitions(path, partitions)
+
+
+def merge_partitioned(df, path):
+    """Merge rows into a month-partitioned store, e.g. new intervals as
+    they're published.
+
+    Rows of df replace any rows of the store at the same times, and are
+    added otherwise. Only the months df touches are read and rewritten.
+
+    :param df: DataFrame with a sorted DatetimeIndex and the store's
+        columns (columns the store doesn't have raise a ValueError, and
+        columns df lacks are NaN).
+    :param path: String. Directory of the store. Created if it doesn't
+        exist. A plain (unpartitioned) store is read whole, merged into
+        and rewritten partitioned.
+
+    :returns: Integer. Number of rows which weren't in the store.
+    """
+    if len(df) == 0:
+        return 0
+    if not is_partitioned(path) \
+            and not os.path.isfile(os.path.join(path, META_FILE)):
+        write_partitioned(df, path)
+        return len(df)
+
+    columns = column_labels(path)
+    extra = [c for c in df.columns if c not in columns]
+    if extra:
+        raise ValueError('Columns {} are not in {}.'.format(extra, path))
+    df = df.reindex(columns=columns)
+
+    if is_partitioned(path):
+        codes = np.unique(month_codes(df.index))
+        keys = {'{:04d}-{:02d}'.format(c // 100, c % 100) for c in codes}
+        old = [read_frame(os.path.join(path, p['key']))
+               for p in read_partitions(path)['partitions']
+               if p['key'] in keys]
+    else:
+        old = [read_frame(path)]
+
+    new = len(df)
+    if old:
+        old = pd.concat(old) if len(old) > 1 else old[0]
+        keep = ~old.index.isin(df.index)
+        new -= int((~keep).sum())
+        df = pd.concat([old[keep], df]).sort_index(kind='stable')
+
+    write_partitioned(df, path, update=True)
+    return new
+
+
+def select_partitions(path, start=None, end=None):
+    """Get the partitions (see read_partitions) of a partitioned store
+    which overlap [start, end). See read_frame for start and end.
+    """
+    parts = read_partitions(path)['partitions']
+    if not parts:
+        raise ValueError('Partitioned store {} is empty.'.format(path))
+
+    tz = read_meta(path)['index']['tz']
+    start_ns = None if start is None else to_ns(start, tz)
+    end_ns = None if end is None else to_ns(end, tz)
+
+    return [p for p in parts
+            if (start_ns is None or p['end'] >= start_ns)
+            and (end_ns is None or p['start'] < end_ns)]
+
+
+def time_extent(path):
+    """Get the first and last index values of a store with a sorted
+    datetime index, as int64 nanoseconds (UTC).
+    """
+    if is_partitioned(path):
+        parts = read_partitions(path)['partitions']
+        if not parts:
+            raise ValueError('Partitioned store {} is empty.'.format(path))
+        return parts[0]['start'], parts[-1]['end']
+
+    _, index_values, _ = open_columns(path, columns=[])
+    return int(index_values[0]), int(index_values[-1])
+
+
+def month_rows(path):
+    """Split a store's rows into months (in the index's time zone).
+
+    :returns: Tuple (meta, months), where months is a list of (key,
+        store, first row, last row) with keys like '2018-01'. store is
+        the plain store holding the month's rows: the partition for
+        partitioned stores, path itself otherwise.
+    """
+    if is_partitioned(path):
+        parts = read_partitions(path)['partitions']
+        return read_meta(path), [(p['key'], os.path.join(path, p['key']),
+                                  0, p['rows']) for p in parts]
+
+    meta, index_values, _ = open_columns(path, columns=[])
+    codes = month_codes(decode_index(index_values, meta['index']))
+
+    # The index is sorted, so each month is one contiguous block.
+    bounds = np.flatnonzero(np.diff(codes)) + 1
+    starts = np.concatenate([[0], bounds]).astype(int)
+    ends = np.concatenate([bounds, [len(codes)]]).astype(int)
+    months = [('{:04d}-{:02d}'.format(codes[a] // 100, codes[a] % 100),
+               path, a, b) for a, b in zip(starts, ends) if b > a]
+
+    return meta, months
+
+
+def fingerprint(path, first, last):
+    """Hash of the index and every column of rows [first, last) of a
+    (plain) store.
+    """
+    _, index_values, arrays = open_columns(path)
+    h = hashlib.sha256()
+    h.update(np.ascontiguousarray(index_values[first:last]).data)
+    for a in arrays.values():
+        h.update(np.ascontiguousarray(a[first:last]).data)
+    return h.hexdigest()
+
+
+def rows_signature(path, first, last):
+    """Cheap stand-in for fingerprint: rows [first, last) of a (plain)
+    store, and the name, size, and modification time of each of its
+    files. It changes whenever the rows are rewritten, without reading
+    them.
+    """
+    signature = [int(first), int(last)]
+    for f in sorted(os.listdir(path)):
+        if f.startswith(SOURCES_FILE):
+            continue
+        st = os.stat(os.path.join(path, f))
+        signature.append([f, st.st_size, st.st_mtime_ns])
+    return signature
+
+
+def month_fingerprints(path, known=None):
+    """Fingerprint (see fingerprint) each month of a store.
+
+    :param known: Dictionary from an earlier call. Months whose
+        signature (see rows_signature) hasn't changed since then keep
+        their fingerprint rather than being hashed again, so only
+        rewritten partitions are read.
+
+    :returns: Dictionary mapping month key (see month_rows) to a
+        [signature, hash] list.
+    """
+    if known is None:
+        known = {}
+
+    _, months = month_rows(path)
+    out = {}
+    for key, store, a, b in months:
+        signature = rows_signature(store, a, b)
+        old = known.get(key)
+        if old is not None and old[0] == signature:
+            out[key] = old
+        else:
+            out[key] = [signature, fingerprint(store, a, b)]
+    return out
+
+
+def read_sources(path):
+    """Read what a store was built from (see SOURCES_FILE), or None if
+    it wasn't recorded. The contents are up to whoever wrote them.
+    """
+    try:
+        with open(os.path.join(path, SOURCES_FILE)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def write_sources(path, sources):
+    """Record what a store was built from, replacing it atomically."""
+    tmp = os.path.join(path, SOURCES_FILE + '.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(sources, f, indent=1)
+    os.replace(tmp, os.path.join(path, SOURCES_FILE))
+
+
+def read_partitioned(path, columns=None, start=None, end=None):
+    """Read a month-partitioned store. See read_frame for inputs.
+
+    Only partitions which overlap [start, end) are opened.
+    """
+    parts = read_partitions(path)['partitions']
+    selected = select_partitions(path, start=start, end=end)
+
+    # Always read at least one partition so we get the right columns
+    # and dtypes back, even if no rows match.
+    if not selected:
+        selected = parts[:1]
+        start = end = pd.Timestamp(parts[0]['end'] + 1, tz='UTC')
+
+    dfs = [read_frame(os.path.join(path, p['key']), columns=columns,
+                      start=start, end=end) for p in selected]
+
+    return pd.concat(dfs) if len(dfs) > 1 else dfs[0]
@@ -1,118 +1,502 @@
-"""Module to combine all NYISO data with the weather data."""
+"""Module to combine all NYISO data with the weather data.
+
+The combined data is written to a month-partitioned store. Use load to
+read just the time range, columns, and zones you need, e.g.:
+
+    df = load('2018-07-01', '2018-07-15', columns=['realtime_lbmp'],
+              zones=['NYC'])
+
+By default everything is loaded into memory and joined in one go. Use
+main(chunked=True) to instead walk through time one window (e.g. month)
+at a time, which keeps memory use bounded no matter how many years of
+data there are. Both give identical output.
+
+The store records a fingerprint of each month of each input. With
+main(incremental=True), only the output months which can depend on
+changed input months are rebuilt (one window at a time, as with
+chunked=True), so adding a day of data costs about a month of work.
+"""
+import hashlib
+import json
+
 import pandas as pd
-from combine_nyiso_data import LMP_DAY_AHEAD_FILE, LMP_REALTIME_FILE,\
-    LOAD_FORECAST_FILE, LOAD_REALTIME_FILE
-from clean_weather_data import OUT_FILE as WEATHER_FILE
+from get_nyiso_data import START_YEAR, END_YEAR
+from combine_nyiso_data import LMP_DAY_AHEAD_STORE, LMP_REALTIME_STORE,\
+    LOAD_FORECAST_STORE, LOAD_REALTIME_STORE
+from clean_weather_data import OUT_STORE as WEATHER_STORE
+from columnar_store import read_frame, write_partitioned, column_labels, \
+    time_extent, read_meta, month_fingerprints, read_sources, write_sources
+from gap_analysis import gap_report, print_max_runs
+from instrumentation import stage, step, count_written, path_size
+from nyiso_schema import clean_name
 
+# Output store (see columnar_store.py), and optional CSV export.
+OUT_STORE = 'all_data.store'
 OUTFILE = 'all_data.csv'
+EXPORT_CSV = False
 
+# Inputs, in join order: (name, store, kind). kind says how gaps are
+# filled: 'forecast' data is hourly and gets forward filled to 5
+# minutes, 'realtime' data gets interpolated, and None is left alone.
+INPUTS = [('lmp_forecast', LMP_DAY_AHEAD_STORE, 'forecast'),
+          ('lmp_realtime', LMP_REALTIME_STORE, 'realtime'),
+          ('load_forecast', LOAD_FORECAST_STORE, 'forecast'),
+          ('load_realtime', LOAD_REALTIME_STORE, 'realtime'),
+          ('weather', WEATHER_STORE, None)]
 
-def print_consecutive_nans(df):
-    # https://stackoverflow.com/questions/29007830/identifying-consecutive-nans-with-pandas
-    for c in df.columns:
-        n = df[c].isnull().astype(int).groupby(df[c].notnull().astype(
-            int).cumsum()).sum().max()
-        print('Max consecutive NaNs in {}: {:d}'.format(c, n))
+# Window size for main(chunked=True). Any pandas frequency string.
+WINDOW = 'MS'
+
+# Set to True to only rebuild what changed (see main).
+INCREMENTAL = False
+
+# Bump to rebuild everything (e.g. if what's recorded about the inputs
+# changes).
+VERSION = 2
+
+# Number of columns to read at a time for the NaN report in
+# main(chunked=True).
+GAP_BLOCK = 16
+
+# The weather data uses zone letters, while the NYISO data uses names.
+# Map letters to (cleaned, lower case) names so load can take either.
+ZONE_NAMES = {'A': 'west', 'B': 'genese', 'C': 'centrl', 'D': 'north',
+              'E': 'mhkvl', 'F': 'capitl', 'G': 'hudvl', 'H': 'millwd',
+              'I': 'dunwod', 'J': 'nyc', 'K': 'longil'}
+
+
+def split_column(col):
+    """Split an all_data column name into (feature, zone).
+
+    E.g. 'realtime_lbmp__nyc' -> ('realtime_lbmp', 'nyc') and
+    'drybulbtemperature_a' -> ('drybulbtemperature', 'a').
+    """
+    feature, _, zone = col.rpartition('_')
+    return feature.rstrip('_'), zone
+
+
+def zone_aliases(zones):
+    """Get the set of column zone suffixes matching the given zones.
+
+    :param zones: List of zone names (e.g. 'NYC', 'N.Y.C.', 'nyc') or
+        letters (e.g. 'J').
+    """
+    letters = {v: k.lower() for k, v in ZONE_NAMES.items()}
+    out = set()
+    for z in zones:
+        z = clean_name(z).lower()
+        out.add(z)
+        if z.upper() in ZONE_NAMES:
+            out.add(ZONE_NAMES[z.upper()])
+        if z in letters:
+            out.add(letters[z])
+
+    return out
 
 
-def main():
-    # Read files.
-    lmp_forecast = pd.read_csv(LMP_DAY_AHEAD_FILE, header=[0, 1], index_col=0,
-                               parse_dates=True, infer_datetime_format=True)
-    print('lmp forecast data loaded.', flush=True)
+def load(start=None, end=None, columns=None, zones=None, path=OUT_STORE):
+    """Load (part of) the combined data.
 
-    lmp_realtime = pd.read_csv(LMP_REALTIME_FILE, header=[0, 1], index_col=0,
-                               parse_dates=True, infer_datetime_format=True)
-    print('lmp realtime data loaded.', flush=True)
+    Only the monthly partitions overlapping [start, end) and the
+    selected columns are read from disk.
 
-    load_forecast = pd.read_csv(LOAD_FORECAST_FILE, index_col=0,
-                                parse_dates=True, infer_datetime_format=True)
-    print('load forecast data loaded.', flush=True)
+    :param start: Anything pd.Timestamp accepts. First time to load
+        (inclusive). Naive times are taken to be UTC.
+    :param end: Like start, but exclusive.
+    :param columns: List of full column names (e.g.
+        'realtime_lbmp__nyc') and/or features (e.g. 'realtime_lbmp'
+        selects the column for every zone). None for all columns.
+    :param zones: List of zone names or letters (see zone_aliases). If
+        given, only columns for these zones are loaded.
+    :param path: String. Path to the store.
+    """
+    if columns is not None:
+        columns = set(columns)
+    if zones is not None:
+        zones = zone_aliases(zones)
 
-    load_realtime = pd.read_csv(LOAD_REALTIME_FILE, header=[0, 1],
-                                index_col=0, parse_dates=True,
-                                infer_datetime_format=True)
-    print('load realtime data loaded.', flush=True)
+    selected = []
+    for col in column_labels(path):
+        feature, zone = split_column(col)
+        if columns is not None and col not in columns \
+                and feature not in columns:
+            continue
+        if zones is not None and zone not in zones:
+            continue
+        selected.append(col)
 
-    weather = pd.read_csv(WEATHER_FILE, index_col=0, parse_dates=True,
-                          infer_datetime_format=True)
-    print('weather data loaded.', flush=True)
+    return read_frame(path, columns=selected, start=start, end=end)
 
+
+def print_consecutive_nans(df):
+    """Print the longest run of NaNs in each column."""
+    print_max_runs(gap_report(df))
+
+
+def rename_columns(name, df):
+    """Flatten and clean the column names of an input (see INPUTS)
+    before the join.
+    """
     # Flatten multi-indexes.
     # https://stackoverflow.com/questions/14507794/pandas-how-to-flatten-a-hierarchical-index-in-columns
-    lmp_forecast.columns = \
-        ['_'.join(col).strip().replace(' ', '_') for col in
-         lmp_forecast.columns.values]
+    if isinstance(df.columns, pd.MultiIndex):
+        df.columns = ['_'.join(col).strip().replace(' ', '_') for col in
+                      df.columns.values]
 
-    lmp_realtime.columns = ['_'.join(col).strip().replace(' ', '_') for col in
-                            lmp_realtime.columns.values]
+    # Clean column names for pre-join.
+    if name == 'lmp_forecast':
+        df.columns = ['forecast_' + col.replace('($/MWHr)', '').lower() for
+                      col in df.columns.values]
+    elif name == 'lmp_realtime':
+        df.columns = ['realtime_' + col.replace('($/MWHr)', '').lower() for
+                      col in df.columns.values]
+    elif name == 'load_forecast':
+        df.columns = ['forecast_load_' + col.lower() for col in
+                      df.columns.values]
+    elif name == 'load_realtime':
+        df.columns = ['realtime_' + col.lower() for col in
+                      df.columns.values]
+    elif name == 'weather':
+        df.columns = [col.lower().replace('hourly', '') for col in
+                      df.columns.values]
 
-    load_realtime.columns = ['_'.join(col).strip().replace(' ', '_') for col in
-                             load_realtime.columns.values]
+    return df
 
-    # Clean column names for pre-join.
-    lmp_forecast.columns = \
-        ['forecast_' + col.replace('($/MWHr)', '').lower() for
-         col in lmp_forecast.columns.values]
 
-    lmp_realtime.columns = \
-        ['realtime_' + col.replace('($/MWHr)', '').lower() for
-         col in lmp_realtime.columns.values]
+def prepare(name, df):
+    """Rename an input's columns and put its index in UTC.
+
+    The stores keep each DataFrame's time zone. Put everything in UTC
+    so the joins line up.
+    """
+    df = rename_columns(name, df)
+    df.index = df.index.tz_convert('UTC')
+    return df
+
+
+def fill(kind, df):
+    """Fill gaps in an input according to its kind (see INPUTS)."""
+    if kind == 'realtime':
+        # Fill via interpolation.
+        df = df.interpolate(method='time')
+    elif kind == 'forecast':
+        # Our forecasts are hourly, but we want to re-index to 5
+        # minutes.
+        df = df.resample('5min').asfreq().fillna(method='ffill')
+
+    return df
+
+
+@stage('combine_all_data')
+def main(chunked=False, window=WINDOW, incremental=None):
+    """Combine all the data and write it to OUT_STORE.
+
+    :param chunked: Boolean. If True, process the data one window at a
+        time (see combine_chunked) rather than all at once.
+    :param window: String. Pandas frequency for the windows.
+    :param incremental: Boolean. If True, only rebuild the output from
+        the first change to the inputs onwards (see first_change). Falls
+        back to a full rebuild if OUT_STORE wasn't built from the same
+        inputs and settings. Defaults to INCREMENTAL.
+    """
+    if incremental is None:
+        incremental = INCREMENTAL
+
+    with step('fingerprint'):
+        # Even for a full rebuild, the last run's fingerprints save
+        # hashing the inputs which haven't been rewritten since.
+        old = read_sources(OUT_STORE)
+        sources = input_sources(old)
+        if not incremental:
+            old = None
+
+    if old is not None and old['layout'] == sources['layout']:
+        start = first_change(old['inputs'], sources['inputs'])
+        if start is None:
+            print('{} is up to date.'.format(OUT_STORE), flush=True)
+            return
+        start = affected_from(start)
+        print('Rebuilding {} from {}.'.format(OUT_STORE, start), flush=True)
+        combine_chunked(window=window, start=start)
+    elif chunked:
+        combine_chunked(window=window)
+    else:
+        combine_in_memory()
+
+    write_sources(OUT_STORE, sources)
+
 
-    load_forecast.columns = \
-        ['forecast_load_' + col.lower() for col in load_forecast.columns.values]
+def input_sources(old=None):
+    """Describe what the output is built from: a hash of the settings
+    and input columns (which, if changed, mean a full rebuild), and the
+    fingerprint of each month of each input.
 
-    load_realtime.columns = \
-        ['realtime_' + col.lower() for col in load_realtime.columns.values]
+    :param old: What the output was last built from (see read_sources),
+        or None. Only input months rewritten since then are hashed (see
+        columnar_store.month_fingerprints), so a one day update only
+        reads the month it's in.
+    """
+    known = {} if old is None or old.get('version') != VERSION \
+        else old['inputs']
+    layout = [VERSION, START_YEAR, END_YEAR, INPUTS,
+              [column_labels(store) for _, store, _ in INPUTS]]
+    return {'version': VERSION,
+            'layout': hashlib.sha256(
+                json.dumps(layout).encode()).hexdigest(),
+            'inputs': {name: month_fingerprints(store,
+                                                known=known.get(name))
+                       for name, store, _ in INPUTS}}
 
-    weather.columns = \
-        [col.lower().replace('hourly', '') for col in weather.columns.values]
 
-    print('Columns renamed.', flush=True)
+def first_change(old, new):
+    """Find the earliest time any input changed.
 
-    # Re-index all DataFrames. For whatever reason, they are not
-    # DatetimeIndexes.
-    for df in [lmp_forecast, lmp_realtime, load_forecast, load_realtime,
-               weather]:
-        df.index = pd.to_datetime(df.index, utc=True)
-        df.sort_index()
+    :param old: Dictionary mapping input name to month fingerprints
+        (see input_sources) from when the output was built. A month
+        whose files were rewritten with the same data doesn't count as
+        changed.
+    :param new: Like old, for the inputs as they are now.
 
-    print('All indexes converted to DateTimeIndexes.', flush=True)
+    :returns: UTC Timestamp of the start of the first changed (or added,
+        or removed) month, or None if nothing changed.
+    """
+    out = None
+    for name, store, _ in INPUTS:
+        tz = read_meta(store)['index']['tz']
+        keys = set(old.get(name, {})) | set(new[name])
+        for key in keys:
+            was = old.get(name, {}).get(key)
+            now = new[name].get(key)
+            if was is not None and now is not None and was[1] == now[1]:
+                continue
+            t = pd.Timestamp(key + '-01', tz=tz).tz_convert('UTC')
+            out = t if out is None else min(out, t)
+
+    return out
+
+
+def affected_from(start):
+    """Find the earliest output time which can depend on input data at
+    or after start.
+
+    Forward fill only carries values forwards, but interpolating
+    'realtime' inputs reaches back to each column's last valid value
+    before start.
+    """
+    out = start
+    for name, store, kind in INPUTS:
+        if kind != 'realtime':
+            continue
+        df = read_with_context(store, start, start, back=True)
+        df = df[df.index < start]
+        if not len(df):
+            continue
+        last = [df[c].last_valid_index() for c in df.columns]
+        if any(t is None for t in last):
+            # Nothing valid before start: back to the beginning.
+            out = min(out, df.index[0])
+        else:
+            out = min(out, min(last))
+
+    return out.tz_convert('UTC')
+
+
+def combine_in_memory():
+    """Load every input fully into memory and join them in one go."""
+    # Read stores.
+    frames = {}
+    for name, store, kind in INPUTS:
+        with step('read_' + name):
+            frames[name] = prepare(name, read_frame(store))
 
     # It turns out our realtime LMP and realtime load have some
     # missing values.
     # First, print the number of consecutive NaNs in each columns for
     # these two DataFrames.
-    print('*' * 80)
-    print('LMP Realtime')
-    print_consecutive_nans(lmp_realtime)
-    print('*' * 80)
-    print('Load Realtime')
-    print_consecutive_nans(load_realtime)
+    with step('gaps'):
+        print('*' * 80)
+        print('LMP Realtime')
+        print_consecutive_nans(frames['lmp_realtime'])
+        print('*' * 80)
+        print('Load Realtime')
+        print_consecutive_nans(frames['load_realtime'])
 
-    # Fill via interpolation.
-    lmp_realtime.interpolate(method='time', inplace=True)
-    load_realtime.interpolate(method='time', inplace=True)
+    # Interpolate realtime data, re-sample hourly forecasts.
+    with step('fill'):
+        for name, store, kind in INPUTS:
+            frames[name] = fill(kind, frames[name])
 
-    # Our forecasts are hourly, but we want to re-index to 5 minutes.
-    lmp_forecast = \
-        lmp_forecast.resample('5min').asfreq().fillna(method='ffill')
+    # Join data.
+    with step('join'):
+        names = [i[0] for i in INPUTS]
+        all_data = frames[names[0]].join(
+            other=[frames[n] for n in names[1:]], how='left')
 
-    load_forecast = \
-        load_forecast.resample('5min').asfreq().fillna(method='ffill')
+    # Only include the years we downloaded.
+    all_data = all_data[str(START_YEAR):str(END_YEAR)]
+    with step('write'):
+        write_partitioned(all_data, OUT_STORE)
 
-    print('Hourly forecasts re-sampled.', flush=True)
-    # Join data.
-    all_data = lmp_forecast.join(other=[lmp_realtime, load_forecast,
-                                        load_realtime, weather], how='left')
+        if EXPORT_CSV:
+            all_data.to_csv(OUTFILE)
+            count_written(rows=len(all_data), nbytes=path_size(OUTFILE),
+                          files=OUTFILE)
+
+
+def store_extent(store):
+    """Get the first and last times in a store as UTC Timestamps."""
+    first, last = time_extent(store)
+    return pd.Timestamp(first, tz='UTC'), pd.Timestamp(last, tz='UTC')
+
+
+def read_with_context(store, start, end, back=False, ahead=False):
+    """Read [start, end) from a store, plus enough rows on either side
+    to fill gaps the same way as if the whole store had been read.
+
+    :param store: String. Path to the store.
+    :param start: UTC Timestamp. Start of the window (inclusive).
+    :param end: UTC Timestamp. End of the window (exclusive).
+    :param back: Boolean. If True, extend the read backwards until
+        every column has a valid value before start (or we hit the
+        start of the data). Needed to carry forward fill (and the left
+        end of interpolation) across the window boundary.
+    :param ahead: Boolean. If True, extend the read forwards until
+        every column has a valid value at or after end (or we hit the
+        end of the data). Needed for the right end of interpolation.
+    """
+    first, last = store_extent(store)
+    margin = pd.Timedelta(days=1)
+
+    while True:
+        lo = start - margin if back else start
+        hi = end + margin if ahead else end
+        df = read_frame(store, start=lo, end=hi)
+
+        done = True
+        if back and lo > first:
+            before = df.index < start
+            done &= bool(df.loc[before].notna().any(axis=0).all())
+        if ahead and hi <= last:
+            after = df.index >= end
+            done &= bool(df.loc[after].notna().any(axis=0).all())
+
+        if done:
+            return df
+
+        margin *= 2
+
+
+def windows(start, end, window):
+    """Split [start, end] into windows aligned to a pandas frequency.
+
+    :returns: List of (window_start, window_end) UTC Timestamps, with
+        window_end exclusive.
+    """
+    edges = pd.date_range(start.floor('D'), end, freq=window, tz='UTC')
+    edges = [start] + [e for e in edges if start < e <= end] \
+        + [end + pd.Timedelta(1)]
+    return list(zip(edges[:-1], edges[1:]))
+
+
+def combine_chunked(window=WINDOW, start=None):
+    """Combine all the data one window at a time.
+
+    Each window is read from the (memory-mapped) input stores along
+    with just enough context to carry the forward fill and
+    interpolation across window boundaries, joined, and written out as
+    its own partition. The output is identical to combine_in_memory.
+
+    :param window: String. Pandas frequency for the windows. Should not
+        be longer than a month. Windows are collected until their month
+        is complete and then written as one monthly partition.
+    :param start: UTC Timestamp. If given, only the output from the
+        start of this time's month onwards is rebuilt, and earlier
+        partitions are kept.
+    """
+    # The output rows are the 5 minute re-sampling of the first input,
+    # limited to the years we downloaded.
+    first, last = store_extent(INPUTS[0][1])
+    first = max(first, pd.Timestamp(str(START_YEAR), tz='UTC'))
+    last = min(last, pd.Timestamp(str(END_YEAR + 1), tz='UTC')
+               - pd.Timedelta(1))
+    if start is not None:
+        first = max(first, start.normalize().replace(day=1))
+
+    # Print NaN information a block of columns at a time so we never
+    # hold a full input in memory.
+    with step('gaps'):
+        for name, store, kind in INPUTS:
+            if kind == 'realtime':
+                print('*' * 80)
+                print(name.replace('_', ' ').title())
+                labels = column_labels(store)
+                for i in range(0, len(labels), GAP_BLOCK):
+                    print_consecutive_nans(prepare(name, read_frame(
+                        store, columns=labels[i:i + GAP_BLOCK],
+                        start=None if start is None else first)))
+
+    # Chunks waiting to be written as one monthly partition.
+    pending = []
+    state = {'first': start is None}
+
+    def flush():
+        if not pending:
+            return
+        month = pd.concat(pending)
+        del pending[:]
+
+        # The first write replaces any existing output, later ones
+        # are added to it.
+        with step('write') as s:
+            s.note(month='{:%Y-%m}'.format(month.index[0]))
+            write_partitioned(month, OUT_STORE, update=not state['first'])
+
+            if EXPORT_CSV and start is None:
+                size = path_size(OUTFILE) if not state['first'] else 0
+                month.to_csv(OUTFILE, mode='w' if state['first'] else 'a',
+                             header=state['first'])
+                count_written(rows=len(month),
+                              nbytes=path_size(OUTFILE) - size,
+                              files=OUTFILE)
+
+        state['first'] = False
+
+    for w_start, w_end in windows(first, last, window):
+        frames = []
+        with step('window') as s:
+            s.note(start=str(w_start))
+            for name, store, kind in INPUTS:
+                # Forecasts need a row after the window too, so the 5
+                # minute re-sampling runs all the way to the window's
+                # end.
+                with step('read_' + name):
+                    df = read_with_context(store, w_start, w_end,
+                                           back=kind is not None,
+                                           ahead=kind is not None)
+                with step('fill'):
+                    df = fill(kind, prepare(name, df))
+                frames.append(df[(df.index >= w_start)
+                                 & (df.index < w_end)])
+
+            with step('join'):
+                chunk = frames[0].join(other=frames[1:], how='left')
+
+        if pending and (pending[-1].index[-1].month != w_start.month
+                        or pending[-1].index[-1].year != w_start.year):
+            flush()
+        if len(chunk):
+            pending.append(chunk)
 
-    # Only include 2016-2018
-    all_data.sort_index()
-    all_data.tz_convert('America/New_York')
-    all_data = all_data['2016':'2018']
-    all_data.to_csv(OUTFILE)
+    flush()
 
-    pass
+    # Partial rebuilds only replace some partitions, so export all of
+    # them.
+    if EXPORT_CSV and start is not None:
+        with step('export'):
+            all_data = read_frame(OUT_STORE)
+            all_data.to_csv(OUTFILE)
+            count_written(rows=len(all_data), nbytes=path_size(OUTFILE),
+                          files=OUTFILE)
 
 
 if __name__ == '__main__':
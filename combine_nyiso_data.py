@@ -1,28 +1,119 @@
 """Module to combine NYISO files into one file per type.
 
-The module get_nyiso_data.py should be run first.
+The module get_nyiso_data.py should be run first. If it was run with
+KEEP_ZIP, set FROM_ZIP here so the CSV files are read straight out of
+the monthly archives.
+
+Files are read straight into one canonical schema per file type (see
+nyiso_schema.py), whatever variant of the columns they have.
+
+Combined data is written to month-partitioned columnar stores (see
+columnar_store.py). Set EXPORT_CSV to also write the old CSV files.
+
+Each store records the size and modification time of the raw files
+behind each month. Set INCREMENTAL to only re-read the months whose
+files changed (e.g. the current, partial month after a new day has been
+downloaded) and replace just the partitions they affect, rather than
+rebuilding from every file.
+
+Besides the latest load forecast for each hour, every forecast is kept
+with its issue time (see LOAD_FORECAST_VINTAGES_STORE). Use
+read_load_forecast_asof to get the forecasts that were available at a
+given time, e.g. for backtests.
 """
 # Imports from get_nyiso_data.py
 from get_nyiso_data import LMP_DAY_AHEAD_ZONAL, LMP_REALTIME_ZONAL,\
-    LOAD_FORECAST, LOAD_REALTIME, START_YEAR, END_YEAR, START_MONTH, \
-    END_MONTH, get_date_str
+    LOAD_FORECAST, LOAD_REALTIME, LMP_DAY_AHEAD_GEN, LMP_REALTIME_GEN, \
+    START_YEAR, END_YEAR, START_MONTH, END_MONTH, KEEP_ZIP, GET_GEN, \
+    get_date_str, archive_path
+from columnar_store import write_partitioned, read_frame, \
+    select_partitions, open_columns, row_range, column_labels, \
+    month_codes, read_sources, write_sources, replace_store
+from instrumentation import stage, step, count_read, count_written, \
+    path_size
+from nyiso_schema import VALUE_DTYPE, SCHEMAS, parse_header, resolve, \
+    check_headers, clean_name
 
 # Third-party:
+import numpy as np
 import pandas as pd
 
 # Standard library:
+import hashlib
+import json
+import mmap
 import os
-from copy import deepcopy
+import shutil
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from zipfile import ZipFile
 
 # Constants:
+LMP_DAY_AHEAD_STORE = 'lmp_day_ahead.store'
+LMP_REALTIME_STORE = 'lmp_realtime.store'
+LOAD_FORECAST_STORE = 'load_forecast.store'
+LOAD_REALTIME_STORE = 'load_realtime.store'
+
+# Every vintage of the load forecasts (see process_load_forecast_vintages).
+LOAD_FORECAST_VINTAGES_STORE = 'load_forecast_vintages.store'
+
+# Optional CSV exports.
 LMP_DAY_AHEAD_FILE = 'lmp_day_ahead.csv'
 LMP_REALTIME_FILE = 'lmp_realtime.csv'
 LOAD_FORECAST_FILE = 'load_forecast.csv'
 LOAD_REALTIME_FILE = 'load_realtime.csv'
+LOAD_FORECAST_VINTAGES_FILE = 'load_forecast_vintages.csv'
+
+# Column of the vintages store holding each forecast's issue time.
+ISSUED = 'Issued'
+
+# When each load forecast file is taken to have been issued, as local
+# time after the start of its first day. The files don't say, so this is
+# an assumption: each day's file is published by the day-ahead market's
+# 5 AM close (it's what that market is bid against), and isn't revised
+# after. Forecasts for hours before then are therefore issued after
+# their target, and don't count as available (see
+# read_load_forecast_asof). replay_server.py publishes the files on the
+# same schedule.
+LOAD_FORECAST_PUBLISH = pd.Timedelta(hours=5)
+
+# Generator (nodal) LMPs are kept in long format (see combine_gen):
+# month-partitioned stores with a row per (time, node, component).
+LMP_DAY_AHEAD_GEN_STORE = 'lmp_day_ahead_gen.store'
+LMP_REALTIME_GEN_STORE = 'lmp_realtime_gen.store'
+
+# Name of the node/component dictionary in each generator store.
+GEN_DICTIONARY_FILE = 'dictionary.json'
+
+# Price components in the generator files, in the order they're coded.
+GEN_COMPONENTS = ['LBMP ($/MWHr)', 'Marginal Cost Losses ($/MWHr)',
+                  'Marginal Cost Congestion ($/MWHr)']
+
+# Set to True to also write the CSV files above.
+EXPORT_CSV = False
+
+# Set to True to only process months whose raw files changed since the
+# stores were last written (see combine).
+INCREMENTAL = False
 
 # Use constant for timezone for consistency.
 TIMEZONE = 'America/New_York'
 
+# Read from the monthly ZIP archives rather than extracted directories.
+FROM_ZIP = KEEP_ZIP
+
+# When reading from ZIP archives, memory-map the archive files rather
+# than going through regular file reads.
+USE_MMAP = False
+
+# Number of processes used to parse files. Set to 1 to parse in this
+# process.
+PROCESSES = os.cpu_count()
+
+# NYISO time stamps come with or without seconds. Key is the length of
+# the time stamp string.
+TIME_FORMATS = {16: '%m/%d/%Y %H:%M', 19: '%m/%d/%Y %H:%M:%S'}
+
 
 def get_file_list(root_dir):
     """Helper to get listing of files for a root directory (root_dir).
@@ -33,52 +124,394 @@ def get_file_list(root_dir):
     # Initialize list.
     all_files = []
 
-    # Loop over the years and months.
-    for year in range(START_YEAR, END_YEAR+1):
-        for month in range(START_MONTH, END_MONTH+1):
-            # Get a date string.
-            date_str = get_date_str(year=year, month=month)
+    # Loop over the months.
+    for date_str in get_month_keys():
+        # Extend the list of all files.
+        all_files.extend(get_month_files(root_dir, date_str))
+
+    return all_files
+
 
-            # Construct string for this directory.
-            this_dir = os.path.join(root_dir, date_str)
+def get_month_keys():
+    """Get the date string (see get_date_str) of each month downloaded
+    by get_nyiso_data.py, in order.
+    """
+    return [get_date_str(year=year, month=month)
+            for year in range(START_YEAR, END_YEAR+1)
+            for month in range(START_MONTH, END_MONTH+1)]
 
-            # Get listing of files and sort them to save sorting later.
-            files = os.listdir(this_dir)
-            files.sort()
 
-            # Extend the list of all files.
-            all_files.extend([os.path.join(root_dir, date_str, f)
-                              for f in files])
+def get_month_files(root_dir, date_str):
+    """Get the sorted list of files for one month (see get_file_list).
+    """
+    # Construct string for this directory.
+    this_dir = os.path.join(root_dir, date_str)
 
-    return all_files
+    # Get listing of files and sort them to save sorting later.
+    files = os.listdir(this_dir)
+    files.sort()
+
+    return [os.path.join(this_dir, f) for f in files]
 
 
-def read_all_files(files):
-    """Helper to read all files in list into a DataFrame."""
-    return pd.concat([pd.read_csv(f, index_col=0, parse_dates=True,
-                                  infer_datetime_format=True) for f in files])
+def get_archive_list(root_dir):
+    """Helper to get listing of monthly archives for a root directory.
+
+    Like get_file_list, but for data downloaded with KEEP_ZIP.
+    """
+    return [archive_path(root_dir, date_str)
+            for date_str in get_month_keys()]
+
+
+def parse_times(times):
+    """Parse NYISO time stamp strings with an explicit format (see
+    TIME_FORMATS). Stamps in any other format (e.g. with AM/PM, or a
+    stray space) are left to pandas to work out, which is slower.
+
+    Raises a ValueError naming the format if they can't be parsed.
+    """
+    if len(times) == 0:
+        return pd.DatetimeIndex([], name=times.name)
+
+    fmt = TIME_FORMATS.get(len(times.iloc[0]))
+    if fmt is not None:
+        try:
+            return pd.DatetimeIndex(pd.to_datetime(times, format=fmt),
+                                    name=times.name)
+        except ValueError:
+            # E.g. a stamp of another length further down.
+            pass
+
+    try:
+        return pd.DatetimeIndex(pd.to_datetime(times), name=times.name)
+    except (ValueError, TypeError) as e:
+        raise ValueError('Unexpected time stamp format in {}, e.g. {!r}: {}'
+                         .format(times.name, times.iloc[0], e)) from e
+
+
+def read_csv(f):
+    """Helper to read a single NYISO CSV file (path or binary file
+    object) into its canonical schema (see nyiso_schema.py).
+    """
+    if isinstance(f, str):
+        with open(f, 'rb') as fh:
+            return read_csv(fh)
+
+    # Peek at the header so we can give the parser a dtype for every
+    # column up front, and skip the columns we don't use.
+    header = parse_header(f.readline())
+    schema = resolve(header)
+
+    df = pd.read_csv(f, header=None, names=header,
+                     usecols=list(schema['names']), dtype=schema['dtypes'])
+
+    df.index = parse_times(df.pop(header[0]))
+    df.columns = [schema['names'][c] for c in df.columns]
+    return df
+
+
+def concat_frames(frames):
+    """Concatenate DataFrames from read_csv, in order.
+
+    Unlike pd.concat, categoricals with different categories are
+    unioned rather than turned into object arrays, and columns missing
+    from some frames are filled with NaN without changing dtypes.
+    """
+    if not frames:
+        return pd.DataFrame(index=pd.DatetimeIndex([]))
+
+    # Ordered union of the columns.
+    columns = []
+    for df in frames:
+        columns.extend(c for c in df.columns if c not in columns)
+
+    data = {}
+    for col in columns:
+        parts = [df[col].values if col in df.columns else None
+                 for df in frames]
+        present = [p for p in parts if p is not None]
+
+        if isinstance(present[0], pd.Categorical):
+            empty = present[0].categories[:0]
+            parts = [p if p is not None else pd.Categorical.from_codes(
+                np.full(len(df), -1), categories=empty)
+                for p, df in zip(parts, frames)]
+            data[col] = pd.api.types.union_categoricals(
+                parts, sort_categories=True)
+        else:
+            dtype = np.result_type(*present)
+            if len(present) < len(parts):
+                dtype = np.result_type(dtype, VALUE_DTYPE)
+            parts = [p if p is not None else np.full(len(df), np.nan, dtype)
+                     for p, df in zip(parts, frames)]
+            data[col] = np.concatenate(parts).astype(dtype, copy=False)
+
+    index = pd.DatetimeIndex(np.concatenate([df.index.values
+                                             for df in frames]),
+                             name=frames[0].index.name)
+
+    return pd.DataFrame(data, index=index, columns=columns)
+
+
+def read_files(files):
+    """Read a list of files into one DataFrame. Worker for
+    read_all_files.
+    """
+    return concat_frames([read_csv(f) for f in files])
+
+
+def split(items, n):
+    """Split a list into (at most) n contiguous chunks. An empty list
+    gives no chunks.
+    """
+    if not items:
+        return []
+
+    size = -(-len(items) // n)
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def pool_map(func, items, processes=None):
+    """Map func over items with a process pool, preserving order.
+
+    :param func: Function to call. Must be defined at module level.
+    :param items: List of arguments. func is called with one at a time.
+    :param processes: Integer. Number of processes. Defaults to
+        PROCESSES. If 1, everything happens in this process.
+    """
+    if processes is None:
+        processes = PROCESSES
+
+    processes = max(1, min(processes, len(items)))
+    if processes == 1:
+        return [func(i) for i in items]
+
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        return list(pool.map(func, items))
+
+
+def read_all_files(files, processes=None):
+    """Helper to read all files in list into a DataFrame.
+
+    Files are parsed in parallel (see PROCESSES) in contiguous chunks,
+    and the chunks merged back together in order.
+    """
+    if processes is None:
+        processes = PROCESSES
+
+    # A few chunks per process evens out the load.
+    chunks = split(files, max(1, processes * 4))
+    return concat_frames(pool_map(read_files, chunks, processes=processes))
+
+
+class MappedFile:
+    """Minimal read-only file object over a memory-mapped file.
+
+    mmap objects can't be handed to ZipFile directly on older Pythons as
+    they lack 'seekable'.
+    """
+
+    def __init__(self, f):
+        self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def read(self, n=-1):
+        return self._mm.read(n)
+
+    def seek(self, pos, whence=0):
+        self._mm.seek(pos, whence)
+        return self._mm.tell()
+
+    def tell(self):
+        return self._mm.tell()
+
+    def seekable(self):
+        return True
+
+    def close(self):
+        self._mm.close()
+
+
+def read_archive(path, use_mmap=False):
+    """Helper to read every CSV in a ZIP archive into a list of
+    DataFrames, in sorted member order.
+
+    Members are streamed straight into the CSV parser, so nothing is
+    extracted to disk.
+
+    :param path: String. Path to the archive.
+    :param use_mmap: Boolean. Memory-map the archive rather than reading
+        it through regular file reads.
+    """
+    with open(path, 'rb') as f:
+        if use_mmap:
+            source = MappedFile(f)
+        else:
+            source = f
+
+        try:
+            with ZipFile(source) as z:
+                names = sorted(n for n in z.namelist()
+                               if n.lower().endswith('.csv'))
+                dfs = []
+                for name in names:
+                    with z.open(name) as member:
+                        dfs.append(read_csv(member))
+
+                if not dfs:
+                    raise UserWarning('No CSV files in {}'.format(path))
+        finally:
+            if use_mmap:
+                source.close()
+
+    return dfs
+
+
+def read_month_archive(path, use_mmap=False):
+    """Read one monthly archive into a DataFrame. Worker for
+    read_all_archives.
+    """
+    return concat_frames(read_archive(path, use_mmap=use_mmap))
+
+
+def read_mapped_month_archive(path):
+    """read_month_archive with use_mmap=True. Worker for
+    read_all_archives.
+    """
+    return read_month_archive(path, use_mmap=True)
+
+
+def read_all_archives(archives, use_mmap=False, processes=None):
+    """Helper to read all archives in list into a DataFrame.
+
+    Each archive (month) is parsed by its own process task (see
+    PROCESSES).
+    """
+    func = read_mapped_month_archive if use_mmap else read_month_archive
+    return concat_frames(pool_map(func, archives, processes=processes))
+
+
+def read_dataset(root_dir, from_zip=None, use_mmap=None):
+    """Read all the data for a dataset into a DataFrame.
+
+    :param root_dir: String. Directory the data was downloaded to.
+    :param from_zip: Boolean. Read from the monthly ZIP archives rather
+        than the extracted files. Defaults to FROM_ZIP.
+    :param use_mmap: Boolean. Memory-map the archives. Only used if
+        from_zip is True. Defaults to USE_MMAP.
+    """
+    if from_zip is None:
+        from_zip = FROM_ZIP
+    if use_mmap is None:
+        use_mmap = USE_MMAP
+
+    if from_zip:
+        files = get_archive_list(root_dir=root_dir)
+        df = read_all_archives(files, use_mmap=use_mmap)
+    else:
+        files = get_file_list(root_dir=root_dir)
+        df = read_all_files(files)
+
+    count_read(rows=len(df), nbytes=sum(os.path.getsize(f) for f in files),
+               files=files)
+    return df
 
 
-def clean_columns(df):
-    """Helper to do some standard cleaning on DataFrame columns.
+def get_month_sources(root_dir, from_zip=None, use_mmap=None):
+    """Get (reader, source) for each month of a dataset, where
+    reader(source) reads the month into a DataFrame.
 
-    1) Make 'Name' categorical
-    2) Remove spaces and periods from 'Name'
-    3) Drop PTID (we have name, why use the ID?)
+    See read_dataset for inputs.
     """
-    # Drop col1. Also drop PTID while we're at it, as we don't need it.
-    df.drop(axis=1, labels=['PTID'], inplace=True)
+    if from_zip is None:
+        from_zip = FROM_ZIP
+    if use_mmap is None:
+        use_mmap = USE_MMAP
 
-    # Make 'Name' categorical
-    df['Name'] = df['Name'].astype('category')
+    if from_zip:
+        reader = read_mapped_month_archive if use_mmap \
+            else read_month_archive
+        return [(reader, a) for a in get_archive_list(root_dir)]
 
-    # Remove spaces and periods from the names:
-    df['Name'] = \
-        df['Name'].apply(lambda x: x.replace(' ', '').replace('.', ''))
+    return [(read_files, get_month_files(root_dir, date_str))
+            for date_str in get_month_keys()]
+
+
+def clean_names(df):
+    """Helper to give the 'Name' column its canonical spelling (see
+    nyiso_schema.clean_name).
+
+    read_csv already makes 'Name' categorical, so only each category is
+    touched, not every row.
+    """
+    names = df['Name'].astype('category').values
+
+    # Two names may clean up to the same thing, so re-map the codes
+    # rather than renaming.
+    cleaned = names.categories.map(clean_name)
+    categories = pd.Index(pd.unique(cleaned))
+    new_codes = categories.get_indexer(cleaned)
+    codes = np.where(names.codes < 0, -1, new_codes[names.codes])
+    df['Name'] = pd.Categorical.from_codes(codes, categories=categories)
 
     return df
 
 
+def save(df, store, csv_file, update=False):
+    """Helper to save a combined DataFrame to its (month-partitioned)
+    store, and to CSV if EXPORT_CSV is set.
+
+    :param update: Boolean. Only replace the months in df (see
+        write_partitioned). The CSV file is then re-exported from the
+        whole store.
+    """
+    write_partitioned(df, store, update=update)
+
+    if EXPORT_CSV:
+        if update:
+            df = read_frame(store)
+        df.to_csv(csv_file)
+        count_written(rows=len(df), nbytes=path_size(csv_file),
+                      files=csv_file)
+
+
+def localize_index(index, keys=None):
+    """Localize a naive DatetimeIndex which may contain several series
+    (e.g. one per zone) interleaved together.
+
+    During the fall-back transition each series repeats an hour of
+    local times. Within each (key, timestamp) pair, the first occurrence
+    is taken to be daylight time and any later occurrence standard
+    time. For a single, chronologically ordered series this is exactly
+    what tz_localize(ambiguous='infer') does, but it works for all the
+    series at once.
+
+    :param index: Naive DatetimeIndex.
+    :param keys: Array-like the same length as index identifying the
+        series each row belongs to, or None for a single series.
+
+    :returns: Localized DatetimeIndex.
+    """
+    if keys is None:
+        keys = np.zeros(len(index), dtype=np.int8)
+
+    # Flag repeats of each (key, timestamp) pair.
+    repeat = pd.DataFrame({'key': np.asarray(keys),
+                           'time': index.values}).duplicated(keep='first')
+
+    # 'ambiguous' is only consulted for ambiguous times. True means DST.
+    return index.tz_localize(TIMEZONE, ambiguous=~repeat.values)
+
+
+def name_codes(names):
+    """Integer codes for a 'Name' column which sort the same way a
+    groupby on the column does.
+    """
+    if isinstance(names.dtype, pd.CategoricalDtype):
+        return names.cat.codes.values
+
+    return pd.factorize(names, sort=True)[0]
+
+
 def localize_times(df):
     """Helper to get the times from naive to aware, as we have to deal
     with daylight savings.
@@ -86,152 +519,733 @@ def localize_times(df):
     # Well, we're in a pickle. We need to pivot the DataFrame. However,
     # we can't pivot until we've removed duplicates. Why do we have
     # duplicates? Daylight savings time. What's the fix? tz_localize.
-    # However, tz_localize fails because it detects multiple transitions
-    # (because we haven't pivoted, there are date duplicates!). See the
-    # paradox?
+    # However, tz_localize(ambiguous='infer') fails because it detects
+    # multiple transitions (because we haven't pivoted, there are date
+    # duplicates!). See the paradox?
     #
-    # So far, our data isn't terribly large in memory. So, let's loop
-    # over the different are names, create copies of the DataFrames,
-    # localize the time, then create a new DataFrame which we can pivot.
-
-    df_list = []
-    # Group by 'Name', loop over the groups, and localize the
-    # sub-indices
-    groups = df.groupby('Name')
-    for g in groups:
-        # Extract the group for this area.
-        sub_df = groups.get_group(g[0])
+    # Rather than looping over the names, resolve the repeated hour by
+    # row order within each (Name, timestamp) pair, for all names in one
+    # go. See localize_index.
+    codes = name_codes(df['Name'])
 
-        # Make a deep copy.
-        new_df = deepcopy(sub_df)
+    # Keep rows grouped by name (in the order a groupby would give) so
+    # the output is laid out exactly as before.
+    order = np.argsort(codes, kind='stable')
+    df = df.iloc[order]
 
-        # Localize the time index.
-        new_df.index = new_df.index.tz_localize(TIMEZONE, ambiguous='infer')
-        # Put the new localized df in our list.
-        df_list.append(new_df)
-
-    # Overwrite our 'df' variable.
-    df = pd.concat(df_list)
+    df.index = localize_index(df.index, keys=codes[order])
 
     return df
 
 
-def combine_lmp_day_ahead():
-    """Combine day ahead LMP files into one."""
-    # Get all day-ahead LMP files.
-    files = get_file_list(root_dir=LMP_DAY_AHEAD_ZONAL)
+def file_numbers(index):
+    """Number the files an hourly, naive DatetimeIndex read by
+    read_dataset was concatenated from, for data (like the load
+    forecasts) whose files overlap in time.
 
-    # Read 'em all.
-    df = read_all_files(files)
+    Each file is in time order, so a new file starts wherever the time
+    goes backwards, or skips ahead by more than the hour missing when
+    daylight saving time starts.
+    """
+    step = np.diff(index.asi8)
+    new_file = (step < 0) | (step > pd.Timedelta(hours=2).value)
+    return np.concatenate([[0], np.cumsum(new_file)])
 
-    # Some files have a 'Marginal Cost Congestion ($/MWH' column instead
-    # of a 'Marginal Cost Congestion ($/MWHr)' column.
-    # Ensure the number of NaN's in both columns sum to be the length
-    # of the data:
-    col1 = 'Marginal Cost Congestion ($/MWH'
-    col2 = 'Marginal Cost Congestion ($/MWHr)'
-    col1_na = df[col1].isnull().sum()
-    col2_na = df[col2].isnull().sum()
-    assert col1_na + col2_na == df.shape[0]
 
-    # Zero out NaN's in those columns.
-    df.fillna(value={col1: 0, col2: 0}, inplace=True)
+def next_month(code):
+    """Month code (like 201801, see columnar_store.month_codes) of the
+    month after code.
+    """
+    return code + 89 if code % 100 == 12 else code + 1
 
-    # Add col1 and col2
-    df[col2] = df[col1] + df[col2]
 
-    # Drop col1. Also drop PTID while we're at it, as we don't need it.
-    df.drop(axis=1, labels=[col1], inplace=True)
+def month_signature(source):
+    """Signature of one month's raw data (a list of files or an
+    archive, see get_month_sources): the name, size, and modification
+    time of each file.
+    """
+    files = [source] if isinstance(source, str) else source
+    signature = []
+    for f in files:
+        st = os.stat(f)
+        signature.append([os.path.basename(f), st.st_size, st.st_mtime_ns])
 
-    # Clean up columns.
-    df = clean_columns(df)
+    return signature
 
-    # Localize the times. This is time consuming (heh).
-    df = localize_times(df)
 
-    # Pivot.
-    df_pivot = df.pivot(columns='Name')
+def read_month(job):
+    """Read one month. Worker for read_months.
 
-    # Save to file.
-    df_pivot.to_csv(LMP_DAY_AHEAD_FILE)
+    :param job: Tuple (reader, source) from get_month_sources.
+    """
+    reader, source = job
+    return reader(source)
 
 
-def combine_lmp_realtime():
-    """Combine all day ahead lmp files into one."""
-    # Get all day-ahead LMP files.
-    files = get_file_list(root_dir=LMP_REALTIME_ZONAL)
+def read_months(jobs):
+    """Read some months (see get_month_sources) into one DataFrame,
+    one process task per month.
+    """
+    df = concat_frames(pool_map(read_month, jobs))
 
-    # Read 'em all.
-    df = read_all_files(files)
+    files = [f for _, source in jobs
+             for f in ([source] if isinstance(source, str) else source)]
+    count_read(rows=len(df), nbytes=sum(os.path.getsize(f) for f in files),
+               files=files)
+    return df
 
-    # Clean up columns.
-    df = clean_columns(df)
+
+def combine(root_dir, store, csv_file, process, spill=False,
+            incremental=None):
+    """Combine a dataset's raw files into its store.
+
+    The store is month-partitioned, and records the signature (see
+    month_signature) of each month's raw data. In incremental mode,
+    only months whose signature changed are read, and only the
+    partitions they affect are replaced. If the store wasn't built with
+    the same settings, lacks a record of its sources, or its columns
+    would change, everything is rebuilt.
+
+    :param root_dir: String. Directory the data was downloaded to.
+    :param store: String. Store to write.
+    :param csv_file: String. CSV file to write if EXPORT_CSV is set.
+    :param process: Function taking the DataFrame read from the raw
+        files and returning the DataFrame to store, with a sorted,
+        localized index.
+    :param spill: Boolean. True if a month's files have data for the
+        next month too (e.g. the load forecasts, which look 6 days
+        ahead). A changed month then also replaces the next month's
+        partition, and the month before each replaced partition is read
+        so overlapping data is resolved as in a full rebuild.
+    :param incremental: Boolean. Only process what changed. Defaults to
+        INCREMENTAL.
+    """
+    if incremental is None:
+        incremental = INCREMENTAL
+
+    keys = get_month_keys()
+    jobs = get_month_sources(root_dir)
+
+    # Anything which changes every month's output means a rebuild.
+    layout = hashlib.sha256(json.dumps(
+        [TIMEZONE, repr(SCHEMAS), TIME_FORMATS,
+         str(LOAD_FORECAST_PUBLISH)]).encode()).hexdigest()
+
+    with step('check'):
+        signatures = {k: month_signature(source)
+                      for k, (_, source) in zip(keys, jobs)}
+        sources = read_sources(store) if incremental else None
+        if sources is not None and (sources['layout'] != layout
+                                    or set(sources['months']) - set(keys)):
+            sources = None
+
+    if sources is None:
+        # Catch new header variants before spending time parsing.
+        with step('schema'):
+            check_headers([source for _, source in jobs], name=root_dir)
+        with step('read'):
+            df = read_dataset(root_dir=root_dir)
+        df = process(df)
+        with step('write'):
+            save(df, store, csv_file)
+    else:
+        changed = [int(k[:6]) for k in keys
+                   if sources['months'].get(k) != signatures[k]]
+        print('{}: {} of {} months changed.'.format(
+            store, len(changed), len(keys)), flush=True)
+        if not changed:
+            return
+
+        # Partitions to replace, and the months to read for them.
+        replace = set(changed)
+        read = set(changed)
+        if spill:
+            codes = {int(k[:6]) for k in keys}
+            replace |= {next_month(c) for c in changed}
+            read |= {c for c in codes
+                     if c in replace or next_month(c) in replace}
+
+        jobs = [j for k, j in zip(keys, jobs) if int(k[:6]) in read]
+        with step('schema'):
+            check_headers([source for _, source in jobs], name=root_dir)
+        with step('read'):
+            df = read_months(jobs)
+        df = process(df)
+        df = df[np.isin(month_codes(df.index), list(replace))]
+
+        if list(df.columns) != column_labels(store):
+            print('{}: Columns changed, rebuilding.'.format(store),
+                  flush=True)
+            return combine(root_dir, store, csv_file, process, spill=spill,
+                           incremental=False)
+
+        with step('write') as s:
+            s.note(months=len(replace))
+            save(df, store, csv_file, update=True)
+
+    write_sources(store, {'layout': layout, 'months': signatures})
+
+
+def process_lmp_day_ahead(df):
+    """Clean, localize, and pivot the day ahead LMP data."""
+    # Clean up the names.
+    with step('clean'):
+        df = clean_names(df)
 
     # Localize the times. This is time consuming (heh).
-    df = localize_times(df)
+    with step('localize'):
+        df = localize_times(df)
 
     # Pivot.
-    df_pivot = df.pivot(columns='Name')
+    with step('pivot'):
+        return df.pivot(columns='Name')
 
-    # TODO: do we want to re-sample from 5 minutes to 1 hour?
-    # Save to file.
-    df_pivot.to_csv(LMP_REALTIME_FILE)
 
+def process_lmp_realtime(df):
+    """Clean, localize, and pivot the realtime LMP data."""
+    # Clean up the names.
+    with step('clean'):
+        df = clean_names(df)
 
-def combine_load_forecast():
-    """Combine all load forecast files into one."""
-    # Get all day-ahead LMP files.
-    files = get_file_list(root_dir=LOAD_FORECAST)
+    # Localize the times. This is time consuming (heh).
+    with step('localize'):
+        df = localize_times(df)
 
-    # Read 'em all.
-    df = read_all_files(files)
+    # Pivot.
+    # Hourly and daily aggregates are made by rollups.py.
+    with step('pivot'):
+        return df.pivot(columns='Name')
 
-    # Rename the columns to be consistent with LMP data.
-    df.rename(lambda x: x.upper().replace('.', '').replace(' ', ''),
-              axis='columns', inplace=True)
 
-    # Localize the time.
-    df.index = df.index.tz_localize(TIMEZONE, ambiguous='infer')
+def process_load_forecast(df):
+    """Localize the load forecast data and keep the latest forecast."""
+    # Localize the time. Files overlap, so resolve the repeated hour
+    # within each file (see file_numbers).
+    with step('localize'):
+        df.index = localize_index(df.index, keys=file_numbers(df.index))
 
     # It turns out that the load forecast files have 6 days of forecast
     # in them. Keep only the most recent forecast.
-    dup = df.index.duplicated(keep='last')
-    df = df[~dup]
+    with step('dedup'):
+        dup = df.index.duplicated(keep='last')
+        return df[~dup]
 
-    # Save to file.
-    df.to_csv(LOAD_FORECAST_FILE)
 
+def process_load_forecast_vintages(df):
+    """Localize the load forecast data, keeping every forecast.
 
-def combine_load_realtime():
-    """Combine all the realtime load files into one."""
-    # Get all day-ahead LMP files.
-    files = get_file_list(root_dir=LOAD_REALTIME)
+    Each file holds forecasts issued LOAD_FORECAST_PUBLISH after the
+    start of the file's first day. Rather than keeping only the latest
+    forecast for each hour,
+    keep them all with their issue time (int64 nanoseconds, UTC) in the
+    ISSUED column, sorted by target time and then issue time. Use
+    read_load_forecast_asof to pick out the forecast available at a
+    given time.
+    """
+    with step('localize'):
+        files = file_numbers(df.index)
+        df.index = localize_index(df.index, keys=files)
 
-    # Read 'em all.
-    df = read_all_files(files)
+    with step('sort'):
+        # Issue time of each row's file.
+        starts = np.flatnonzero(np.diff(files, prepend=-1))
+        issued = (df.index[starts].normalize().tz_localize(None)
+                  + LOAD_FORECAST_PUBLISH).tz_localize(TIMEZONE).asi8
+        df.insert(0, ISSUED, issued[files])
 
-    # Drop the "Time Zone" column as it isn't useful.
-    df.drop(axis=1, labels=['Time Zone'], inplace=True)
+        order = np.lexsort((df[ISSUED].values, df.index.asi8))
+        return df.iloc[order]
 
-    # Clean up the columns.
-    df = clean_columns(df)
+
+def process_load_realtime(df):
+    """Clean, localize, and pivot the realtime load data."""
+    # Clean up the names.
+    with step('clean'):
+        df = clean_names(df)
 
     # Localize the times. This is time consuming (heh).
-    df = localize_times(df)
+    with step('localize'):
+        df = localize_times(df)
 
     # Pivot.
-    df_pivot = df.pivot(columns='Name')
+    with step('pivot'):
+        return df.pivot(columns='Name')
+
+
+@stage('combine_lmp_day_ahead')
+def combine_lmp_day_ahead(incremental=None):
+    """Combine day ahead LMP files into one."""
+    combine(LMP_DAY_AHEAD_ZONAL, LMP_DAY_AHEAD_STORE, LMP_DAY_AHEAD_FILE,
+            process_lmp_day_ahead, incremental=incremental)
+
+
+@stage('combine_lmp_realtime')
+def combine_lmp_realtime(incremental=None):
+    """Combine all realtime lmp files into one."""
+    combine(LMP_REALTIME_ZONAL, LMP_REALTIME_STORE, LMP_REALTIME_FILE,
+            process_lmp_realtime, incremental=incremental)
+
+
+@stage('combine_load_forecast')
+def combine_load_forecast(incremental=None):
+    """Combine all load forecast files into one."""
+    combine(LOAD_FORECAST, LOAD_FORECAST_STORE, LOAD_FORECAST_FILE,
+            process_load_forecast, spill=True, incremental=incremental)
+
+    # Keep every vintage too, for backtests.
+    with step('vintages'):
+        combine(LOAD_FORECAST, LOAD_FORECAST_VINTAGES_STORE,
+                LOAD_FORECAST_VINTAGES_FILE, process_load_forecast_vintages,
+                spill=True, incremental=incremental)
 
-    # Save to file.
-    df_pivot.to_csv(LOAD_REALTIME_FILE)
+
+@stage('combine_load_realtime')
+def combine_load_realtime(incremental=None):
+    """Combine all the realtime load files into one."""
+    combine(LOAD_REALTIME, LOAD_REALTIME_STORE, LOAD_REALTIME_FILE,
+            process_load_realtime, incremental=incremental)
+
+
+def read_gen_month(job):
+    """Read and localize one month of generator LMPs. Worker for
+    combine_gen.
+
+    :param job: Tuple (reader, source) from get_month_sources.
+
+    :returns: Tuple (times, names, values): int64 nanoseconds (UTC),
+        a Categorical of cleaned node names, and a VALUE_DTYPE array of
+        shape (rows, len(GEN_COMPONENTS)).
+    """
+    reader, source = job
+    df = clean_names(reader(source))
+    names = df['Name'].values
+    index = localize_index(df.index, keys=names.codes)
+    values = df[GEN_COMPONENTS].values.astype(VALUE_DTYPE, copy=False)
+    return index.asi8, names, values
+
+
+def imap_ahead(func, items, processes=None):
+    """Like pool_map, but yields results in order as they're ready,
+    with at most one item per process in flight (so only a few results
+    are ever held in memory at once).
+    """
+    if processes is None:
+        processes = PROCESSES
+
+    if max(1, min(processes, len(items))) == 1:
+        for i in items:
+            yield func(i)
+        return
+
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        items = iter(items)
+        pending = deque(pool.submit(func, i)
+                        for _, i in zip(range(processes), items))
+        while pending:
+            result = pending.popleft().result()
+            for i in items:
+                pending.append(pool.submit(func, i))
+                break
+            yield result
+
+
+def write_gen_dictionary(path, nodes):
+    """Write the node and component names of a generator store,
+    replacing them atomically.
+
+    :param nodes: Dictionary mapping node name to code.
+    """
+    dictionary = {'nodes': sorted(nodes, key=nodes.get),
+                  'components': GEN_COMPONENTS}
+    tmp = os.path.join(path, GEN_DICTIONARY_FILE + '.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(dictionary, f, indent=1)
+    os.replace(tmp, os.path.join(path, GEN_DICTIONARY_FILE))
+
+
+def combine_gen(root_dir, store, incremental=None):
+    """Combine generator LMP files into a long-format store.
+
+    With hundreds of generators, pivoting to one column per
+    (component, node) like the zonal data makes for an unwieldy table.
+    Instead, the store (month-partitioned, see columnar_store.py) has a
+    row per (time, node, component), sorted in that order, with columns:
+        - node: int32 code of the node name.
+        - component: int8 code of the price component.
+        - value: The price, as VALUE_DTYPE.
+    The node and component names are kept in GEN_DICTIONARY_FILE.
+
+    Months are read in parallel and written one at a time, so memory
+    use doesn't depend on how many months there are. Use read_gen_lmp
+    or pivot_nodes to read the store.
+
+    As with combine, the store records the signature of each month's
+    raw data, and in incremental mode only months whose signature
+    changed are read and replaced. The existing dictionary is kept, and
+    new nodes are given the next code, so the codes in the partitions
+    which aren't replaced stay valid. A full rebuild numbers the nodes
+    afresh.
+
+    :param root_dir: String. Directory the data was downloaded to.
+    :param store: String. Store to write.
+    :param incremental: Boolean. Only process what changed. Defaults to
+        INCREMENTAL.
+    """
+    if incremental is None:
+        incremental = INCREMENTAL
+
+    keys = get_month_keys()
+    jobs = get_month_sources(root_dir)
+    k = len(GEN_COMPONENTS)
+
+    # Anything which changes every month's output means a rebuild.
+    layout = hashlib.sha256(json.dumps(
+        [TIMEZONE, repr(SCHEMAS), TIME_FORMATS, GEN_COMPONENTS]).encode()
+    ).hexdigest()
+
+    with step('check'):
+        signatures = {key: month_signature(source)
+                      for key, (_, source) in zip(keys, jobs)}
+        sources = read_sources(store) if incremental else None
+        if sources is not None and (sources['layout'] != layout
+                                    or set(sources['months']) - set(keys)):
+            sources = None
+
+    if sources is None:
+        # Build next to the store and swap it in at the end.
+        out = store + '.tmp'
+        if os.path.exists(out):
+            shutil.rmtree(out)
+        nodes = {}
+    else:
+        # Update the store in place. Months only count as done once the
+        # sources are written at the end, so an interrupted run is
+        # picked up by the next one.
+        out = store
+        jobs = [j for key, j in zip(keys, jobs)
+                if sources['months'].get(key) != signatures[key]]
+        print('{}: {} of {} months changed.'.format(
+            store, len(jobs), len(keys)), flush=True)
+        if not jobs:
+            return
+        nodes = {n: i for i, n in
+                 enumerate(read_gen_dictionary(store)['nodes'])}
+
+    results = imap_ahead(read_gen_month, jobs)
+    for reader, source in jobs:
+        with step('month') as s:
+            with step('read'):
+                times, names, values = next(results)
+                files = [source] if isinstance(source, str) else source
+                count_read(rows=len(times), nbytes=sum(
+                    os.path.getsize(f) for f in files), files=files)
+
+            with step('encode'):
+                # Map the month's names onto the store's codes.
+                for name in names.categories:
+                    nodes.setdefault(name, len(nodes))
+                mapping = np.array([nodes[n] for n in names.categories],
+                                   dtype=np.int32)
+                keep = names.codes >= 0
+                codes = mapping[names.codes[keep]]
+                times = times[keep]
+                values = values[keep]
+
+                # Sort rows by (time, node), then melt the components.
+                order = np.lexsort((codes, times))
+                df = pd.DataFrame(
+                    {'node': np.repeat(codes[order], k),
+                     'component': np.tile(np.arange(k, dtype=np.int8),
+                                          len(order)),
+                     'value': values[order].ravel()},
+                    index=gen_index(np.repeat(times[order], k)))
+
+            with step('write'):
+                # When updating in place, the month's codes have to be
+                # in the dictionary before anything can read them.
+                if out == store:
+                    write_gen_dictionary(out, nodes)
+                write_partitioned(df, out, update=True)
+            s.note(month=df.index[0].strftime('%Y-%m') if len(df)
+                   else None)
+
+    os.makedirs(out, exist_ok=True)
+    write_gen_dictionary(out, nodes)
+    write_sources(out, {'layout': layout, 'months': signatures})
+
+    if out != store:
+        replace_store(out, store)
+
+
+@stage('combine_lmp_day_ahead_gen')
+def combine_lmp_day_ahead_gen(incremental=None):
+    """Combine day ahead generator LMP files into a long-format store."""
+    combine_gen(LMP_DAY_AHEAD_GEN, LMP_DAY_AHEAD_GEN_STORE,
+                incremental=incremental)
+
+
+@stage('combine_lmp_realtime_gen')
+def combine_lmp_realtime_gen(incremental=None):
+    """Combine real time generator LMP files into a long-format store."""
+    combine_gen(LMP_REALTIME_GEN, LMP_REALTIME_GEN_STORE,
+                incremental=incremental)
+
+
+def read_gen_dictionary(path):
+    """Read the node and component names of a generator store.
+
+    :returns: Dictionary with 'nodes' and 'components' lists, where a
+        name's position is its code.
+    """
+    with open(os.path.join(path, GEN_DICTIONARY_FILE)) as f:
+        return json.load(f)
+
+
+def lookup_codes(names, known, kind):
+    """Get the codes of names in a list of known names."""
+    positions = {n: i for i, n in enumerate(known)}
+    missing = [n for n in names if n not in positions]
+    if missing:
+        raise ValueError('Unknown {}: {}'.format(kind, ', '.join(missing)))
+    return np.array([positions[n] for n in names])
+
+
+def read_gen_arrays(path, nodes=None, components=None, start=None,
+                    end=None):
+    """Read the rows of a generator store for some nodes and components.
+
+    Partitions outside [start, end) aren't opened, and only the matching
+    rows are copied out of the memory-mapped columns.
+
+    :param path: String. Generator store (see combine_gen).
+    :param nodes: List of node codes, or None for all.
+    :param components: List of component codes, or None for all.
+    :param start: See columnar_store.read_frame.
+    :param end: See columnar_store.read_frame.
+
+    :returns: Tuple (times, node, component, value) of arrays, sorted
+        by time. times are int64 nanoseconds (UTC).
+    """
+    out = []
+    nbytes = 0
+    for p in select_partitions(path, start=start, end=end):
+        part = os.path.join(path, p['key'])
+        meta, t, cols = open_columns(part)
+        first, last = row_range(meta, t, start=start, end=end)
+        node = cols['node'][first:last]
+        comp = cols['component'][first:last]
+
+        keep = np.ones(last - first, dtype=bool)
+        if nodes is not None:
+            keep &= np.isin(node, nodes)
+        if components is not None:
+            keep &= np.isin(comp, components)
+
+        rows = np.flatnonzero(keep)
+        out.append((t[first:last][rows], node[rows], comp[rows],
+                    cols['value'][first:last][rows]))
+        nbytes += (last - first) * (node.itemsize + comp.itemsize) \
+            + len(rows) * (t.itemsize + cols['value'].itemsize)
+
+    count_read(rows=sum(len(o[0]) for o in out), nbytes=nbytes, files=path)
+    if not out:
+        return (np.array([], np.int64), np.array([], np.int32),
+                np.array([], np.int8), np.array([], VALUE_DTYPE))
+
+    return tuple(np.concatenate(a) for a in zip(*out))
+
+
+def gen_index(times):
+    """DatetimeIndex in TIMEZONE from int64 nanoseconds (UTC)."""
+    return pd.DatetimeIndex(times.view('M8[ns]'), name='Time Stamp')\
+        .tz_localize('UTC').tz_convert(TIMEZONE)
+
+
+def read_gen_lmp(path=LMP_REALTIME_GEN_STORE, nodes=None, components=None,
+                 start=None, end=None):
+    """Read a generator store in long format.
+
+    :param path: String. Generator store (see combine_gen).
+    :param nodes: List of node names, or None for all of them. Names are
+        cleaned like clean_names does, so 'GEN 1' and 'GEN1' match.
+    :param components: List of components (see GEN_COMPONENTS), or None
+        for all of them.
+    :param start: See columnar_store.read_frame.
+    :param end: See columnar_store.read_frame.
+
+    :returns: DataFrame indexed by time, with categorical 'node' and
+        'component' columns and a 'value' column.
+    """
+    dictionary = read_gen_dictionary(path)
+    node_codes = None if nodes is None else lookup_codes(
+        [clean_name(n) for n in nodes], dictionary['nodes'], 'nodes')
+    comp_codes = None if components is None else lookup_codes(
+        components, dictionary['components'], 'components')
+
+    t, node, comp, value = read_gen_arrays(
+        path, nodes=node_codes, components=comp_codes, start=start, end=end)
+
+    return pd.DataFrame(
+        {'node': pd.Categorical.from_codes(node, dictionary['nodes']),
+         'component': pd.Categorical.from_codes(comp,
+                                                dictionary['components']),
+         'value': value}, index=gen_index(t))
+
+
+def pivot_nodes(nodes, path=LMP_REALTIME_GEN_STORE, components=None,
+                start=None, end=None):
+    """Read some nodes of a generator store as a wide DataFrame, laid out
+    like the zonal stores (one column per (component, Name)).
+
+    :param nodes: List of node names (see read_gen_lmp).
+    :param path: String. Generator store (see combine_gen).
+    :param components: List of components (see GEN_COMPONENTS), or None
+        for all of them.
+    :param start: See columnar_store.read_frame.
+    :param end: See columnar_store.read_frame.
+
+    Times where a node has no data are NaN.
+    """
+    dictionary = read_gen_dictionary(path)
+    nodes = [clean_name(n) for n in nodes]
+    if components is None:
+        components = dictionary['components']
+    node_codes = lookup_codes(nodes, dictionary['nodes'], 'nodes')
+    comp_codes = lookup_codes(components, dictionary['components'],
+                              'components')
+
+    t, node, comp, value = read_gen_arrays(
+        path, nodes=node_codes, components=comp_codes, start=start, end=end)
+
+    # Position of each code among the requested nodes and components.
+    node_pos = np.full(len(dictionary['nodes']), -1)
+    node_pos[node_codes] = np.arange(len(node_codes))
+    comp_pos = np.full(len(dictionary['components']), -1)
+    comp_pos[comp_codes] = np.arange(len(comp_codes))
+
+    # t is sorted, so np.unique gives each row's output row directly.
+    times, row = np.unique(t, return_inverse=True)
+    col = comp_pos[comp] * len(nodes) + node_pos[node]
+    out = np.full((len(times), len(comp_codes) * len(nodes)), np.nan,
+                  dtype=VALUE_DTYPE)
+    out[row, col] = value
+
+    columns = pd.MultiIndex.from_product([components, nodes],
+                                         names=[None, 'Name'])
+    return pd.DataFrame(out, index=gen_index(times), columns=columns)
+
+
+def asof_positions(target, issued, query, cutoff):
+    """Find, for each query, the row of the latest forecast for the
+    query's target time issued no later than its cutoff.
+
+    :param target: int64 array of target times, sorted.
+    :param issued: int64 array of issue times, sorted within each
+        target time.
+    :param query: int64 array of target times to look up.
+    :param cutoff: int64 array (same length as query) of the latest
+        issue time allowed for each query.
+
+    :returns: Array of row positions, -1 where there's no forecast.
+    """
+    lo = np.searchsorted(target, query, 'left')
+    hi = np.searchsorted(target, query, 'right')
+    pos = np.full(len(query), -1)
+
+    # Each target only has a handful of vintages, so step through them
+    # for every query at once. Issue times are sorted, so the last one
+    # before the cutoff wins.
+    for k in range(int((hi - lo).max(initial=0))):
+        row = lo + k
+        ok = row < hi
+        ok[ok] = issued[row[ok]] <= cutoff[ok]
+        pos[ok] = row[ok]
+
+    return pos
+
+
+def to_index(times, n=None):
+    """Make a localized DatetimeIndex from anything DatetimeIndex
+    accepts, or a single time. Naive times are taken to be in TIMEZONE.
+
+    :param n: Integer. Repeat a single time this many times.
+    """
+    if not isinstance(times, pd.DatetimeIndex):
+        times = pd.DatetimeIndex(np.atleast_1d(times))
+    if times.tz is None:
+        times = times.tz_localize(TIMEZONE)
+    if n is not None and len(times) == 1:
+        times = times.repeat(n)
+    return times
+
+
+def read_load_forecast_asof(targets, lead=0, issued_by=None,
+                            columns=None, path=LOAD_FORECAST_VINTAGES_STORE):
+    """Get the load forecast that was available for each target time.
+
+    For each target, the latest forecast issued at least lead before
+    the target and no later than issued_by is returned. E.g. to get the
+    forecasts available when the day ahead market closed:
+
+        read_load_forecast_asof(hours, issued_by=hours.normalize()
+                                - pd.Timedelta(hours=19))
+
+    Issue times aren't in the data: each file is assumed to be issued
+    LOAD_FORECAST_PUBLISH after the start of its first day, and not
+    revised after that. If NYISO actually published (or revised) a file
+    later than that, lookups can return a forecast slightly before it
+    was really available, so set LOAD_FORECAST_PUBLISH conservatively.
+    By default (lead=0), a forecast is never used for a target before
+    its issue time.
+
+    :param targets: Target times. Anything DatetimeIndex accepts.
+    :param lead: Anything pd.Timedelta accepts, or None for no limit.
+    :param issued_by: A time, or times (one per target), or None.
+    :param columns: List of zone columns (e.g. 'NYC'), or None for all.
+    :param path: String. Vintages store (see
+        process_load_forecast_vintages).
+
+    :returns: DataFrame indexed by targets with the ISSUED time of each
+        forecast used and the forecasts. Targets without a forecast are
+        NaN (and NaT).
+    """
+    targets = to_index(targets)
+    cutoff = np.full(len(targets), np.iinfo(np.int64).max)
+    if lead is not None:
+        cutoff = np.minimum(cutoff, targets.asi8 - pd.Timedelta(lead).value)
+    if issued_by is not None:
+        cutoff = np.minimum(cutoff, to_index(issued_by, len(targets)).asi8)
+
+    if columns is not None:
+        columns = [ISSUED] + [c for c in columns if c != ISSUED]
+    bounds = (targets.min(), targets.max() + pd.Timedelta(1)) \
+        if len(targets) else (0, 0)
+    df = read_frame(path, columns=columns, start=bounds[0], end=bounds[1])
+    values = df.drop(columns=ISSUED)
+
+    pos = asof_positions(df.index.asi8, df[ISSUED].values, targets.asi8,
+                         cutoff)
+
+    # Position -1 picks an extra row of NaNs (and NaT) for targets
+    # without a forecast.
+    data = np.vstack([values.values, np.full((1, values.shape[1]), np.nan,
+                                             dtype=values.values.dtype)])
+    issued = np.append(df[ISSUED].values, np.iinfo(np.int64).min)
+
+    out = pd.DataFrame(data[pos], index=targets, columns=values.columns)
+    out.insert(0, ISSUED, gen_index(issued[pos]))
+    return out
 
 
 def main():
-    # combine_lmp_day_ahead()
-    # combine_lmp_realtime()
+    # To only rebuild what's out of date, use pipeline.py instead.
+    combine_lmp_day_ahead()
+    combine_lmp_realtime()
     combine_load_forecast()
-    # combine_load_realtime()
-    pass
+    combine_load_realtime()
+    if GET_GEN:
+        combine_lmp_day_ahead_gen()
+        combine_lmp_realtime_gen()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,162 @@
+"""Module for finding gaps (runs of consecutive NaNs) in DataFrames.
+
+Every column is handled at once with a single pass of NumPy operations
+over the NaN mask, rather than a groupby per column.
+
+Usage:
+    report = gap_report(df)
+    print(report['max_run'])
+"""
+# Third-party:
+import numpy as np
+import pandas as pd
+
+
+def nan_runs(isna):
+    """Find every run of True in each column of a 2-D boolean array.
+
+    :param isna: 2-D boolean array, shape (rows, columns).
+
+    :returns: Tuple of 1-D integer arrays (col, start, length), one
+        entry per run, sorted by column and then start row.
+    """
+    isna = np.asarray(isna, dtype=bool)
+    if isna.ndim == 1:
+        isna = isna[:, np.newaxis]
+
+    # Pad with a row of False on each end so every run has a start and
+    # an end, then difference: +1 marks a start, -1 marks one past the
+    # end. Transposing first means nonzero walks column by column.
+    padded = np.zeros((isna.shape[1], isna.shape[0] + 2), dtype=np.int8)
+    padded[:, 1:-1] = isna.T
+    d = np.diff(padded, axis=1)
+
+    col, start = np.nonzero(d == 1)
+    stop = np.nonzero(d == -1)[1]
+
+    return col, start, stop - start
+
+
+def block_starts(sorted_keys):
+    """Positions where each block of equal values in a sorted array
+    starts.
+    """
+    return np.concatenate([[0], np.flatnonzero(np.diff(sorted_keys)) + 1])
+
+
+def run_cells(start, length):
+    """Row of every cell of the runs from nan_runs, run by run (the same
+    order nan_runs walks them in).
+    """
+    return np.repeat(start, length) + (np.arange(length.sum())
+                                       - np.repeat(np.cumsum(length)
+                                                   - length, length))
+
+
+def run_lengths(isna):
+    """For each cell, the length of the NaN run it belongs to.
+
+    :param isna: 2-D boolean array, shape (rows, columns).
+
+    :returns: 2-D integer array the same shape as isna. Zero where isna
+        is False.
+    """
+    isna = np.asarray(isna, dtype=bool)
+    col, start, length = nan_runs(isna)
+
+    out = np.zeros(isna.shape, dtype=np.int64)
+    if len(col) == 0:
+        return out
+
+    # Drop each run's length into its cells.
+    out[run_cells(start, length), np.repeat(col, length)] = \
+        np.repeat(length, length)
+    return out
+
+
+def run_ids(isna):
+    """Number the NaN runs of a 2-D boolean array.
+
+    :param isna: 2-D boolean array, shape (rows, columns).
+
+    :returns: Tuple (ids, count). ids is a 2-D integer array the same
+        shape as isna, holding the number (0 to count - 1, in nan_runs'
+        order) of the run each cell belongs to, and -1 where isna is
+        False. count is the number of runs.
+    """
+    isna = np.asarray(isna, dtype=bool)
+    col, start, length = nan_runs(isna)
+
+    out = np.full(isna.shape, -1, dtype=np.int64)
+    out[run_cells(start, length), np.repeat(col, length)] = \
+        np.repeat(np.arange(len(col)), length)
+    return out, len(col)
+
+
+def gap_runs(df):
+    """List every gap in a DataFrame.
+
+    :param df: DataFrame.
+
+    :returns: DataFrame with one row per gap and columns 'column',
+        'start', 'end' (index labels of the first and last NaN), and
+        'length' (number of rows).
+    """
+    col, start, length = nan_runs(df.isna().values)
+    return pd.DataFrame({'column': df.columns[col],
+                         'start': df.index[start],
+                         'end': df.index[start + length - 1],
+                         'length': length})
+
+
+def gap_report(df):
+    """Summarize the gaps in each column of a DataFrame.
+
+    :param df: DataFrame.
+
+    :returns: DataFrame indexed by df's columns with columns:
+        - nan_count: Total number of NaNs.
+        - run_count: Number of separate gaps.
+        - max_run: Length of the longest gap (0 if there are none).
+        - max_run_start, max_run_end: Index labels of the first and last
+            NaN of the longest gap (the earliest one if there's a tie).
+            Missing if the column has no gaps.
+    """
+    isna = df.isna().values
+    n_cols = isna.shape[1]
+    col, start, length = nan_runs(isna)
+
+    max_run = np.zeros(n_cols, dtype=np.int64)
+    max_start = np.full(n_cols, -1, dtype=np.int64)
+
+    if len(col):
+        # Runs are already sorted by column, so each column's runs are
+        # one contiguous block.
+        first = block_starts(col)
+        max_run[col[first]] = np.maximum.reduceat(length, first)
+
+        # The earliest run in each column which is as long as the
+        # longest.
+        is_max = np.flatnonzero(length == max_run[col])
+        first = block_starts(col[is_max])
+        max_start[col[is_max[first]]] = start[is_max[first]]
+
+    has_gap = max_start >= 0
+    starts = pd.Series(df.index[max_start[has_gap]],
+                       index=df.columns[has_gap])
+    ends = pd.Series(df.index[max_start[has_gap] + max_run[has_gap] - 1],
+                     index=df.columns[has_gap])
+
+    report = pd.DataFrame({'nan_count': isna.sum(axis=0),
+                           'run_count': np.bincount(col, minlength=n_cols),
+                           'max_run': max_run}, index=df.columns)
+    report['max_run_start'] = starts.reindex(df.columns)
+    report['max_run_end'] = ends.reindex(df.columns)
+
+    return report
+
+
+def print_max_runs(report):
+    """Print the longest gap in each column of a gap_report."""
+    for c, n in report['max_run'].items():
+        print('Max consecutive NaNs in {}: {:d}'.format(c, n))
@@ -0,0 +1,240 @@
+"""Module for filling gaps (runs of NaNs) in regularly sampled data.
+
+Short gaps are interpolated. Long gaps, where interpolation would just
+draw a straight line through hours or days of missing data, are filled
+from the same time on a previous day or week, or from a neighboring
+column (e.g. the same feature in a nearby zone). Each long gap is filled
+from one source throughout, so the data may be sparse (e.g. hourly
+observations at different minutes past the hour, on a 5 minute grid).
+Whatever is left over is interpolated, and anything before the first
+valid value is back filled.
+
+Everything is done with whole-frame NumPy operations, and every filled
+cell is recorded in a mask (see FILL_CODES) so we know which values are
+real.
+
+Usage:
+    filled, mask = fill_gaps(df, max_interpolate='15h',
+                             lags=['1D', '7D'],
+                             neighbors={'temp_A': ['temp_B']})
+"""
+# Third-party:
+import numpy as np
+import pandas as pd
+
+# Imports from gap_analysis.py
+from gap_analysis import run_lengths, run_ids
+
+# Codes used in the mask returned by fill_gaps.
+ORIGINAL = 0
+INTERPOLATED = 1
+NEIGHBOR = 2
+BACKFILLED = 3
+# Seasonal fills get LAG_CODE_START for the first lag, +1 for the next,
+# and so on.
+LAG_CODE_START = 10
+
+FILL_CODES = {ORIGINAL: 'original', INTERPOLATED: 'interpolated',
+              NEIGHBOR: 'neighbor', BACKFILLED: 'backfilled'}
+
+
+def index_step(index):
+    """Get the (constant) spacing of a DatetimeIndex as a Timedelta.
+
+    Raises a ValueError if the index isn't regularly spaced.
+    """
+    if len(index) < 2:
+        raise ValueError('Need at least two rows to determine spacing.')
+
+    d = np.diff(index.asi8)
+    if not (d == d[0]).all() or d[0] <= 0:
+        raise ValueError('Index must be sorted and regularly spaced.')
+
+    return pd.Timedelta(int(d[0]))
+
+
+def to_rows(span, step):
+    """Convert a time span (anything pd.Timedelta accepts) into a number
+    of rows.
+    """
+    rows, rem = divmod(pd.Timedelta(span).value, step.value)
+    if rem:
+        raise ValueError('{} is not a multiple of the index spacing {}.'
+                         .format(span, step))
+    return int(rows)
+
+
+def suffix_neighbors(columns, zone_neighbors, sep='_'):
+    """Build a neighbors dictionary for columns named like
+    <feature><sep><zone>.
+
+    :param columns: Iterable of column names.
+    :param zone_neighbors: Dictionary mapping each zone to a list of
+        neighboring zones, nearest first.
+    :param sep: String separating the feature from the zone.
+
+    :returns: Dictionary mapping each column to a list of the columns
+        for the same feature in neighboring zones (which exist in
+        columns), nearest first.
+    """
+    columns = list(columns)
+    present = set(columns)
+    out = {}
+    for col in columns:
+        feature, _, zone = col.rpartition(sep)
+        candidates = [feature + sep + z
+                      for z in zone_neighbors.get(zone, [])]
+        out[col] = [c for c in candidates if c in present]
+
+    return out
+
+
+def shift_rows(values, n):
+    """Shift a 2-D array down by n rows, filling the top with NaN."""
+    out = np.full_like(values, np.nan)
+    if n < len(values):
+        out[n:] = values[:len(values) - n]
+    return out
+
+
+def realign(source, limit):
+    """Interpolate a fill source across its own short gaps (at most limit
+    rows), so that a source sampled at other times than the column it
+    fills (e.g. a zone reporting at a different minute past the hour)
+    has a value on every row between its samples.
+    """
+    isna = np.isnan(source)
+    out = pd.DataFrame(source).interpolate(limit_area='inside').values
+    out[isna & (run_lengths(isna) > limit)] = np.nan
+    return out
+
+
+def fill_sources(original, columns, step, lags, neighbors):
+    """Yield the fill sources for fill_gaps, in order of preference, as
+    (source, code) tuples: a 2-D array like original, and the mask code
+    for cells filled from it.
+    """
+    for i, lag in enumerate(lags):
+        yield shift_rows(original, to_rows(lag, step)), LAG_CODE_START + i
+
+    # One source array per level of preference (nearest neighbor, next
+    # nearest, ...).
+    if neighbors:
+        col_pos = {c: i for i, c in enumerate(columns)}
+        depth = max(len(v) for v in neighbors.values())
+        for level in range(depth):
+            src_col = np.array([
+                col_pos[neighbors[c][level]]
+                if c in neighbors and len(neighbors[c]) > level else -1
+                for c in columns])
+
+            source = original[:, np.maximum(src_col, 0)]
+            source[:, src_col < 0] = np.nan
+            yield source, NEIGHBOR
+
+
+def fill_gaps(df, max_interpolate, lags=('1D', '7D'), neighbors=None):
+    """Fill the gaps in a regularly sampled DataFrame.
+
+    Gaps longer than max_interpolate are filled from one of these
+    sources, in order of preference:
+        1) The same time one lag earlier, for each lag in lags.
+        2) The neighboring columns given in neighbors, nearest first.
+    Each gap takes all its values from one source: the first with a
+    value for every row of the gap, or failing that the one with values
+    for the most rows. All fill sources are the original (unfilled)
+    data, interpolated across their own short gaps (see realign).
+    Anything still missing is then interpolated in time, and leading
+    NaNs back filled.
+
+    :param df: DataFrame with a regularly spaced DatetimeIndex.
+    :param max_interpolate: Anything pd.Timedelta accepts. Longest gap
+        (in time covered by the missing rows) to simply interpolate.
+    :param lags: List of time spans (anything pd.Timedelta accepts) to
+        look back for seasonal fills.
+    :param neighbors: Dictionary mapping column names to lists of
+        neighboring column names, nearest first. See suffix_neighbors.
+
+    :returns: Tuple (filled, mask). filled is a new DataFrame like df
+        with no NaNs (unless a column is entirely NaN). mask is a
+        DataFrame of uint8 codes (see FILL_CODES and LAG_CODE_START)
+        saying how each cell was filled.
+    """
+    step = index_step(df.index)
+    limit = to_rows(max_interpolate, step)
+
+    original = df.values.astype(float)
+    values = original.copy()
+    isna = np.isnan(original)
+    mask = np.zeros(values.shape, dtype=np.uint8)
+
+    # Gaps which are too long to interpolate, and the number of the gap
+    # each of their cells is in.
+    todo = run_lengths(isna) > limit
+    gap, n_gaps = run_ids(todo)
+    gap = gap[todo]
+    length = np.bincount(gap, minlength=n_gaps)
+
+    # How many cells of each gap each source covers. The sources are
+    # made again below rather than all held at once, as each is the
+    # size of df.
+    covered = [
+        np.bincount(gap, weights=~np.isnan(realign(source, limit)[todo]),
+                    minlength=n_gaps)
+        for source, _ in fill_sources(original, df.columns, step, lags,
+                                      neighbors)]
+
+    # Pick a source for each gap (-1 for none).
+    choice = np.full(n_gaps, -1)
+    if covered:
+        covered = np.array(covered)
+        full = covered == length
+        choice = np.where(full.any(axis=0), full.argmax(axis=0),
+                          covered.argmax(axis=0))
+        choice[covered.max(axis=0) == 0] = -1
+
+    cell_choice = np.full(values.shape, -1)
+    cell_choice[todo] = choice[gap]
+    for k, (source, code) in enumerate(fill_sources(
+            original, df.columns, step, lags, neighbors)):
+        source = realign(source, limit)
+        take = (cell_choice == k) & ~np.isnan(source)
+        values[take] = source[take]
+        mask[take] = code
+
+    filled = pd.DataFrame(values, index=df.index, columns=df.columns)
+
+    # Interpolate everything else (the short gaps, plus any long gaps
+    # we couldn't fill).
+    before = np.isnan(values)
+    filled.interpolate(method='time', inplace=True)
+    after = np.isnan(filled.values)
+    mask[before & ~after] = INTERPOLATED
+
+    # Back fill leading NaNs.
+    filled.fillna(method='backfill', inplace=True)
+    mask[after & ~np.isnan(filled.values)] = BACKFILLED
+
+    # Keep the original dtypes where we can.
+    filled = filled.astype(df.dtypes.to_dict())
+
+    return filled, pd.DataFrame(mask, index=df.index, columns=df.columns)
+
+
+def describe_mask(mask, lags=('1D', '7D')):
+    """Count how each column's cells were filled.
+
+    :param mask: Mask DataFrame from fill_gaps.
+    :param lags: The lags given to fill_gaps, for naming.
+
+    :returns: DataFrame indexed by mask's columns, with one column per
+        fill method.
+    """
+    names = dict(FILL_CODES)
+    for i, lag in enumerate(lags):
+        names[LAG_CODE_START + i] = 'lag_{}'.format(lag)
+
+    values = mask.values
+    return pd.DataFrame({name: (values == code).sum(axis=0)
+                         for code, name in sorted(names.items())},
+                        index=mask.columns)
@@ -2,21 +2,50 @@
 
 Please read the NOTES section of nyiso_url.
 
-Adapt the "main" section of the code to download what you would like.
+Adapt the constants below (and main) to download what you would like.
+
+Downloads are performed by a small pool of worker threads which share a
+single requests Session (so connections get re-used), retry failed
+requests with exponential backoff, and limit the number of concurrent
+requests made to any one host.
+
+Each data directory holds a manifest (see MANIFEST_FILE) recording the
+size, content hash and HTTP validators (ETag/Last-Modified) of every
+archive we've downloaded. Reruns send conditional requests, so only
+months which are new or have changed (e.g. the current month) are
+downloaded and extracted again.
+
+By default each monthly archive is extracted into <data_dir>/<YYYYMMDD>/.
+With keep_zip=True (see KEEP_ZIP) the archive is instead saved as
+<data_dir>/<YYYYMMDD>.zip and never extracted; combine_nyiso_data can
+read the CSV files straight out of the archives.
 """
 # Third-party:
 import requests
+from requests.adapters import HTTPAdapter
 
 # Built-in:
+import hashlib
+import json
 import os
-from zipfile import ZipFile
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urlsplit
+from zipfile import BadZipFile, ZipFile
 from io import BytesIO
 
+# Imports from instrumentation.py
+from instrumentation import stage, step, record, count_read, count_written
+
 # Directories for saving data. Use these in the 'main' section.
 LMP_DAY_AHEAD_ZONAL = 'nyiso_lmp_day_ahead_zonal'
 LMP_REALTIME_ZONAL = 'nyiso_lmp_realtime_zonal'
 LOAD_FORECAST = 'nyiso_load_forecast'
 LOAD_REALTIME = 'nyiso_load_realtime'
+LMP_DAY_AHEAD_GEN = 'nyiso_lmp_day_ahead_gen'
+LMP_REALTIME_GEN = 'nyiso_lmp_realtime_gen'
 
 # Years to grab data for (inclusive).
 START_YEAR = 2016
@@ -28,19 +57,78 @@ END_MONTH = 12
 # end URL uncommented at a time.
 NYISO_BASE_URL = 'http://mis.nyiso.com/public/csv/'
 
+# Datasets to download in the 'main' section. Each entry is
+# (data_dir, data_type, day_ahead, zonal).
+DATASETS = [(LMP_DAY_AHEAD_ZONAL, 'lmp', True, True),
+            (LMP_REALTIME_ZONAL, 'lmp', False, True),
+            (LOAD_FORECAST, 'load', True, True),
+            (LOAD_REALTIME, 'load', False, True)]
+
+# Generator (nodal) LMP datasets, only downloaded if GET_GEN is set.
+# There are hundreds of generators, so these are much bigger than the
+# zonal data.
+GEN_DATASETS = [(LMP_DAY_AHEAD_GEN, 'lmp', True, False),
+                (LMP_REALTIME_GEN, 'lmp', False, False)]
+GET_GEN = False
+
+# Download tuning. MAX_WORKERS is the size of the thread pool, while
+# MAX_PER_HOST caps how many of those threads may be talking to the
+# same host at once (let's be nice to NYISO).
+MAX_WORKERS = 8
+MAX_PER_HOST = 4
+
+# Retry settings. We'll wait BACKOFF * 2**attempt seconds (plus a bit
+# of jitter) between attempts.
+MAX_RETRIES = 5
+BACKOFF = 0.5
+TIMEOUT = 60
+
+# HTTP status codes which are worth retrying.
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+# Request errors which are worth retrying (e.g. a connection dropped
+# part way through the body).
+RETRY_ERRORS = (requests.ConnectionError, requests.Timeout,
+                requests.exceptions.ChunkedEncodingError)
+
+# Errors which only fail the file they came from (e.g. a corrupt
+# archive). Anything else stops the download.
+FETCH_ERRORS = (UserWarning, BadZipFile, requests.RequestException)
+
+# Name of the manifest file kept in each data directory.
+MANIFEST_FILE = 'manifest.json'
+
+# Set to True to keep the monthly ZIP archives rather than extracting
+# thousands of small CSV files.
+KEEP_ZIP = False
+
 
 def get_date_str(year, month):
     """Simple helper for creating the NYISO date strings."""
     return str(year) + '{:02d}'.format(month) + '01'
 
 
-def nyiso_url(data_type, day_ahead, date_str, zonal=True):
+def get_day_str(day):
+    """Date string (like get_date_str) of a single day, e.g. for the
+    daily files (see nyiso_url).
+
+    :param day: datetime.date, datetime, or Timestamp.
+    """
+    return '{:%Y%m%d}'.format(day)
+
+
+def nyiso_url(data_type, day_ahead, date_str, zonal=True, daily=False,
+              base_url=None):
     """Helper function to formulate a URL for downloading NYISO data.
 
     :param data_type: String. Either 'load' or 'lmp.'
     :param day_ahead: Boolean. True for day ahead, False for real time.
     :param date_str: String. Represents date like YYYYMMDD.
     :param zonal: Boolean. True for zonal, False for generator.
+    :param daily: Boolean. True for the CSV file of the single day
+        date_str, which NYISO updates through the day, rather than the
+        monthly archive. The file has the same name as in the archive.
+    :param base_url: String. Defaults to NYISO_BASE_URL.
 
     NOTES:
         - The zonal input is not used if data_type is 'load.'
@@ -74,6 +162,7 @@ def nyiso_url(data_type, day_ahead, date_str, zonal=True):
         url_mid = 'pal'
         # Example:
         # http://mis.nyiso.com/public/csv/pal/20180501pal_csv.zip
+        # http://mis.nyiso.com/public/csv/pal/20180501pal.csv (daily)
     else:
         raise ValueError("data_type must be 'load' or 'lmp' and day_ahead "
                          "must be a boolean.")
@@ -89,16 +178,373 @@ def nyiso_url(data_type, day_ahead, date_str, zonal=True):
 
     # Construct the full URL.
     # noinspection PyUnboundLocalVariable
-    url = '{base}/{mid}/{date}{mid}{e}_csv.zip'.format(base=NYISO_BASE_URL,
-                                                       mid=url_mid,
-                                                       date=date_str,
-                                                       e=url_end)
+    url = '{base}/{mid}/{date}{mid}{e}{ext}'.format(
+        base=NYISO_BASE_URL if base_url is None else base_url,
+        mid=url_mid, date=date_str, e=url_end,
+        ext='.csv' if daily else '_csv.zip')
 
     return url
 
 
-def get_data(data_dir, data_type, day_ahead, zonal, start_year=2016,
+class HostLimiter:
+    """Cap the number of concurrent requests made to each host.
+
+    Usage:
+        limiter = HostLimiter(max_per_host=4)
+        with limiter(url):
+            ...
+    """
+
+    def __init__(self, max_per_host=MAX_PER_HOST):
+        self.max_per_host = max_per_host
+        self._lock = threading.Lock()
+        self._semaphores = {}
+
+    def __call__(self, url):
+        """Return the semaphore for the host of the given URL."""
+        host = urlsplit(url).netloc
+
+        with self._lock:
+            try:
+                sem = self._semaphores[host]
+            except KeyError:
+                sem = threading.BoundedSemaphore(self.max_per_host)
+                self._semaphores[host] = sem
+
+        return sem
+
+
+def get_session(pool_size=MAX_WORKERS):
+    """Create a requests Session whose connection pool is large enough
+    to serve all our worker threads.
+
+    :param pool_size: Integer. Number of connections to keep per host.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def read_manifest(data_dir):
+    """Read the download manifest for a data directory.
+
+    :param data_dir: String. Directory for this dataset.
+
+    :returns: Dictionary keyed by URL. Each value is a dictionary with
+        'date_str', 'size', 'sha256', 'etag', and 'last_modified' keys.
+        Empty if there is no manifest yet.
+    """
+    try:
+        with open(os.path.join(data_dir, MANIFEST_FILE), 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def write_manifest(data_dir, manifest):
+    """Write the download manifest for a data directory.
+
+    The manifest is written to a temporary file first and then moved
+    into place, so an interrupted run can't leave a corrupt manifest.
+    """
+    path = os.path.join(data_dir, MANIFEST_FILE)
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tmp, path)
+
+
+def archive_path(data_dir, date_str):
+    """Path of a kept monthly archive (see KEEP_ZIP)."""
+    return os.path.join(data_dir, date_str + '.zip')
+
+
+def month_exists(data_dir, date_str, keep_zip=False):
+    """Check if the data for a month is present on disk.
+
+    :param data_dir: String. Directory for this dataset.
+    :param date_str: String. Represents date like YYYYMMDD.
+    :param keep_zip: Boolean. True to look for the archive rather than
+        the extracted directory.
+    """
+    if keep_zip:
+        return os.path.isfile(archive_path(data_dir, date_str))
+
+    return os.path.isdir(os.path.join(data_dir, date_str))
+
+
+def conditional_headers(entry):
+    """Build conditional request headers from a manifest entry.
+
+    :param entry: Dictionary from the manifest, or None.
+    """
+    headers = {}
+    if entry is None:
+        return headers
+
+    if entry.get('etag'):
+        headers['If-None-Match'] = entry['etag']
+    if entry.get('last_modified'):
+        headers['If-Modified-Since'] = entry['last_modified']
+
+    return headers
+
+
+def download(session, url, limiter, max_retries=MAX_RETRIES,
+             backoff=BACKOFF, timeout=TIMEOUT, headers=None):
+    """Download a URL, retrying with exponential backoff.
+
+    :param session: requests Session to use for the request.
+    :param url: String. URL to download.
+    :param limiter: HostLimiter instance.
+    :param max_retries: Integer. Number of retries before giving up.
+    :param backoff: Float. Base number of seconds to wait between tries.
+    :param timeout: Float. Seconds to wait for the server.
+    :param headers: Dictionary of extra request headers, e.g. from
+        conditional_headers.
+
+    :returns: requests Response object. Note the status code will be
+        304 if a conditional request found the file unchanged.
+    """
+    attempt = 0
+    while True:
+        try:
+            with limiter(url):
+                r = session.get(url, timeout=timeout, headers=headers)
+        except RETRY_ERRORS as e:
+            error = e
+        else:
+            if r.status_code not in RETRY_STATUS:
+                # Either we succeeded, or retrying won't help.
+                if not r.ok:
+                    raise UserWarning('Failed to download {} (HTTP {})'
+                                      .format(url, r.status_code))
+                return r
+
+            error = UserWarning('HTTP {}'.format(r.status_code))
+
+        if attempt >= max_retries:
+            raise UserWarning('Failed to download {} after {} attempts: {}'
+                              .format(url, attempt + 1, error))
+
+        # Back off, with some jitter so the workers don't all retry in
+        # lock step.
+        time.sleep(backoff * 2 ** attempt * (1 + random.random()))
+        attempt += 1
+
+
+def extract(content, data_dir, date_str):
+    """Extract a downloaded monthly archive into <data_dir>/<date_str>.
+
+    :param content: Bytes. The ZIP archive.
+    :param data_dir: String. Directory for this dataset.
+    :param date_str: String. Represents date like YYYYMMDD.
+    """
+    # Get data into ZIP archive.
+    z = ZipFile(BytesIO(content))
+
+    # Create directory for this archive. Don't complain if it already
+    # exists.
+    this_dir = os.path.join(data_dir, date_str)
+    os.makedirs(this_dir, exist_ok=True)
+
+    # Extract data to directory.
+    z.extractall(path=this_dir)
+
+    infos = z.infolist()
+    count_written(nbytes=sum(i.file_size for i in infos),
+                  files=[os.path.join(this_dir, i.filename) for i in infos])
+
+
+def save_archive(content, data_dir, date_str):
+    """Save a downloaded monthly archive as <data_dir>/<date_str>.zip.
+
+    :param content: Bytes. The ZIP archive.
+    :param data_dir: String. Directory for this dataset.
+    :param date_str: String. Represents date like YYYYMMDD.
+    """
+    # Make sure we actually got a ZIP archive before keeping it.
+    ZipFile(BytesIO(content)).testzip()
+
+    # Write to a temporary file and move into place so readers never
+    # see a partial archive.
+    path = archive_path(data_dir, date_str)
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(content)
+    os.replace(tmp, path)
+
+    count_written(nbytes=len(content), files=path)
+
+
+def get_jobs(data_dir, data_type, day_ahead, zonal, start_year=2016,
              end_year=2018, start_month=1, end_month=12):
+    """Build the list of download jobs for a single dataset.
+
+    Inputs are the same as for get_data.
+
+    :returns: List of (data_dir, url, date_str) tuples.
+    """
+    jobs = []
+    # NYISO stores data in monthly archives. Loop over years and months.
+    for year in range(start_year, end_year+1):
+        for month in range(start_month, end_month+1):
+            # Create a string for the date.
+            date_str = get_date_str(year, month)
+
+            # Formulate the URL.
+            url = nyiso_url(data_type=data_type, day_ahead=day_ahead,
+                            zonal=zonal, date_str=date_str)
+
+            jobs.append((data_dir, url, date_str))
+
+    return jobs
+
+
+def fetch(session, limiter, data_dir, url, date_str, entry, keep_zip=False,
+          **kwargs):
+    """Download and extract a single archive, if it has changed.
+
+    :param session: requests Session to use for the request.
+    :param limiter: HostLimiter instance.
+    :param data_dir: String. Directory for this dataset.
+    :param url: String. URL of the archive.
+    :param date_str: String. Represents date like YYYYMMDD.
+    :param entry: Manifest entry for this URL, or None to force the
+        download.
+    :param keep_zip: Boolean. True to save the archive rather than
+        extract it.
+    :param kwargs: Passed on to download.
+
+    :returns: Tuple (status, entry). status is one of 'new', 'updated',
+        or 'unchanged'. entry is the new manifest entry.
+    """
+    # Only trust the validators if the data is actually on disk.
+    if entry is not None and not month_exists(data_dir, date_str,
+                                              keep_zip=keep_zip):
+        entry = None
+
+    r = download(session=session, url=url, limiter=limiter,
+                 headers=conditional_headers(entry), **kwargs)
+
+    # The server told us nothing changed.
+    if r.status_code == 304:
+        return 'unchanged', entry
+
+    content = r.content
+    count_read(nbytes=len(content), files=url)
+    new_entry = {'date_str': date_str,
+                 'size': len(content),
+                 'sha256': hashlib.sha256(content).hexdigest(),
+                 'etag': r.headers.get('ETag'),
+                 'last_modified': r.headers.get('Last-Modified')}
+
+    # Some servers don't do validators. If the content is the same,
+    # there's no need to extract again.
+    if entry is not None and entry['sha256'] == new_entry['sha256']:
+        return 'unchanged', new_entry
+
+    if keep_zip:
+        save_archive(content=content, data_dir=data_dir, date_str=date_str)
+    else:
+        extract(content=content, data_dir=data_dir, date_str=date_str)
+
+    return ('new' if entry is None else 'updated'), new_entry
+
+
+def timed(func, *args, **kwargs):
+    """Call func, returning (result, seconds taken)."""
+    t0 = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - t0
+
+
+def download_jobs(jobs, max_workers=MAX_WORKERS, max_per_host=MAX_PER_HOST,
+                  max_retries=MAX_RETRIES, backoff=BACKOFF, timeout=TIMEOUT,
+                  force=False, keep_zip=KEEP_ZIP):
+    """Download and extract a list of jobs using a pool of threads.
+
+    Only archives which are new or have changed since the last run (per
+    each data directory's manifest) are downloaded and extracted.
+
+    :param jobs: List of (data_dir, url, date_str) tuples, e.g. from
+        get_jobs. Jobs from different datasets may be mixed.
+    :param max_workers: Integer. Number of worker threads.
+    :param max_per_host: Integer. Max concurrent requests per host.
+    :param max_retries: Integer. Number of retries for each URL.
+    :param backoff: Float. Base number of seconds to wait between tries.
+    :param timeout: Float. Seconds to wait for the server.
+    :param force: Boolean. If True, ignore the manifests and download
+        everything.
+    :param keep_zip: Boolean. True to keep the monthly archives rather
+        than extracting them.
+
+    :returns: Dictionary keyed by status ('new', 'updated', 'unchanged')
+        with lists of (data_dir, date_str) tuples.
+    """
+    # Create directories and read manifests up front so the workers
+    # don't race. Manifests are only touched by this thread.
+    manifests = {}
+    for data_dir in set(j[0] for j in jobs):
+        os.makedirs(data_dir, exist_ok=True)
+        manifests[data_dir] = {} if force else read_manifest(data_dir)
+
+    session = get_session(pool_size=max_workers)
+    limiter = HostLimiter(max_per_host=max_per_host)
+
+    failed = []
+    results = {'new': [], 'updated': [], 'unchanged': []}
+    with step('download') as s, \
+            ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = {pool.submit(timed, fetch, session, limiter, data_dir, url,
+                               date_str, manifests[data_dir].get(url),
+                               keep_zip=keep_zip, max_retries=max_retries,
+                               backoff=backoff, timeout=timeout):
+                   (data_dir, url, date_str)
+                   for data_dir, url, date_str in jobs}
+
+        for n, future in enumerate(as_completed(futures), start=1):
+            data_dir, url, date_str = futures[future]
+            progress = '{}/{}'.format(n, len(jobs))
+            try:
+                (status, entry), seconds = future.result()
+            except FETCH_ERRORS as e:
+                # Carry on with the other files, and report this one at
+                # the end.
+                failed.append(url)
+                record('fetch', progress=progress, data_dir=data_dir,
+                       date_str=date_str, status='failed', error=str(e))
+                continue
+
+            results[status].append((data_dir, date_str))
+            record('fetch', progress=progress, data_dir=data_dir,
+                   date_str=date_str, status=status,
+                   seconds=round(seconds, 3))
+
+            # Record progress as we go, so an interrupted run doesn't
+            # have to start over.
+            if status != 'unchanged' \
+                    or manifests[data_dir].get(url) != entry:
+                manifests[data_dir][url] = entry
+                write_manifest(data_dir, manifests[data_dir])
+
+        s.note(jobs=len(jobs), failed=len(failed),
+               **{k: len(v) for k, v in results.items()})
+
+    session.close()
+
+    if failed:
+        raise UserWarning('Failed to download {} of {} files: {}'
+                          .format(len(failed), len(jobs), failed))
+
+    return results
+
+
+def get_data(data_dir, data_type, day_ahead, zonal, start_year=2016,
+             end_year=2018, start_month=1, end_month=12,
+             max_workers=MAX_WORKERS, force=False, keep_zip=KEEP_ZIP):
     """Helper function for downloading NYISO data.
 
     It's worth reading the "notes" section of the docstring for the
@@ -112,73 +558,47 @@ def get_data(data_dir, data_type, day_ahead, zonal, start_year=2016,
     :param end_year: Integer. Ending year to pull data.
     :param start_month: Integer. Starting month to pull data.
     :param end_month: Integer. Ending month to pull data.
-    """
-    # Create directory for NYISO LMP data
-    try:
-        os.mkdir(data_dir)
-    except OSError:
-        # If the directory already exists, don't complain.
-        pass
+    :param max_workers: Integer. Number of concurrent downloads.
+    :param force: Boolean. If True, re-download months even if the
+        manifest says they haven't changed.
+    :param keep_zip: Boolean. True to keep the monthly archives rather
+        than extracting them.
 
-    # NYISO stores data in monthly archives. Loop.
-    for year in range(start_year, end_year+1):
-        # Loop over months.
-        for month in range(start_month, end_month+1):
-            # Create a string for the date.
-            date_str = get_date_str(year, month)
-            print('Downloading data for {}...'.format(date_str), end='',
-                  flush=True)
-
-            # Formulate the URL.
-            url = nyiso_url(data_type=data_type, day_ahead=day_ahead,
-                            zonal=zonal, date_str=date_str)
+    :returns: See download_jobs.
+    """
+    jobs = get_jobs(data_dir=data_dir, data_type=data_type,
+                    day_ahead=day_ahead, zonal=zonal, start_year=start_year,
+                    end_year=end_year, start_month=start_month,
+                    end_month=end_month)
 
-            # Download the data.
-            r = requests.get(url)
+    return download_jobs(jobs, max_workers=max_workers, force=force,
+                         keep_zip=keep_zip)
 
-            if not r.ok:
-                raise UserWarning('Failed to download for {}'.format(date_str))
 
-            # Get data into ZIP archive.
-            z = ZipFile(BytesIO(r.content))
+def all_datasets():
+    """The datasets main downloads."""
+    return DATASETS + (GEN_DATASETS if GET_GEN else [])
 
-            # Create directory for this archive.
-            this_dir = os.path.join(data_dir, date_str)
-            try:
-                os.mkdir(this_dir)
-            except OSError:
-                # Don't complain if the directory already exists.
-                pass
 
-            # Extract data to directory.
-            z.extractall(path=this_dir)
+@stage('get_nyiso_data')
+def main():
+    """Download all the datasets in DATASETS (and GEN_DATASETS, if
+    GET_GEN is set).
+    """
+    # Rather than running the datasets back to back, throw every
+    # (dataset, month) pair into one pool.
+    all_jobs = []
+    for d_dir, d_type, d_ahead, d_zonal in all_datasets():
+        all_jobs.extend(get_jobs(data_dir=d_dir, data_type=d_type,
+                                 day_ahead=d_ahead, zonal=d_zonal,
+                                 start_year=START_YEAR, end_year=END_YEAR,
+                                 start_month=START_MONTH,
+                                 end_month=END_MONTH))
 
-            # Print a dot for each file we've downloaded.
-            print('done.', flush=True)
-            pass
+    res = download_jobs(all_jobs)
+    print('{} new, {} updated, {} unchanged.'.format(
+        len(res['new']), len(res['updated']), len(res['unchanged'])))
 
 
 if __name__ == '__main__':
-    # Download all the zonal data.
-    print('Downloading day ahead zonal LMP data.')
-    get_data(data_dir=LMP_DAY_AHEAD_ZONAL, data_type='lmp',
-             day_ahead=True, zonal=True, start_year=START_YEAR,
-             end_year=END_YEAR, start_month=START_MONTH, end_month=END_MONTH)
-    print('*' * 80)
-
-    print('Downloading realtime zonal LMP data.')
-    get_data(data_dir=LMP_REALTIME_ZONAL, data_type='lmp',
-             day_ahead=False, zonal=True, start_year=START_YEAR,
-             end_year=END_YEAR, start_month=START_MONTH, end_month=END_MONTH)
-    print('*' * 80)
-
-    print('Downloading forecast load data.')
-    get_data(data_dir=LOAD_FORECAST, data_type='load',
-             day_ahead=True, zonal=True, start_year=START_YEAR,
-             end_year=END_YEAR, start_month=START_MONTH, end_month=END_MONTH)
-    print('*' * 80)
-
-    print('Downloading realtime load data.')
-    get_data(data_dir=LOAD_REALTIME, data_type='load',
-             day_ahead=False, zonal=True, start_year=START_YEAR,
-             end_year=END_YEAR, start_month=START_MONTH, end_month=END_MONTH)
+    main()
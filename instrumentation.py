@@ -0,0 +1,325 @@
+"""Module for recording what each pipeline stage spends its time on.
+
+Work is wrapped in named steps:
+
+    with stage('combine_lmp_realtime'):
+        with step('read'):
+            df = read_dataset(LMP_REALTIME_ZONAL)
+        with step('localize'):
+            df = localize_times(df)
+
+For each step we record the wall and CPU time (including any worker
+processes which finished during the step), the peak resident memory,
+and the rows, bytes and files read and written. The I/O counts are
+reported by the functions which do the reading and writing (see
+count_read and count_written), so they end up on whichever step is
+running when they're called. Steps can be nested; a step's peak memory
+and I/O include those of the steps inside it.
+
+Every finished step is appended as a line of JSON to LOG_FILE (or the
+file named by the PIPELINE_LOG environment variable). All the steps of
+one run, including those in child processes, share a run id. summarize
+boils a run down to where the time went:
+
+    python instrumentation.py [log file] [run id or 'all']
+
+Steps should only be started from the main thread, but count_read,
+count_written, and record may be called from any thread.
+"""
+# Third-party:
+import pandas as pd
+
+# Built-in:
+import json
+import os
+import resource
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+# Where steps are logged, unless the PIPELINE_LOG environment variable
+# says otherwise.
+LOG_FILE = 'pipeline_log.jsonl'
+
+# Print a line as each step finishes, for steps nested no deeper than
+# ECHO_DEPTH (0 for stages only).
+ECHO = True
+ECHO_DEPTH = 1
+
+# Number of file paths to keep for each step (the count is always
+# kept).
+MAX_PATHS = 10
+
+# Shared by every process in a run (child processes inherit it).
+RUN_ID_VAR = 'PIPELINE_RUN_ID'
+if RUN_ID_VAR not in os.environ:
+    os.environ[RUN_ID_VAR] = '{}-{}'.format(
+        time.strftime('%Y%m%dT%H%M%S'), os.getpid())
+
+# Steps currently running, outermost first, and the current stage.
+# Steps outside any stage are put under the script's name.
+_stack = []
+_stage = [os.path.splitext(os.path.basename(sys.argv[0] or 'python'))[0]]
+_lock = threading.Lock()
+
+
+def log_file():
+    return os.environ.get('PIPELINE_LOG', LOG_FILE)
+
+
+def peak_rss_mb():
+    """Peak resident memory of this process, in MB, since the last
+    reset_peak_rss (or since it started, if that isn't supported).
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes.
+    return rss / 1024 / (1024 if sys.platform == 'darwin' else 1)
+
+
+def reset_peak_rss():
+    """Reset the peak resident memory counter (Linux only)."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def cpu_seconds():
+    """CPU time of this process and any children which have exited."""
+    t = os.times()
+    return t.user + t.system + t.children_user + t.children_system
+
+
+def path_size(path):
+    """Size in bytes of a file, or of everything in a directory."""
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(d, f))
+                   for d, _, files in os.walk(path) for f in files)
+    return os.path.getsize(path)
+
+
+class Step:
+    """Measurements for one running step. See step."""
+
+    def __init__(self, name, stage, depth):
+        self.name = name
+        self.stage = stage
+        self.depth = depth
+        self.peak_rss_mb = 0.0
+        self.counts = {'rows_read': 0, 'bytes_read': 0, 'files_read': 0,
+                       'rows_written': 0, 'bytes_written': 0,
+                       'files_written': 0}
+        self.paths = []
+        self.fields = {}
+
+    def add(self, kind, rows=0, nbytes=0, files=()):
+        if isinstance(files, str):
+            files = [files]
+        with _lock:
+            self.counts['rows_' + kind] += int(rows)
+            self.counts['bytes_' + kind] += int(nbytes)
+            self.counts['files_' + kind] += len(files)
+            room = MAX_PATHS - len(self.paths)
+            if room > 0:
+                self.paths.extend(str(f) for f in files[:room])
+
+    def note(self, **fields):
+        """Attach extra fields to this step's record."""
+        self.fields.update(fields)
+
+
+def write_record(rec):
+    """Append one record to the log."""
+    line = json.dumps(rec) + '\n'
+    with _lock:
+        with open(log_file(), 'a') as f:
+            f.write(line)
+
+
+def base_record(name, stage):
+    return {'run': os.environ[RUN_ID_VAR], 'pid': os.getpid(),
+            'stage': stage, 'step': name,
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S')}
+
+
+def echo(rec):
+    parts = ['{:.2f} s ({:.2f} s CPU)'.format(rec['wall_s'], rec['cpu_s'])]
+    for kind in ('read', 'written'):
+        if rec['rows_' + kind] or rec['bytes_' + kind]:
+            parts.append('{:,} rows / {:.1f} MB {}'.format(
+                rec['rows_' + kind], rec['bytes_' + kind] / 2**20, kind))
+    parts.append('peak {:.0f} MB'.format(rec['peak_rss_mb']))
+    print('{}{}/{}: {}'.format('  ' * rec['depth'], rec['stage'],
+                               rec['step'], ', '.join(parts)), flush=True)
+
+
+@contextmanager
+def step(name, stage=None):
+    """Time a named step (see module docstring).
+
+    :param name: String. Step name, e.g. 'read', 'localize', 'write'.
+    :param stage: String. Stage the step belongs to. Defaults to the
+        current stage (see stage).
+
+    Yields the Step, whose note method can attach extra fields.
+    """
+    s = Step(name, stage or _stage[0], len(_stack))
+
+    # The peak counter is about to be reset, so give the enclosing
+    # step the peak so far.
+    if _stack:
+        _stack[-1].peak_rss_mb = max(_stack[-1].peak_rss_mb, peak_rss_mb())
+    reset_peak_rss()
+
+    _stack.append(s)
+    cpu = cpu_seconds()
+    t0 = time.perf_counter()
+    error = None
+    try:
+        yield s
+    except BaseException as e:
+        error = repr(e)
+        raise
+    finally:
+        wall = time.perf_counter() - t0
+        cpu = cpu_seconds() - cpu
+        _stack.pop()
+
+        # Roll the peak and I/O up into the enclosing step.
+        s.peak_rss_mb = max(s.peak_rss_mb, peak_rss_mb())
+        if _stack:
+            parent = _stack[-1]
+            parent.peak_rss_mb = max(parent.peak_rss_mb, s.peak_rss_mb)
+            with _lock:
+                for k, v in s.counts.items():
+                    parent.counts[k] += v
+
+        rec = base_record(name, s.stage)
+        rec.update({'event': False, 'depth': s.depth, 'wall_s': wall,
+                    'cpu_s': cpu, 'peak_rss_mb': s.peak_rss_mb,
+                    'paths': s.paths, 'error': error})
+        rec.update(s.counts)
+        rec.update(s.fields)
+        write_record(rec)
+        if ECHO and s.depth <= ECHO_DEPTH:
+            echo(rec)
+
+
+@contextmanager
+def stage(name):
+    """Time a whole stage. Steps started inside belong to it, and the
+    stage itself is recorded as a step named 'total'.
+    """
+    outer = _stage[0]
+    _stage[0] = name
+    try:
+        with step('total', stage=name) as s:
+            yield s
+    finally:
+        _stage[0] = outer
+
+
+def current():
+    """The innermost running step, or None."""
+    return _stack[-1] if _stack else None
+
+
+def count_read(rows=0, nbytes=0, files=()):
+    """Add to the rows/bytes/files read by the current step (if any)."""
+    s = current()
+    if s is not None:
+        s.add('read', rows=rows, nbytes=nbytes, files=files)
+
+
+def count_written(rows=0, nbytes=0, files=()):
+    """Add to the rows/bytes/files written by the current step (if
+    any).
+    """
+    s = current()
+    if s is not None:
+        s.add('written', rows=rows, nbytes=nbytes, files=files)
+
+
+def record(name, stage=None, **fields):
+    """Log a one-off event, e.g. the outcome of a single download in a
+    worker thread. Unlike step, nothing is measured.
+    """
+    rec = base_record(name, stage or _stage[0])
+    rec['event'] = True
+    rec.update(fields)
+    write_record(rec)
+    if ECHO:
+        print('{}/{}: {}'.format(rec['stage'], name, ', '.join(
+            '{}={}'.format(k, v) for k, v in fields.items())), flush=True)
+
+
+def read_log(path=None):
+    """Read a log into a DataFrame with one row per record."""
+    with open(path or log_file()) as f:
+        return pd.DataFrame([json.loads(line) for line in f if line.strip()])
+
+
+def summarize(path=None, run=None):
+    """Summarize where a run's time went.
+
+    :param path: Log file. Defaults to the current log file.
+    :param run: Run id, or 'all' for every run in the log. Defaults to
+        the most recent run.
+
+    :returns: DataFrame indexed by (stage, step), sorted by stage and
+        then wall time, with the number of times the step ran, total
+        wall and CPU time, the share of the run's wall time, peak
+        memory, and I/O totals.
+    """
+    log = read_log(path)
+    log = log[~log['event'].astype(bool)]
+    if run is None:
+        run = log['run'].iloc[-1]
+    if run != 'all':
+        log = log[log['run'] == run]
+
+    total = log.loc[log['depth'] == 0, 'wall_s'].sum()
+    g = log.groupby(['stage', 'step'], sort=False)
+    out = pd.DataFrame({
+        'count': g.size(),
+        'wall_s': g['wall_s'].sum(),
+        'cpu_s': g['cpu_s'].sum(),
+        'peak_rss_mb': g['peak_rss_mb'].max(),
+        'rows_read': g['rows_read'].sum(),
+        'mb_read': g['bytes_read'].sum() / 2**20,
+        'files_read': g['files_read'].sum(),
+        'rows_written': g['rows_written'].sum(),
+        'mb_written': g['bytes_written'].sum() / 2**20,
+        'files_written': g['files_written'].sum()})
+    out.insert(3, 'pct_wall', 100 * out['wall_s'] / total if total else 0.0)
+
+    # Keep stages in the order they ran, slowest steps first.
+    order = {s: i for i, s in enumerate(log['stage'].unique())}
+    out['_order'] = [order[s] for s in out.index.get_level_values(0)]
+    out = out.sort_values(['_order', 'wall_s'], ascending=[True, False])
+    return out.drop(columns='_order')
+
+
+def print_summary(path=None, run=None):
+    """Print summarize's table."""
+    summary = summarize(path, run)
+    with pd.option_context('display.max_rows', None,
+                           'display.max_columns', None,
+                           'display.width', 250,
+                           'display.float_format', '{:.2f}'.format):
+        print(summary)
+
+
+if __name__ == '__main__':
+    # Usage: python instrumentation.py [log file] [run id or 'all']
+    print_summary(*sys.argv[1:3])
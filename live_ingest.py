@@ -0,0 +1,334 @@
+"""Module to ingest the current day's NYISO data as it's published.
+
+get_nyiso_data.py downloads monthly archives, which are only complete
+(and only worth re-downloading) once a month. NYISO also publishes each
+day's CSV file on its own, and updates it through the day: every few
+minutes for the real-time data, once a day for the day-ahead data. This
+module polls those daily files and merges new intervals into the
+combined stores (see combine_nyiso_data.py) as they arrive:
+
+    - Each feed (see FEEDS) is polled on its own interval by an asyncio
+        task. Downloads run in threads, sharing one requests Session,
+        with get_nyiso_data's retries and per-host limit.
+    - Requests are conditional (ETag/Last-Modified, recorded in each
+        data directory's manifest), so polling an unchanged file costs
+        a 304 and nothing else.
+    - A changed file is saved where the monthly archive would have
+        extracted it (<root>/<data_dir>/<YYYYMM01>/<file>), so the
+        regular and incremental combines pick it up too. It's then
+        parsed and merged into the store (<root>/<store>), replacing the
+        month partition it falls in (see columnar_store.merge_partitioned).
+    - A daily file is only ever overwritten by this module if this
+        module wrote it (see fetch_day). A file which was already there,
+        e.g. extracted from a complete monthly archive, is kept and not
+        polled.
+
+The load forecast vintages store isn't updated live; the next combine
+adds the new files to it.
+
+To test without NYISO, serve recorded files with replay_server.py and
+point base_url at it:
+
+    python replay_server.py 2018-11-05T06:00 60
+    python live_ingest.py http://127.0.0.1:8000 [root]
+
+Polling a replay server, the files and stores go under REPLAY_ROOT
+rather than the working directory, which is where replay_server reads
+its recording from by default. The replayed files are partial, and
+saving them over the recording would cut it short. Pass root to put
+them elsewhere.
+"""
+# Third-party:
+import pandas as pd
+
+# Standard library:
+import asyncio
+import hashlib
+import os
+import sys
+from io import BytesIO
+
+# Imports from get_nyiso_data.py
+from get_nyiso_data import LMP_DAY_AHEAD_ZONAL, LMP_REALTIME_ZONAL, \
+    LOAD_FORECAST, LOAD_REALTIME, MAX_PER_HOST, get_date_str, get_day_str, \
+    nyiso_url, get_session, HostLimiter, download, conditional_headers, \
+    read_manifest, write_manifest, timed, FETCH_ERRORS
+
+# Imports from combine_nyiso_data.py
+from combine_nyiso_data import LMP_DAY_AHEAD_STORE, LMP_REALTIME_STORE, \
+    LOAD_FORECAST_STORE, LOAD_REALTIME_STORE, TIMEZONE, read_csv, \
+    process_lmp_day_ahead, process_lmp_realtime, process_load_forecast, \
+    process_load_realtime
+from columnar_store import merge_partitioned
+from instrumentation import stage, step, record, count_read, count_written
+
+# Feeds to poll. Each entry is (data_dir, store, data_type, day_ahead,
+# process, days, seconds): the dataset (see get_nyiso_data.DATASETS),
+# the store it's combined into and how (see combine_nyiso_data), which
+# days' files to poll relative to today, and seconds between polls.
+# Real-time feeds poll yesterday too, to catch the last intervals of the
+# day, which land after midnight.
+FEEDS = [(LMP_REALTIME_ZONAL, LMP_REALTIME_STORE, 'lmp', False,
+          process_lmp_realtime, (-1, 0), 60),
+         (LOAD_REALTIME, LOAD_REALTIME_STORE, 'load', False,
+          process_load_realtime, (-1, 0), 60),
+         (LMP_DAY_AHEAD_ZONAL, LMP_DAY_AHEAD_STORE, 'lmp', True,
+          process_lmp_day_ahead, (0, 1), 600),
+         (LOAD_FORECAST, LOAD_FORECAST_STORE, 'load', True,
+          process_load_forecast, (0,), 600)]
+
+# Retry settings for polls. Lower than get_nyiso_data's, as the next
+# poll is never far off.
+MAX_RETRIES = 2
+BACKOFF = 0.5
+TIMEOUT = 30
+
+# Directory the data directories and stores are in (see module
+# docstring): ROOT when polling NYISO, REPLAY_ROOT when polling a replay
+# server.
+ROOT = '.'
+REPLAY_ROOT = 'replay_live'
+
+
+def local_now():
+    """The current time where NYISO is."""
+    return pd.Timestamp.now(tz=TIMEZONE)
+
+
+def replay_clock(base_url, session):
+    """Clock of a replay server (see replay_server.py), for polling it
+    as if it were now then.
+    """
+    url = base_url.rstrip('/') + '/clock'
+
+    def now():
+        r = session.get(url, timeout=TIMEOUT)
+        r.raise_for_status()
+        return pd.Timestamp(r.text.strip()).tz_convert(TIMEZONE)
+
+    return now
+
+
+def day_jobs(feed, now, base_url=None):
+    """Daily files to poll for a feed.
+
+    :param feed: Entry of FEEDS.
+    :param now: Timestamp. Current (local) time.
+    :param base_url: String. Defaults to NYISO's.
+
+    :returns: List of (url, day_str) tuples.
+    """
+    _, _, data_type, day_ahead, _, days, _ = feed
+    today = now.tz_localize(None).normalize()
+    out = []
+    for d in days:
+        day_str = get_day_str(today + pd.Timedelta(days=d))
+        out.append((nyiso_url(data_type=data_type, day_ahead=day_ahead,
+                              date_str=day_str, daily=True,
+                              base_url=base_url), day_str))
+
+    return out
+
+
+def day_path(data_dir, url, day_str):
+    """Where a daily file is kept: in its month's directory, under the
+    name it has in the monthly archive.
+    """
+    month = get_date_str(year=int(day_str[:4]), month=int(day_str[4:6]))
+    return os.path.join(data_dir, month, url.rsplit('/', 1)[-1])
+
+
+def fetch_day(session, limiter, data_dir, url, day_str, entry, **kwargs):
+    """Download a daily file, if it has changed, and save it.
+
+    A file on disk which doesn't match entry (one this module didn't
+    write, e.g. extracted from a monthly archive) is taken to be
+    complete. It's kept, and nothing is downloaded.
+
+    :param session: requests Session to use for the request.
+    :param limiter: HostLimiter instance.
+    :param data_dir: String. Directory for this dataset.
+    :param url: String. URL of the file.
+    :param day_str: String. Represents date like YYYYMMDD.
+    :param entry: Manifest entry for this URL, or None.
+    :param kwargs: Passed on to get_nyiso_data.download.
+
+    :returns: Tuple (status, entry, content). status is one of 'new',
+        'updated', 'unchanged', or 'kept'; entry is the new manifest
+        entry; and content is the file's bytes, or None if it's
+        unchanged or kept.
+    """
+    path = day_path(data_dir, url, day_str)
+
+    if os.path.isfile(path):
+        if entry is None or entry['size'] != os.path.getsize(path):
+            return 'kept', entry, None
+    else:
+        # Only trust the validators if the file is actually on disk.
+        entry = None
+
+    r = download(session=session, url=url, limiter=limiter,
+                 headers=conditional_headers(entry), **kwargs)
+    if r.status_code == 304:
+        return 'unchanged', entry, None
+
+    content = r.content
+    count_read(nbytes=len(content), files=url)
+    new_entry = {'date_str': day_str,
+                 'size': len(content),
+                 'sha256': hashlib.sha256(content).hexdigest(),
+                 'etag': r.headers.get('ETag'),
+                 'last_modified': r.headers.get('Last-Modified')}
+    if entry is not None and entry['sha256'] == new_entry['sha256']:
+        return 'unchanged', new_entry, None
+
+    # Write to a temporary file and move into place so the combine
+    # never sees a partial file.
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(content)
+    os.replace(tmp, path)
+    count_written(nbytes=len(content), files=path)
+
+    return ('new' if entry is None else 'updated'), new_entry, content
+
+
+def ingest(content, store, process):
+    """Parse a daily file and merge it into its store.
+
+    :param content: Bytes. The CSV file.
+    :param store: String. Store to merge into.
+    :param process: Function to turn the parsed file into rows of the
+        store (see combine_nyiso_data).
+
+    :returns: Integer. Number of new rows (times which weren't in the
+        store).
+    """
+    with step('ingest') as s:
+        df = process(read_csv(BytesIO(content)))
+        rows = merge_partitioned(df, store)
+        s.note(store=store, rows=len(df), new_rows=rows)
+    return rows
+
+
+async def poll_feed(feed, session, limiter, clock, stop, base_url=None,
+                    once=False, root=ROOT):
+    """Poll one feed until stop is set.
+
+    Downloads run in a thread, so the feeds poll concurrently. Parsing
+    and merging run on the event loop (they're quick, and the stores
+    aren't shared between feeds).
+
+    :param feed: Entry of FEEDS.
+    :param session: requests Session.
+    :param limiter: HostLimiter instance.
+    :param clock: Function returning the current local time.
+    :param stop: asyncio.Event. Set to stop polling.
+    :param base_url: String. Defaults to NYISO's.
+    :param once: Boolean. Poll once and return.
+    :param root: String. Directory the data directories and stores are
+        in.
+    """
+    data_dir, store, _, _, process, _, seconds = feed
+    data_dir = os.path.join(root, data_dir)
+    store = os.path.join(root, store)
+    manifest = read_manifest(data_dir)
+
+    while not stop.is_set():
+        now = await asyncio.to_thread(clock)
+        for url, day_str in day_jobs(feed, now, base_url=base_url):
+            try:
+                (status, entry, content), secs = await asyncio.to_thread(
+                    timed, fetch_day, session, limiter, data_dir, url,
+                    day_str, manifest.get(url), max_retries=MAX_RETRIES,
+                    backoff=BACKOFF, timeout=TIMEOUT)
+            except FETCH_ERRORS as e:
+                # E.g. tomorrow's day-ahead file isn't out yet.
+                record('poll', data_dir=data_dir, date_str=day_str,
+                       status='failed', error=str(e))
+                continue
+
+            try:
+                rows = 0 if content is None else ingest(content, store,
+                                                        process)
+            except ValueError as e:
+                # E.g. schema drift. The manifest isn't updated, so the
+                # file is tried again on the next poll.
+                record('poll', data_dir=data_dir, date_str=day_str,
+                       status='failed', error=str(e))
+                continue
+
+            if manifest.get(url) != entry:
+                manifest[url] = entry
+                os.makedirs(data_dir, exist_ok=True)
+                write_manifest(data_dir, manifest)
+            if status not in ('unchanged', 'kept'):
+                record('poll', data_dir=data_dir, date_str=day_str,
+                       status=status, new_rows=rows, seconds=round(secs, 3))
+
+        if once:
+            return
+        try:
+            await asyncio.wait_for(stop.wait(), timeout=seconds)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def run(feeds=None, base_url=None, clock=None, duration=None,
+              once=False, session=None, root=None):
+    """Poll feeds concurrently.
+
+    :param feeds: List of entries of FEEDS. Defaults to FEEDS.
+    :param base_url: String. Defaults to NYISO's.
+    :param clock: Function returning the current local time. Defaults to
+        local_now, or the replay server's clock if base_url is given.
+    :param duration: Float. Seconds to poll for. None polls until
+        interrupted.
+    :param once: Boolean. Poll each feed once and return.
+    :param session: requests Session. One is made if not given.
+    :param root: String. Directory the data directories and stores are
+        in. Defaults to ROOT, or REPLAY_ROOT if base_url is given.
+    """
+    if feeds is None:
+        feeds = FEEDS
+    if root is None:
+        root = ROOT if base_url is None else REPLAY_ROOT
+    own_session = session is None
+    if own_session:
+        session = get_session(pool_size=len(feeds))
+    if clock is None:
+        clock = local_now if base_url is None \
+            else replay_clock(base_url, session)
+
+    limiter = HostLimiter(max_per_host=MAX_PER_HOST)
+    stop = asyncio.Event()
+    tasks = [asyncio.create_task(poll_feed(f, session, limiter, clock, stop,
+                                           base_url=base_url, once=once,
+                                           root=root))
+             for f in feeds]
+    try:
+        if duration is None:
+            await asyncio.gather(*tasks)
+        else:
+            await asyncio.wait(tasks, timeout=duration)
+            stop.set()
+            await asyncio.gather(*tasks)
+    finally:
+        stop.set()
+        if own_session:
+            session.close()
+
+
+@stage('live_ingest')
+def main(base_url=None, duration=None, once=False, root=None):
+    """Poll FEEDS, from NYISO or a replay server (see replay_server.py)
+    at base_url, into root (see run).
+    """
+    asyncio.run(run(base_url=base_url, duration=duration, once=once,
+                    root=root))
+
+
+if __name__ == '__main__':
+    main(base_url=sys.argv[1] if len(sys.argv) > 1 else None,
+         root=sys.argv[2] if len(sys.argv) > 2 else None)
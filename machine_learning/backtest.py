@@ -0,0 +1,288 @@
+"""Module for walk-forward backtesting of models on a dataset.
+
+The notebooks score a model once, on the whole test year. A single
+number hides when a model is good or bad (e.g. fine overnight and poor
+in the afternoon peak, or fine until the summer), so instead:
+
+    - Forecasts are made from rolling origins, e.g. each midnight of the
+        test data, for each horizon (rows after the origin) up to a day
+        ahead. Models can be refit as the origin moves (e.g. monthly, on
+        the data before it), or fit once and only re-predict.
+    - Predictions are scaled back to the original units with the
+        dataset's affine scalers, where the chained ('_both') variant is
+        already composed into one transform (see dataset.compose).
+    - Errors are reduced, in one vectorized pass, to sums (count, error,
+        absolute error, squared error, target, squared target) for every
+        (zone, horizon, hour of day, month) cell. Metrics for any
+        grouping of those are computed from the sums (see summarize).
+
+Predictions have shape (origins, horizons, targets): element [i, h, z]
+predicts target z at row origins[i] + horizons[h], as with the windows
+from windows.make_windows.
+
+Usage:
+    pred, sums = backtest(lambda: Ridge(alpha=1.0), suffix='_both',
+                          refit=4 * FIVE_MIN_PER_WEEK)
+    summarize(sums, by=['horizon'])
+    summarize(sums, by=['zone', 'hour'])
+"""
+# Third-party:
+import numpy as np
+import pandas as pd
+
+# Imports from dataset.py
+from dataset import DATASET_DIR, read_meta, read_index, open_arrays, \
+    read_scaler, transform
+
+# Rows between origins (a day of five minute intervals).
+STEP = 12 * 24
+
+# Rows ahead to forecast from each origin. Defaults to a day.
+HORIZON = 12 * 24
+
+# Origins reduced to metric sums at a time, to bound memory.
+CHUNK = 256
+
+# Sums kept per cell (see metric_sums).
+STATS = ('n', 'err', 'abs_err', 'sq_err', 'y', 'sq_y')
+
+
+def make_origins(n_rows, start, step=STEP, horizons=None, end=None):
+    """Rows to forecast from, every step rows from start, while every
+    horizon stays before end.
+
+    :param n_rows: Integer. Rows in the dataset.
+    :param start: Integer. First origin.
+    :param step: Integer. Rows between origins.
+    :param horizons: Array of rows ahead. Defaults to range(HORIZON).
+    :param end: Integer. Rows at or after end aren't forecast. Defaults
+        to n_rows.
+    """
+    if horizons is None:
+        horizons = np.arange(HORIZON)
+    if end is None:
+        end = n_rows
+    return np.arange(start, end - np.max(horizons), step)
+
+
+def refit_blocks(origins, refit=None):
+    """Split origins into blocks which share a fitted model.
+
+    :param origins: Sorted array of origins.
+    :param refit: Integer. Rows between refits, or None to fit once.
+
+    :returns: Array of block boundaries (positions in origins), starting
+        with 0 and ending with len(origins).
+    """
+    if refit is None or len(origins) == 0:
+        return np.array([0, len(origins)])
+    block = (origins - origins[0]) // refit
+    return np.concatenate(([0], np.flatnonzero(np.diff(block)) + 1,
+                           [len(origins)]))
+
+
+def forecast(model, x, origins, horizons, n_targets):
+    """Forecast each horizon from each origin with a fitted model.
+
+    If the model has a forecast(x, origins, horizons) method it's used,
+    and must return an array of shape (origins, horizons, targets).
+    Otherwise the model predicts one row of targets from one row of
+    features (like the ANN) with predict(x), which is called once, on
+    every row any origin needs.
+    """
+    if hasattr(model, 'forecast'):
+        return np.asarray(model.forecast(x, origins, horizons),
+                          dtype=np.float32)
+
+    rows = origins[:, np.newaxis] + horizons
+    unique, inverse = np.unique(rows, return_inverse=True)
+    pred = np.asarray(model.predict(x[unique]), dtype=np.float32)
+    pred = pred.reshape(len(unique), n_targets)
+    return pred[inverse.ravel()].reshape(rows.shape + (n_targets,))
+
+
+def walk_forward(make_model, x, y, origins, horizons, refit=None,
+                 train_rows=None):
+    """Fit and forecast over rolling origins.
+
+    :param make_model: Callable returning a new model with fit(x, y)
+        and predict(x) (e.g. a scikit-learn estimator) or forecast (see
+        forecast) methods.
+    :param x: Array of scaled features, shape (time, features).
+    :param y: Array of scaled targets, shape (time, targets).
+    :param origins: Sorted array of origins (see make_origins).
+    :param horizons: Array of rows ahead.
+    :param refit: Integer. Rows between refits. Each model is fit on the
+        rows before the first origin it forecasts from. None fits once,
+        on the rows before the first origin.
+    :param train_rows: Integer. Fit on at most this many rows before the
+        origin (a rolling window). None uses all of them (expanding).
+
+    :returns: Array of scaled predictions, shape (origins, horizons,
+        targets).
+    """
+    origins = np.asarray(origins)
+    horizons = np.asarray(horizons)
+    out = np.empty((len(origins), len(horizons), y.shape[1]),
+                   dtype=np.float32)
+
+    bounds = refit_blocks(origins, refit)
+    for b0, b1 in zip(bounds[:-1], bounds[1:]):
+        cut = origins[b0]
+        first = 0 if train_rows is None else max(0, cut - train_rows)
+        model = make_model()
+        model.fit(x[first:cut], y[first:cut])
+        out[b0:b1] = forecast(model, x, origins[b0:b1], horizons,
+                              y.shape[1])
+        print('Forecast from {} of {} origins.'.format(b1, len(origins)),
+              flush=True)
+
+    return out
+
+
+def metric_sums(pred, y, origins, horizons, hour, month, zones=None,
+                chunk=CHUNK):
+    """Reduce forecast errors to sums per (zone, horizon, hour, month).
+
+    Each chunk of origins is reduced with one np.bincount per sum, so
+    there are no Python loops over cells.
+
+    :param pred: Array of predictions in the original units, shape
+        (origins, horizons, targets).
+    :param y: Array of targets in the original units, shape (time,
+        targets). Predictions or targets which are NaN are skipped.
+    :param origins: Array of origins.
+    :param horizons: Array of rows ahead.
+    :param hour: Integer array of the hour of day (0 - 23) of each row.
+    :param month: Integer array of the month (1 - 12) of each row.
+    :param zones: List of target names. Defaults to their positions.
+    :param chunk: Integer. Origins to reduce at a time.
+
+    :returns: DataFrame with a row per cell with any data, columns zone,
+        horizon (rows ahead), hour, month, and the sums in STATS.
+    """
+    origins = np.asarray(origins)
+    horizons = np.asarray(horizons)
+    n_h = len(horizons)
+    n_z = y.shape[1]
+    cells = n_z * n_h * 24 * 12
+    sums = np.zeros((len(STATS), cells))
+
+    # Cell of each (horizon, zone) before the hour and month are added.
+    base = ((np.arange(n_z) * n_h)[np.newaxis, :]
+            + np.arange(n_h)[:, np.newaxis]) * (24 * 12)
+
+    for i in range(0, len(origins), chunk):
+        rows = origins[i:i + chunk, np.newaxis] + horizons
+        true = np.asarray(y[rows.ravel()], dtype=np.float64).reshape(
+            rows.shape + (n_z,))
+        err = pred[i:i + chunk].astype(np.float64) - true
+        key = (base[np.newaxis]
+               + (hour[rows] * 12 + month[rows] - 1)[..., np.newaxis])
+
+        ok = np.isfinite(err)
+        key = key[ok]
+        err = err[ok]
+        true = true[ok]
+        for s, w in enumerate((None, err, np.abs(err), err ** 2, true,
+                               true ** 2)):
+            sums[s] += np.bincount(key, weights=w, minlength=cells)
+
+    z, h, hr, m = np.unravel_index(np.arange(cells), (n_z, n_h, 24, 12))
+    keep = sums[0] > 0
+    if zones is None:
+        zones = list(range(n_z))
+    out = pd.DataFrame({'zone': np.asarray(zones, dtype=object)[z[keep]],
+                        'horizon': horizons[h[keep]],
+                        'hour': hr[keep],
+                        'month': m[keep] + 1})
+    for s, name in enumerate(STATS):
+        out[name] = sums[s, keep]
+    out['n'] = out['n'].astype(np.int64)
+    return out
+
+
+def summarize(sums, by=None):
+    """Metrics from the output of metric_sums.
+
+    :param sums: DataFrame from metric_sums (or backtest).
+    :param by: Column name or list of them (zone, horizon, hour, month)
+        to group by. None gives one row for everything.
+
+    :returns: DataFrame of n, MAE, MSE, RMSE, bias (mean of prediction
+        minus target), and R^2 per group. R^2 is relative to the mean of
+        the target within the group.
+    """
+    if by is None:
+        g = sums[list(STATS)].sum().to_frame('all').T
+    else:
+        g = sums.groupby(by)[list(STATS)].sum()
+
+    n = g['n']
+    mse = g['sq_err'] / n
+    return pd.DataFrame({'n': n.astype(np.int64),
+                         'mae': g['abs_err'] / n,
+                         'mse': mse,
+                         'rmse': np.sqrt(mse),
+                         'bias': g['err'] / n,
+                         'r2': 1 - g['sq_err'] / (g['sq_y'] - g['y'] ** 2 / n)})
+
+
+def backtest(make_model, path=DATASET_DIR, suffix='', start=None, step=STEP,
+             horizons=None, refit=None, train_rows=None):
+    """Walk-forward backtest of a model on a dataset.
+
+    :param make_model: Callable returning a new model (see walk_forward).
+    :param path: Dataset directory.
+    :param suffix: Scaling variant (see dataset.VARIANTS).
+    :param start: Integer. First origin. Defaults to the start of the test
+        data.
+    :param step: Integer. Rows between origins.
+    :param horizons: Array of rows ahead. Defaults to range(HORIZON).
+    :param refit: See walk_forward.
+    :param train_rows: See walk_forward.
+
+    :returns: Tuple (pred, sums): predictions in the original units, shape
+        (origins, horizons, targets), and the metric sums (see score and
+        summarize).
+    """
+    meta = read_meta(path)
+    if start is None:
+        start = meta['split']
+    if horizons is None:
+        horizons = np.arange(HORIZON)
+    horizons = np.asarray(horizons)
+
+    x_raw, y_raw = open_arrays(path)
+    x = transform(x_raw, *read_scaler('x', suffix=suffix, path=path))
+    y = transform(y_raw, *read_scaler('y', suffix=suffix, path=path))
+    origins = make_origins(len(x), start, step=step, horizons=horizons)
+
+    pred = walk_forward(make_model, x, y, origins, horizons, refit=refit,
+                        train_rows=train_rows)
+    return pred, score(pred, origins, horizons, path=path, suffix=suffix)
+
+
+def score(pred, origins, horizons, path=DATASET_DIR, suffix=''):
+    """Undo the scaling of predictions (in place) and reduce their errors
+    to metric sums (see metric_sums).
+
+    Targets are compared unscaled, straight from the dataset, so they
+    never need inverting.
+
+    :param pred: float32 array of scaled predictions, shape (origins,
+        horizons, targets).
+    :param origins: Array of origins.
+    :param horizons: Array of rows ahead.
+    :param path: Dataset directory.
+    :param suffix: Scaling variant pred was scaled with.
+    """
+    scale, offset = read_scaler('y', suffix=suffix, path=path)
+    pred -= offset.astype(np.float32)
+    pred /= scale.astype(np.float32)
+
+    times = read_index(path)
+    return metric_sums(pred, open_arrays(path)[1], origins, horizons,
+                       hour=np.asarray(times.hour),
+                       month=np.asarray(times.month),
+                       zones=read_meta(path)['y_columns'])
@@ -0,0 +1,240 @@
+"""Module for closed-form linear baselines of every zone and horizon.
+
+data_prep fits scikit-learn linear models to NYC only, and each other
+zone (or horizon) would be another fit repeating the same X'X work.
+Least squares and ridge regression only need a few sums of the data,
+and the expensive one, the Gram matrix X'X, doesn't depend on the
+target. So LinearBaseline:
+
+    - Regresses the target of every zone at every horizon (rows after
+        the origin) on the features at the origin, i.e. a direct
+        multi-horizon forecast, with one shared Gram matrix.
+    - Keeps running sums, so new data (e.g. a new month) is added with
+        partial_fit rather than refitting from scratch.
+    - Solves for any number of ridge penalties from one eigendecomposition
+        of the Gram matrix (alpha=0 is ordinary least squares).
+    - Forecasts in the layout of backtest.py, (origins, horizons,
+        targets), so it can be passed to backtest.backtest like any
+        other model, and scored the same way.
+
+Usage:
+    # Every zone (see data_prep for the dataset), several penalties at
+    # once.
+    pred, summary = compare(alphas=[0, 1, 100])
+
+    # Walk-forward, refit every four weeks.
+    pred, sums = backtest(lambda: LinearBaseline(alpha=10),
+                          path=ZONES_DATASET_DIR,
+                          refit=4 * FIVE_MIN_PER_WEEK)
+"""
+# Third-party:
+import numpy as np
+import pandas as pd
+from numpy.lib.stride_tricks import sliding_window_view
+
+# Imports from dataset.py
+from dataset import ZONES_DATASET_DIR, read_meta, open_arrays, read_scaler, \
+    transform
+
+# Imports from backtest.py
+from backtest import HORIZON, STEP, make_origins, score, summarize
+
+# Ridge penalties compare tries, relative to the number of rows fit.
+ALPHAS = (0.0, 1e-3, 1e-2, 1e-1, 1.0)
+
+# Origins summed at a time, to bound memory (each needs a copy of its
+# targets at every horizon).
+CHUNK = 256
+
+
+class LinearBaseline:
+    """Least squares or ridge regression of the targets at each horizon
+    on the features at the origin.
+
+    The intercept isn't penalized. alpha is relative to the number of
+    rows fit (i.e. it's added to the diagonal of the covariance matrix of
+    the features), so a penalty means the same thing whether fit on a
+    month or on two years.
+
+    :param horizons: Array of rows ahead. Defaults to range(HORIZON).
+    :param alpha: Float. Ridge penalty. 0 for least squares.
+    """
+
+    def __init__(self, horizons=None, alpha=0.0):
+        if horizons is None:
+            horizons = np.arange(HORIZON)
+        self.horizons = np.asarray(horizons)
+        self.alpha = alpha
+        self.reset()
+
+    def reset(self):
+        """Forget everything fit so far."""
+        self.n = 0
+        self.gram = None
+        self.cross = None
+        self.coef_ = None
+        self.intercept_ = None
+        self._tail = None
+
+    def fit(self, x, y):
+        """Fit on consecutive rows of scaled features and targets, shapes
+        (time, features) and (time, targets).
+        """
+        self.reset()
+        return self.partial_fit(x, y)
+
+    def partial_fit(self, x, y):
+        """Add the rows following those already fit (e.g. a new month).
+
+        The last max(horizons) rows of each call don't have every target
+        yet, so they're held back until the next call. Fitting in pieces
+        gives the same model as fitting all the rows at once.
+        """
+        x = np.asarray(x)
+        y = np.asarray(y)
+        if y.ndim == 1:
+            y = y[:, np.newaxis]
+        if self._tail is not None:
+            x = np.concatenate([self._tail[0], x])
+            y = np.concatenate([self._tail[1], y])
+
+        n_f = x.shape[1] + 1
+        n_h = len(self.horizons)
+        if self.gram is None:
+            self.gram = np.zeros((n_f, n_f))
+            self.cross = np.zeros((n_f, n_h * y.shape[1]))
+
+        # Origins with a target at every horizon.
+        span = int(self.horizons.max())
+        n_o = max(0, len(x) - span)
+        for i in range(0, n_o, CHUNK):
+            j = min(n_o, i + CHUNK)
+            # Features with a column of ones, so the Gram and cross
+            # products also sum the features, targets, and rows.
+            xo = np.ones((j - i, n_f))
+            xo[:, :-1] = x[i:j]
+            # Targets at each horizon from each origin, as (origins,
+            # horizons * targets).
+            yo = sliding_window_view(y[i:j + span].astype(np.float64),
+                                     span + 1, axis=0)
+            yo = yo[:, :, self.horizons].transpose(0, 2, 1).reshape(j - i, -1)
+
+            self.gram += xo.T @ xo
+            self.cross += xo.T @ yo
+        self.n += n_o
+        self._tail = (x[n_o:], y[n_o:])
+
+        if self.n > 0:
+            self.coef_, self.intercept_ = self.solve([self.alpha])[0]
+        return self
+
+    def solve(self, alphas):
+        """Solve for each ridge penalty.
+
+        :param alphas: List of penalties (see LinearBaseline).
+
+        :returns: List of (coef, intercept) tuples, one per penalty, with
+            shapes (features, horizons, targets) and (horizons, targets).
+        """
+        if self.n == 0:
+            raise UserWarning('Nothing has been fit yet.')
+
+        n_f = self.gram.shape[0] - 1
+        n_h = len(self.horizons)
+        mean_x = self.gram[:-1, -1] / self.n
+        mean_y = self.cross[-1] / self.n
+
+        # Covariances of the centered data (so the intercept isn't
+        # penalized), per row.
+        cov = self.gram[:-1, :-1] / self.n - np.outer(mean_x, mean_x)
+        cross = self.cross[:-1] / self.n - np.outer(mean_x, mean_y)
+
+        # cov is symmetric, so one eigendecomposition solves every
+        # penalty. Directions with no variance (e.g. a constant feature)
+        # are dropped, as a pseudo-inverse would.
+        vals, vecs = np.linalg.eigh(cov)
+        proj = vecs.T @ cross
+        tol = max(vals.max(), 0) * n_f * np.finfo(np.float64).eps
+
+        out = []
+        for alpha in alphas:
+            d = vals + alpha
+            inv = np.where(d > tol, 1 / np.where(d > tol, d, 1), 0)
+            coef = vecs @ (inv[:, np.newaxis] * proj)
+            intercept = mean_y - mean_x @ coef
+            out.append((coef.reshape(n_f, n_h, -1),
+                        intercept.reshape(n_h, -1)))
+
+        return out
+
+    def forecast(self, x, origins, horizons=None, coef=None, intercept=None):
+        """Forecast from origins (see backtest.forecast).
+
+        :param x: Array of scaled features, shape (time, features).
+        :param origins: Array of origins.
+        :param horizons: Array of rows ahead, each of which must have been
+            fit. Defaults to every horizon fit.
+        :param coef: Coefficients to use (see solve). Defaults to those
+            for alpha.
+        :param intercept: Intercept to use (see solve).
+
+        :returns: float32 array of scaled predictions, shape (origins,
+            horizons, targets).
+        """
+        if coef is None:
+            coef, intercept = self.coef_, self.intercept_
+        if horizons is not None:
+            k = np.searchsorted(self.horizons, horizons)
+            if np.any(k >= len(self.horizons)) \
+                    or np.any(self.horizons[np.minimum(
+                        k, len(self.horizons) - 1)] != horizons):
+                raise ValueError('Horizons {} weren\'t all fit ({}).'.format(
+                    horizons, self.horizons))
+            coef = coef[:, k]
+            intercept = intercept[k]
+
+        n_f, n_h, n_t = coef.shape
+        xo = np.asarray(x[np.asarray(origins)], dtype=np.float64)
+        pred = xo @ coef.reshape(n_f, -1) + intercept.ravel()
+        return pred.astype(np.float32).reshape(len(xo), n_h, n_t)
+
+
+def compare(alphas=ALPHAS, path=ZONES_DATASET_DIR, suffix='', horizons=None,
+            step=STEP):
+    """Fit baselines for several ridge penalties on the training data,
+    and score them on the test data.
+
+    The data is only summed once; each penalty is just another solve.
+
+    :param alphas: List of penalties (see LinearBaseline).
+    :param path: Dataset directory.
+    :param suffix: Scaling variant (see dataset.VARIANTS).
+    :param horizons: Array of rows ahead. Defaults to range(HORIZON).
+    :param step: Integer. Rows between the test origins.
+
+    :returns: Tuple (pred, summary): dictionary mapping each penalty to
+        its predictions in the original units, shape (origins, horizons,
+        targets), and a DataFrame of metrics (see backtest.summarize)
+        for each penalty and zone.
+    """
+    split = read_meta(path)['split']
+    x_raw, y_raw = open_arrays(path)
+    x = transform(x_raw, *read_scaler('x', suffix=suffix, path=path))
+    y = transform(y_raw, *read_scaler('y', suffix=suffix, path=path))
+
+    model = LinearBaseline(horizons=horizons)
+    model.fit(x[:split], y[:split])
+    origins = make_origins(len(x), split, step=step,
+                           horizons=model.horizons)
+
+    pred = {}
+    summary = []
+    for alpha, (coef, intercept) in zip(alphas, model.solve(alphas)):
+        pred[alpha] = model.forecast(x, origins, coef=coef,
+                                     intercept=intercept)
+        sums = score(pred[alpha], origins, model.horizons, path=path,
+                     suffix=suffix)
+        summary.append(summarize(sums, by='zone').assign(alpha=alpha))
+
+    summary = pd.concat(summary).reset_index().set_index(['alpha', 'zone'])
+    return pred, summary
@@ -0,0 +1,236 @@
+"""Module for saving and loading the datasets the notebooks train on.
+
+data_prep used to write a CSV of the scaled data for every scaling
+variant (standard, min/max, and both), and every notebook re-parsed
+them. Instead, a dataset is a directory holding the unscaled data once:
+    - x.npy: float32 features, shape (time, features).
+    - y.npy: float32 targets, shape (time, targets).
+    - index.npy: The times, as int64 nanoseconds since the epoch (UTC).
+    - scalers.npz: For each variant, the scale and offset of the affine
+        transform (scaled = unscaled * scale + offset) for x and y.
+    - meta.json: Column names, time zone, and the row where the test data
+        starts.
+
+Every scaling we use (StandardScaler, MinMaxScaler, and one followed by
+the other) is an affine transform, so a variant is just two small arrays.
+The arrays are memory-mapped and scaled when they're loaded.
+
+Usage:
+    x_train, y_train, x_test, y_test = load_dataset('dataset',
+                                                    suffix='_mm')
+    y_pred = inverse_transform_y(model.predict(x_test), suffix='_mm')
+"""
+# Third-party:
+import numpy as np
+import pandas as pd
+
+# Standard library:
+import json
+import os
+import shutil
+
+# Default dataset directory.
+DATASET_DIR = 'dataset'
+
+X_FILE = 'x.npy'
+Y_FILE = 'y.npy'
+INDEX_FILE = 'index.npy'
+SCALER_FILE = 'scalers.npz'
+META_FILE = 'meta.json'
+
+# Bump if the layout changes.
+VERSION = 1
+
+# Suffixes of the scaling variants data_prep creates: standard scaling,
+# min/max scaling, and standard followed by min/max.
+VARIANTS = ('', '_mm', '_both')
+
+# Dataset data_prep writes with every zone's real-time LBMP as a target
+# (the default dataset only has NYC's).
+ZONES_DATASET_DIR = 'dataset_zones'
+
+# Load zones, as spelled in all_data's column names (A through K).
+ZONES = ['west', 'genese', 'centrl', 'north', 'mhkvl', 'capitl', 'hudvl',
+         'millwd', 'dunwod', 'nyc', 'longil']
+
+# Column of a zone's target.
+ZONE_TARGET = 'realtime_lbmp__{}'
+
+
+def zone_targets(columns, zones=None):
+    """Target columns of the given zones, in zone order, skipping zones
+    which aren't in columns.
+
+    :param columns: Column names (e.g. of all_data).
+    :param zones: List of zones. Defaults to ZONES.
+    """
+    if zones is None:
+        zones = ZONES
+    columns = set(columns)
+    return [ZONE_TARGET.format(z) for z in zones
+            if ZONE_TARGET.format(z) in columns]
+
+
+def affine_params(scaler, idx=None):
+    """Get (scale, offset) from a fitted scikit-learn scaler such that
+    scaler.transform(a) == a * scale + offset.
+
+    :param scaler: Fitted StandardScaler or MinMaxScaler.
+    :param idx: Optional list of column indices to keep (e.g. if only
+        some of the features the scaler was fit on are being saved).
+    """
+    if hasattr(scaler, 'min_'):
+        # MinMaxScaler.
+        scale = scaler.scale_
+        offset = scaler.min_
+    else:
+        # StandardScaler.
+        scale = 1 / scaler.scale_
+        offset = -scaler.mean_ / scaler.scale_
+
+    scale = np.asarray(scale, dtype=np.float64)
+    offset = np.asarray(offset, dtype=np.float64)
+    if idx is not None:
+        scale = scale[idx]
+        offset = offset[idx]
+
+    return scale, offset
+
+
+def compose(first, second):
+    """Combine two (scale, offset) pairs into the one which applies first,
+    then second.
+    """
+    s1, o1 = first
+    s2, o2 = second
+    return s1 * s2, o1 * s2 + o2
+
+
+def write_dataset(path, x, y, split, scalers_x, scalers_y):
+    """Write a dataset directory (see module docstring).
+
+    :param path: Directory to write. Replaced if it exists.
+    :param x: DataFrame of unscaled features with a DatetimeIndex.
+    :param y: Series or DataFrame of unscaled targets, same index as x.
+    :param split: Integer. Row where the test data starts.
+    :param scalers_x: Dictionary mapping variant suffix (see VARIANTS) to
+        (scale, offset) for x (see affine_params and compose).
+    :param scalers_y: Like scalers_x, for y.
+    """
+    if isinstance(y, pd.Series):
+        y = y.to_frame()
+
+    if not x.index.equals(y.index):
+        raise ValueError('x and y must have the same index.')
+
+    tmp = path + '.tmp'
+    if os.path.exists(tmp):
+        shutil.rmtree(tmp)
+    os.makedirs(tmp)
+
+    index = x.index
+    tz = None if index.tz is None else str(index.tz)
+    if tz is not None:
+        index = index.tz_convert('UTC')
+
+    np.save(os.path.join(tmp, X_FILE), x.values.astype(np.float32))
+    np.save(os.path.join(tmp, Y_FILE), y.values.astype(np.float32))
+    np.save(os.path.join(tmp, INDEX_FILE), index.asi8)
+
+    arrays = {}
+    for name, scalers in (('x', scalers_x), ('y', scalers_y)):
+        for suffix, (scale, offset) in scalers.items():
+            arrays[name + '_scale' + suffix] = scale
+            arrays[name + '_offset' + suffix] = offset
+    np.savez(os.path.join(tmp, SCALER_FILE), **arrays)
+
+    meta = {'version': VERSION,
+            'x_columns': [str(c) for c in x.columns],
+            'y_columns': [str(c) for c in y.columns],
+            'tz': tz,
+            'split': int(split),
+            'variants': sorted(scalers_x.keys())}
+    with open(os.path.join(tmp, META_FILE), 'w') as f:
+        json.dump(meta, f, indent=1)
+
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.replace(tmp, path)
+
+
+def read_meta(path=DATASET_DIR):
+    """Read a dataset's metadata dictionary."""
+    with open(os.path.join(path, META_FILE)) as f:
+        return json.load(f)
+
+
+def read_index(path=DATASET_DIR):
+    """Read a dataset's times as a DatetimeIndex."""
+    meta = read_meta(path)
+    index = pd.DatetimeIndex(np.load(os.path.join(path, INDEX_FILE)))
+    if meta['tz'] is not None:
+        index = index.tz_localize('UTC').tz_convert(meta['tz'])
+    return index
+
+
+def open_arrays(path=DATASET_DIR):
+    """Memory-map a dataset's unscaled (x, y) arrays."""
+    return (np.load(os.path.join(path, X_FILE), mmap_mode='r'),
+            np.load(os.path.join(path, Y_FILE), mmap_mode='r'))
+
+
+def read_scaler(name, suffix='', path=DATASET_DIR):
+    """Read (scale, offset) for 'x' or 'y' and the given variant."""
+    with np.load(os.path.join(path, SCALER_FILE)) as f:
+        try:
+            return f[name + '_scale' + suffix], f[name + '_offset' + suffix]
+        except KeyError:
+            raise UserWarning('No scaling variant "{}" in {}.'
+                              .format(suffix, path)) from None
+
+
+def transform(a, scale, offset):
+    """Apply a * scale + offset, returning a new float32 array."""
+    out = np.multiply(a, scale.astype(np.float32), dtype=np.float32)
+    out += offset.astype(np.float32)
+    return out
+
+
+def inverse_transform(a, scale, offset):
+    """Undo transform."""
+    return (np.asarray(a, dtype=np.float64) - offset) / scale
+
+
+def inverse_transform_y(y, suffix='', path=DATASET_DIR):
+    """Convert scaled targets (e.g. predictions) back to the original
+    units.
+
+    :param y: Array of scaled targets, shape (samples, targets) or
+        (samples,) for a single target.
+    :param suffix: Scaling variant y was scaled with.
+    :param path: Dataset directory.
+    """
+    scale, offset = read_scaler('y', suffix=suffix, path=path)
+    y = np.asarray(y)
+    if y.ndim == 1:
+        return inverse_transform(y[:, np.newaxis], scale, offset)[:, 0]
+    return inverse_transform(y, scale, offset)
+
+
+def load_dataset(path=DATASET_DIR, suffix=''):
+    """Load a dataset, scaled with the given variant.
+
+    :param path: Dataset directory.
+    :param suffix: Scaling variant, one of VARIANTS.
+
+    :returns: Tuple of float32 arrays (x_train, y_train, x_test, y_test).
+    """
+    split = read_meta(path)['split']
+    x, y = open_arrays(path)
+    x_scale, x_offset = read_scaler('x', suffix=suffix, path=path)
+    y_scale, y_offset = read_scaler('y', suffix=suffix, path=path)
+
+    return (transform(x[:split], x_scale, x_offset),
+            transform(y[:split], y_scale, y_offset),
+            transform(x[split:], x_scale, x_offset),
+            transform(y[split:], y_scale, y_offset))
@@ -0,0 +1,417 @@
+"""Module to run a grid of training experiments in parallel on CPU.
+
+The notebooks train one model at a time: each scaling variant (see
+dataset.VARIANTS) is loaded, scaled, and trained on in turn, with the
+next model or setting being a hand-edited copy of the cell before it.
+Without a GPU, one Keras fit doesn't keep every core busy, so instead
+run a whole grid of trials at once:
+
+    - Each trial is (variant, model, params, target). model is a
+        function (or 'module:function' string) which trains on the
+        scaled data and predicts the test data; see ann and cnn1d for
+        examples.
+    - Trials run in a pool of worker processes, each limited to
+        THREADS_PER_WORKER threads so the workers don't fight over the
+        cores.
+    - Each variant's scaled arrays are made once, in shared memory, and
+        every worker reads the same copy.
+    - Each trial's predictions are scaled back to the original units and
+        scored, and the results are collected into one DataFrame.
+
+Usage:
+    trials = make_grid(models=['experiments:ann'],
+                       params=param_grid({'epochs': [50, 100]}),
+                       targets=['nyc'])
+    results = run_grid(trials, workers=4)
+    results.to_csv('results.csv')
+
+Model functions must be importable by the workers (i.e. defined in a
+module, not a notebook).
+"""
+# Third-party:
+import numpy as np
+import pandas as pd
+
+# Standard library:
+import importlib
+import itertools
+import os
+import sys
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import get_context
+from multiprocessing.shared_memory import SharedMemory
+
+# Imports from dataset.py
+from dataset import DATASET_DIR, VARIANTS, read_meta, open_arrays, \
+    read_scaler, inverse_transform
+
+# Number of worker processes. Defaults to one per core, divided by
+# THREADS_PER_WORKER.
+WORKERS = None
+
+# Threads each worker's math libraries (BLAS, OpenMP, TensorFlow) may
+# use.
+THREADS_PER_WORKER = 1
+
+# Environment variables which set the thread count of the math
+# libraries. They have to be set before the libraries are imported,
+# i.e. when the worker starts.
+THREAD_VARS = ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS',
+               'NUMEXPR_NUM_THREADS', 'TF_NUM_INTRAOP_THREADS',
+               'TF_NUM_INTEROP_THREADS')
+
+# Arrays shared with this worker: (name, variant) -> array. Set by
+# init_worker.
+_SHARED = {}
+_BLOCKS = []
+
+
+def param_grid(grid):
+    """Every combination of a dictionary of lists, e.g.
+    {'a': [1, 2], 'b': [3]} -> [{'a': 1, 'b': 3}, {'a': 2, 'b': 3}].
+    """
+    keys = sorted(grid)
+    return [dict(zip(keys, values))
+            for values in itertools.product(*(grid[k] for k in keys))]
+
+
+def make_grid(models, variants=VARIANTS, params=({},), targets=(None,)):
+    """Build the list of trials for every combination of the inputs.
+
+    :param models: List of model functions or 'module:function' strings
+        (see run_trial).
+    :param variants: List of scaling variants (see dataset.VARIANTS).
+    :param params: List of dictionaries of keyword arguments for the
+        model (see param_grid).
+    :param targets: List of target columns or zones (see
+        target_column). None is the first target.
+
+    :returns: List of trial dictionaries with 'variant', 'model',
+        'params', and 'target' keys.
+    """
+    return [{'variant': v, 'model': m, 'params': dict(p), 'target': t}
+            for v, m, p, t in itertools.product(variants, models, params,
+                                                targets)]
+
+
+def model_name(model):
+    """'module:function' name of a model."""
+    if isinstance(model, str):
+        return model
+    return '{}:{}'.format(model.__module__, model.__name__)
+
+
+def get_model(model):
+    """Get a model function from a function or 'module:function'."""
+    if not isinstance(model, str):
+        return model
+    module, _, name = model.partition(':')
+    return getattr(importlib.import_module(module), name)
+
+
+def target_column(columns, target):
+    """Find the position of a target in the dataset's y columns.
+
+    :param columns: List of y column names.
+    :param target: Column name (e.g. 'realtime_lbmp__nyc'), zone (e.g.
+        'NYC' or 'N.Y.C.', matching the column ending in '__nyc'), or
+        None for the first column.
+    """
+    if target is None:
+        return 0
+    if target in columns:
+        return columns.index(target)
+
+    suffix = '__' + target.replace(' ', '').replace('.', '').lower()
+    matches = [i for i, c in enumerate(columns) if c.endswith(suffix)]
+    if len(matches) != 1:
+        raise ValueError('Target {} matches {} of the y columns {}.'.format(
+            target, len(matches), columns))
+    return matches[0]
+
+
+def share_variants(variants, path=DATASET_DIR):
+    """Scale the dataset with each variant, into shared memory.
+
+    :returns: Tuple (blocks, specs): the SharedMemory blocks (which the
+        caller must close and unlink), and for each (name, variant) the
+        (block name, shape) workers attach with (see init_worker).
+    """
+    x, y = open_arrays(path)
+    blocks = []
+    specs = {}
+    for v in variants:
+        for name, a in (('x', x), ('y', y)):
+            scale, offset = read_scaler(name, suffix=v, path=path)
+            shm = SharedMemory(create=True,
+                               size=max(1, a.size * np.dtype(np.float32)
+                                        .itemsize))
+            blocks.append(shm)
+            out = np.ndarray(a.shape, dtype=np.float32, buffer=shm.buf)
+            np.multiply(a, scale.astype(np.float32), out=out)
+            out += offset.astype(np.float32)
+            specs[(name, v)] = (shm.name, a.shape)
+
+    return blocks, specs
+
+
+def attach(name):
+    """Attach to a shared memory block made by share_variants.
+
+    Workers share the resource tracker of the process which started them,
+    so the block stays registered once, and is unregistered when that
+    process unlinks it.
+    """
+    try:
+        return SharedMemory(name=name, track=False)
+    except TypeError:
+        # Python < 3.13.
+        return SharedMemory(name=name)
+
+
+def init_worker(specs, threads):
+    """Attach a worker to the shared arrays (see share_variants) and
+    limit its threads.
+    """
+    for key, (name, shape) in specs.items():
+        shm = attach(name)
+        _BLOCKS.append(shm)
+        a = np.ndarray(shape, dtype=np.float32, buffer=shm.buf)
+        a.flags.writeable = False
+        _SHARED[key] = a
+
+    pin_threads(threads)
+
+
+def pin_threads(threads):
+    """Limit the threads of libraries which can only be limited after
+    they're imported. Only touches TensorFlow if it's already imported.
+    """
+    tf = sys.modules.get('tensorflow')
+    if tf is None:
+        return
+    try:
+        tf.config.threading.set_intra_op_parallelism_threads(threads)
+        tf.config.threading.set_inter_op_parallelism_threads(threads)
+    except (AttributeError, RuntimeError):
+        # Older TensorFlow, or already initialized.
+        pass
+
+
+def worker_threads():
+    """Threads this worker was limited to (see run_grid)."""
+    return int(os.environ.get('OMP_NUM_THREADS', THREADS_PER_WORKER))
+
+
+def scores(y_true, y_pred):
+    """MAE, MSE, and R^2 of predictions, in one pass over the data."""
+    y_true = np.asarray(y_true, dtype=np.float64).ravel()
+    y_pred = np.asarray(y_pred, dtype=np.float64).ravel()
+    err = y_pred - y_true
+    mse = np.mean(err ** 2)
+    return {'mae': np.mean(np.abs(err)), 'mse': mse,
+            'r2': 1 - mse / np.var(y_true)}
+
+
+def run_trial(trial, split, y_columns, y_scalers):
+    """Run one trial in a worker (see init_worker).
+
+    The model is called as model(x_train, y_train, x_test, y_test,
+    **params) with read-only, scaled float32 arrays (y_train and y_test
+    are the target's column, shape (time, 1)) and returns (y_true,
+    y_pred): the scaled targets it was scored against (e.g. one per
+    window) and its predictions of them.
+
+    :param split: Integer. Row where the test data starts.
+    :param y_columns: List of y column names.
+    :param y_scalers: Dictionary mapping variant to the y (scale,
+        offset).
+
+    :returns: Dictionary of results (see run_grid).
+    """
+    out = {'variant': trial['variant'], 'model': model_name(trial['model']),
+           'target': trial['target'], 'params': repr(trial['params']),
+           'pid': os.getpid()}
+    t0 = time.time()
+    try:
+        j = target_column(y_columns, trial['target'])
+        x = _SHARED[('x', trial['variant'])]
+        y = _SHARED[('y', trial['variant'])][:, j:j + 1]
+        y_true, y_pred = get_model(trial['model'])(
+            x[:split], y[:split], x[split:], y[split:], **trial['params'])
+
+        # Score in the original units.
+        scale, offset = y_scalers[trial['variant']]
+        out.update(scores(
+            inverse_transform(np.reshape(y_true, (-1, 1)), scale[j],
+                              offset[j]),
+            inverse_transform(np.reshape(y_pred, (-1, 1)), scale[j],
+                              offset[j])))
+        out['error'] = None
+    except Exception:
+        out['error'] = traceback.format_exc()
+
+    out['seconds'] = time.time() - t0
+    return out
+
+
+def run_grid(trials, workers=None, threads=None, path=DATASET_DIR,
+             results_file=None):
+    """Run trials (see make_grid) in parallel.
+
+    :param trials: List of trial dictionaries.
+    :param workers: Integer. Worker processes. Defaults to WORKERS.
+    :param threads: Integer. Threads per worker. Defaults to
+        THREADS_PER_WORKER.
+    :param path: Dataset directory.
+    :param results_file: String. If given, results are appended to this
+        CSV file as trials finish, so an interrupted sweep isn't lost.
+
+    :returns: DataFrame with a row per trial, in trial order: variant,
+        model, target, params, mae, mse, r2, seconds, pid, and error (the
+        traceback, for trials which failed).
+    """
+    if threads is None:
+        threads = THREADS_PER_WORKER
+    if workers is None:
+        workers = WORKERS or max(1, (os.cpu_count() or 1) // threads)
+    workers = max(1, min(workers, len(trials)))
+
+    meta = read_meta(path)
+    variants = sorted({t['variant'] for t in trials})
+    y_scalers = {v: read_scaler('y', suffix=v, path=path) for v in variants}
+
+    # Workers inherit the environment when they start, before they
+    # import anything.
+    saved = {k: os.environ.get(k) for k in THREAD_VARS}
+    os.environ.update({k: str(threads) for k in THREAD_VARS})
+
+    blocks, specs = share_variants(variants, path=path)
+    results = [None] * len(trials)
+    try:
+        with ProcessPoolExecutor(max_workers=workers,
+                                 mp_context=get_context('spawn'),
+                                 initializer=init_worker,
+                                 initargs=(specs, threads)) as pool:
+            futures = {pool.submit(run_trial, t, meta['split'],
+                                   meta['y_columns'], y_scalers): i
+                       for i, t in enumerate(trials)}
+            for done, future in enumerate(as_completed(futures), 1):
+                i = futures[future]
+                results[i] = future.result()
+                print('Trial {} of {} done ({}).'.format(
+                    done, len(trials), 'failed' if results[i]['error']
+                    else '{:.1f} s'.format(results[i]['seconds'])),
+                    flush=True)
+                if results_file is not None:
+                    pd.DataFrame([results[i]]).to_csv(
+                        results_file, mode='a', index=False,
+                        header=not os.path.exists(results_file))
+    finally:
+        for k, v in saved.items():
+            if v is None:
+                os.environ.pop(k, None)
+            else:
+                os.environ[k] = v
+        for shm in blocks:
+            shm.close()
+            shm.unlink()
+
+    return pd.DataFrame(results)
+
+
+def seed_everything(seed):
+    """Seed numpy and, if it's installed, TensorFlow."""
+    np.random.seed(seed)
+    try:
+        import tensorflow as tf
+    except ImportError:
+        return
+    if hasattr(tf, 'random') and hasattr(tf.random, 'set_seed'):
+        tf.random.set_seed(seed)
+    else:
+        tf.set_random_seed(seed)
+
+
+def ann(x_train, y_train, x_test, y_test, epochs=100, patience=5,
+        dropout=0.25, layers=(256, 128, 64), optimizer='adadelta',
+        validation_split=0.2, seed=None):
+    """The ANN from ann.ipynb, as a model for run_trial.
+
+    A dense layer as wide as the input, then the given hidden layers,
+    each followed by dropout. Trained with early stopping on a held out
+    fraction of the training data.
+    """
+    import keras
+    from keras.models import Sequential
+    from keras.layers import Dense, Dropout
+
+    pin_threads(worker_threads())
+    if seed is not None:
+        seed_everything(seed)
+
+    model = Sequential()
+    model.add(Dense(x_train.shape[1], input_dim=x_train.shape[1],
+                    activation='relu'))
+    for width in layers:
+        model.add(Dense(width, activation='relu'))
+        model.add(Dropout(dropout))
+    model.add(Dense(1))
+    model.compile(loss='mean_squared_error', optimizer=optimizer,
+                  metrics=['mse'])
+
+    early_stop = keras.callbacks.EarlyStopping(
+        monitor='val_loss', patience=patience, restore_best_weights=True)
+    model.fit(x_train, y_train, epochs=epochs, shuffle=True,
+              validation_split=validation_split, callbacks=[early_stop],
+              verbose=0)
+
+    return y_test, model.predict(x_test)
+
+
+def cnn1d(x_train, y_train, x_test, y_test, num_weeks=4, filters=32,
+          kernel_size=36, pool_size=12, dense=512, dropout=0.25, epochs=10,
+          batch_size=32, seed=None):
+    """The 1D CNN from cnn1d.ipynb, as a model for run_trial.
+
+    Back to back windows of num_weeks weeks, each predicting the time
+    step right after it (see windows.make_windows).
+    """
+    from keras.models import Sequential
+    from keras.layers import Dense, Dropout, Flatten, SeparableConv1D, \
+        MaxPooling1D
+    from windows import make_windows, FIVE_MIN_PER_WEEK
+
+    pin_threads(worker_threads())
+    if seed is not None:
+        seed_everything(seed)
+
+    t_per_m = FIVE_MIN_PER_WEEK * num_weeks
+    x_win_train, y_win_train = make_windows(
+        x_train, y_train, num_weeks=num_weeks, n_y=1, stride=t_per_m,
+        flat=True)
+    x_win_test, y_win_test = make_windows(
+        x_test, y_test, num_weeks=num_weeks, n_y=1, stride=t_per_m,
+        flat=True)
+
+    model = Sequential()
+    model.add(SeparableConv1D(filters=filters, kernel_size=kernel_size,
+                              padding='same',
+                              input_shape=(t_per_m, x_train.shape[1])))
+    model.add(MaxPooling1D(pool_size=pool_size))
+    model.add(SeparableConv1D(filters=filters, kernel_size=kernel_size,
+                              padding='same'))
+    model.add(MaxPooling1D(pool_size=pool_size))
+    model.add(Flatten())
+    model.add(Dense(dense, activation='relu'))
+    model.add(Dropout(dropout))
+    model.add(Dense(1))
+    model.compile(loss='mean_squared_error', optimizer='adam',
+                  metrics=['mse'])
+
+    model.fit(x_win_train, y_win_train, epochs=epochs,
+              batch_size=batch_size, verbose=0)
+
+    return y_win_test, model.predict(x_win_test)
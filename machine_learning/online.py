@@ -0,0 +1,163 @@
+"""Module for building features one five minute interval at a time.
+
+data_prep builds the features from the whole history at once: every
+real-time column is shifted back a day (since a day-old real-time value
+is what we'd actually have), the first day (now NaN) is dropped, the
+selected features are kept, and the scaling is applied. To predict the
+next interval as soon as its data lands, FeatureStream does the same
+thing one row at a time:
+
+    - The day of real-time values it needs is kept in a ring buffer, so
+        each new row costs one read and one write per column, however
+        much history there is.
+    - The saved scaling (see dataset.py) is applied in place, in the
+        same float32 arithmetic as dataset.transform, so the features are
+        bit for bit those of the batch path (see batch_features).
+
+Usage:
+    stream = FeatureStream(columns=all_data_columns, suffix='_both')
+    # Prime with (at least) the last day of all_data, oldest first.
+    stream.extend(history)
+    # Then, as each interval arrives:
+    x = stream.update(row)
+    y_pred = model.predict(x[np.newaxis])
+"""
+# Third-party:
+import numpy as np
+import pandas as pd
+
+# Imports from dataset.py
+from dataset import DATASET_DIR, read_meta, read_scaler, transform
+
+# Rows the real-time columns are shifted by (a day of five minute
+# intervals), as in data_prep.
+LAG = 12 * 24
+
+# Columns starting with these are lagged by LAG.
+LAGGED_PREFIXES = ('realtime_',)
+
+
+def is_lagged(column):
+    """Whether a column is used LAG rows late (see LAGGED_PREFIXES)."""
+    return column.startswith(LAGGED_PREFIXES)
+
+
+def batch_features(df, path=DATASET_DIR, suffix='', lag=LAG):
+    """The batch path from data_prep: lag, drop, select, and scale.
+
+    :param df: DataFrame of all_data columns (without NaNs, e.g. after
+        data_prep's interpolation).
+    :param path: Dataset directory, for the features and scaling.
+    :param suffix: Scaling variant (see dataset.VARIANTS).
+    :param lag: Integer. Rows the real-time columns are shifted by.
+
+    :returns: float32 array of scaled features, shape (len(df) - lag,
+        features).
+    """
+    columns = read_meta(path)['x_columns']
+    x = df[columns].copy()
+    for c in columns:
+        if is_lagged(c):
+            x[c] = x[c].shift(lag)
+    x = x.iloc[lag:]
+    return transform(x.values.astype(np.float32),
+                     *read_scaler('x', suffix=suffix, path=path))
+
+
+class FeatureStream:
+    """Scaled features for each new row of all_data (see module
+    docstring).
+
+    :param columns: List of the columns of each row passed to update, in
+        order. Must include every feature of the dataset (other columns
+        are ignored).
+    :param path: Dataset directory, for the features and scaling.
+    :param suffix: Scaling variant (see dataset.VARIANTS).
+    :param lag: Integer. Rows the real-time columns are shifted by.
+    """
+
+    def __init__(self, columns, path=DATASET_DIR, suffix='', lag=LAG):
+        features = read_meta(path)['x_columns']
+        missing = [c for c in features if c not in columns]
+        if missing:
+            raise ValueError('Features {} aren\'t in columns.'.format(
+                missing))
+
+        position = {c: i for i, c in enumerate(columns)}
+        lagged = [i for i, c in enumerate(features) if is_lagged(c)]
+        current = [i for i, c in enumerate(features) if not is_lagged(c)]
+
+        self.columns = list(columns)
+        self.features = features
+        self.lag = lag
+
+        # Where each feature comes from in a row, and goes in the output.
+        self._lagged_src = np.array([position[features[i]] for i in lagged],
+                                    dtype=np.intp)
+        self._lagged_dst = np.array(lagged, dtype=np.intp)
+        self._current_src = np.array([position[features[i]]
+                                      for i in current], dtype=np.intp)
+        self._current_dst = np.array(current, dtype=np.intp)
+
+        scale, offset = read_scaler('x', suffix=suffix, path=path)
+        self._scale = scale.astype(np.float32)
+        self._offset = offset.astype(np.float32)
+
+        self._ring = np.empty((lag, len(lagged)), dtype=np.float32)
+        self._last = np.full(len(columns), np.nan, dtype=np.float32)
+        self._out = np.empty(len(features), dtype=np.float32)
+        self._pos = 0
+        self.rows = 0
+
+    @property
+    def ready(self):
+        """Whether a full lag of history has been seen."""
+        return self.rows > self.lag
+
+    def update(self, row):
+        """Add the next row and get its features.
+
+        :param row: Array-like of the row's values, in the order of
+            columns. A NaN is replaced by the column's previous value.
+            (data_prep interpolates gaps, which can't be done until the
+            gap has ended, so features after a gap can differ slightly
+            from the batch path.)
+
+        :returns: float32 array of the row's scaled features, or None for
+            the first lag rows, which data_prep drops. The array is
+            overwritten by the next update, so copy it to keep it.
+        """
+        row = np.asarray(row, dtype=np.float32)
+        np.copyto(self._last, row, where=~np.isnan(row))
+
+        # The oldest value in the ring is the one from lag rows ago.
+        # Replace it with the current one.
+        old = self._ring[self._pos].copy()
+        self._ring[self._pos] = self._last[self._lagged_src]
+        self._pos = (self._pos + 1) % self.lag
+        self.rows += 1
+        if self.rows <= self.lag:
+            return None
+
+        out = self._out
+        out[self._lagged_dst] = old
+        out[self._current_dst] = self._last[self._current_src]
+        out *= self._scale
+        out += self._offset
+        return out
+
+    def extend(self, rows):
+        """Add several rows, oldest first (e.g. to prime the stream with
+        the last day of history).
+
+        :param rows: DataFrame (whose columns are reordered to match) or
+            2-D array of rows.
+
+        :returns: Features of the last row (see update).
+        """
+        if isinstance(rows, pd.DataFrame):
+            rows = rows[self.columns].values
+        out = None
+        for row in rows:
+            out = self.update(row)
+        return out
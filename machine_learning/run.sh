@@ -1,2 +1,2 @@
 #!/bin/bash
-docker run --runtime=nvidia -u $(id -u):$(id -g) -it --rm -v $(realpath ~/git/ecen-715-project/machine_learning):/tf/notebooks -p 8888:8888 ecen715:latest
+docker run --runtime=nvidia -u $(id -u):$(id -g) -it --rm -v $(realpath ~/git/ecen-715-project):/tf/notebooks -p 8888:8888 ecen715:latest
@@ -0,0 +1,130 @@
+"""Module for cutting time series data into sliding windows for the CNNs.
+
+Rather than copying each window into a new array, the windows are
+strided views over the original data: window i is just a different way
+of looking at rows i through i + (window length). This means we can
+train on every possible window while only ever materializing one
+mini-batch at a time (see batch_generator).
+
+Usage:
+    x_win, y_win = make_windows(x_train, y_train, num_weeks=4, n_y=288)
+    gen = batch_generator(x_win, y_win, batch_size=32)
+    model.fit_generator(gen, steps_per_epoch=num_batches(len(x_win), 32))
+"""
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+# Number of 5 minute intervals in a week.
+FIVE_MIN_PER_WEEK = int((1/5) * 60 * 24 * 7)
+
+
+def num_windows(n_rows, window, n_y=0, stride=1):
+    """Number of windows of length window (followed by n_y targets)
+    which fit in n_rows, starting every stride rows.
+    """
+    return max(0, (n_rows - window - n_y) // stride + 1)
+
+
+def window_view(x, num_weeks, steps_per_week=FIVE_MIN_PER_WEEK, n_y=0,
+                stride=1, flat=False):
+    """Read-only view of x as sliding windows.
+
+    :param x: 2-D array, shape (time, features).
+    :param num_weeks: Integer. Number of weeks in each window.
+    :param steps_per_week: Integer. Number of rows in a week.
+    :param n_y: Integer. Number of rows which must follow each window
+        (for targets, see target_view).
+    :param stride: Integer. Rows between the starts of consecutive
+        windows.
+    :param flat: Boolean. If True, don't split the window into weeks.
+
+    :returns: View of shape (windows, num_weeks, steps_per_week,
+        features), or (windows, num_weeks * steps_per_week, features) if
+        flat. Window i starts at row i * stride.
+    """
+    x = np.asarray(x)
+    window = num_weeks * steps_per_week
+    n = num_windows(len(x), window, n_y=n_y, stride=stride)
+    s0, s1 = x.strides
+
+    if flat:
+        shape = (n, window, x.shape[1])
+        strides = (stride * s0, s0, s1)
+    else:
+        shape = (n, num_weeks, steps_per_week, x.shape[1])
+        strides = (stride * s0, steps_per_week * s0, s0, s1)
+
+    return as_strided(x, shape=shape, strides=strides, writeable=False)
+
+
+def target_view(y, offset, n_windows, n_y, stride=1):
+    """Read-only view of the targets following each window.
+
+    :param y: Array of shape (time,) or (time, 1).
+    :param offset: Integer. Row of the first target for window 0 (i.e.
+        the window length).
+    :param n_windows: Integer. Number of windows.
+    :param n_y: Integer. Number of targets per window.
+    :param stride: Integer. Rows between the starts of consecutive
+        windows.
+
+    :returns: View of shape (n_windows, n_y). Row i is
+        y[offset + i * stride:offset + i * stride + n_y].
+    """
+    y = np.asarray(y)
+    if y.ndim == 2:
+        if y.shape[1] != 1:
+            raise ValueError('y must have a single column.')
+        y = y[:, 0]
+
+    s0 = y.strides[0]
+    return as_strided(y[offset:], shape=(n_windows, n_y),
+                      strides=(stride * s0, s0), writeable=False)
+
+
+def make_windows(x, y, num_weeks, n_y, steps_per_week=FIVE_MIN_PER_WEEK,
+                 stride=1, flat=False):
+    """Views of x as sliding windows, and of y as the n_y values
+    immediately after each window.
+
+    See window_view and target_view for inputs.
+
+    :returns: Tuple (x_windows, y_windows). Neither copies any data.
+    """
+    x_win = window_view(x, num_weeks=num_weeks, steps_per_week=steps_per_week,
+                        n_y=n_y, stride=stride, flat=flat)
+    y_win = target_view(y, offset=num_weeks * steps_per_week,
+                        n_windows=len(x_win), n_y=n_y, stride=stride)
+    return x_win, y_win
+
+
+def num_batches(n, batch_size):
+    """Number of batches needed to cover n samples."""
+    return -(-n // batch_size)
+
+
+def batch_generator(x, y, batch_size, indices=None, shuffle=True, seed=None):
+    """Generate (x, y) mini-batches forever, as Keras' fit_generator
+    wants.
+
+    Only the current batch is copied out of the (strided) windows.
+
+    :param x: Windows, e.g. from make_windows.
+    :param y: Targets, e.g. from make_windows.
+    :param batch_size: Integer. Samples per batch.
+    :param indices: Array of window indices to draw from (e.g. to split
+        off validation windows). Defaults to all of them.
+    :param shuffle: Boolean. Shuffle the windows each epoch.
+    :param seed: Integer. Seed for shuffling.
+    """
+    if indices is None:
+        indices = np.arange(len(x))
+    indices = np.asarray(indices)
+
+    rng = np.random.RandomState(seed)
+    while True:
+        order = rng.permutation(indices) if shuffle else indices
+        for i in range(0, len(order), batch_size):
+            # Sorting keeps the reads as sequential as we can.
+            idx = np.sort(order[i:i + batch_size])
+            yield x[idx], y[idx]
@@ -0,0 +1,262 @@
+"""Module describing the columns of each type of NYISO file.
+
+NYISO's files have changed a little over the years, and spell things
+differently from one type of file to the next:
+    - Some day ahead LMP files have a 'Marginal Cost Congestion ($/MWH'
+        column instead of 'Marginal Cost Congestion ($/MWHr)'.
+    - Zone names have spaces and periods in them ('HUD VL', 'N.Y.C.'),
+        and the load forecast files use title case ('Hud Vl').
+    - Some columns (PTID, Time Zone) aren't any use to us.
+
+Each file's header is matched to a file type (see SCHEMAS) and mapped to
+that type's canonical column names before the file is parsed, so the
+variants cost nothing and unused columns are never parsed at all.
+
+A header which doesn't match any type is schema drift. check_headers
+finds it by reading only the first line of each file, so a new variant
+is reported before the parsing starts rather than partway through. Run
+this module to list every header variant in the downloaded data:
+
+    python nyiso_schema.py
+"""
+# Third-party:
+import numpy as np
+
+# Standard library:
+import csv
+import os
+from zipfile import ZipFile
+
+# dtype for prices and loads.
+VALUE_DTYPE = np.float32
+
+# Zones in the load forecast files, spelled as by clean_zone.
+FORECAST_ZONES = ['CAPITL', 'CENTRL', 'DUNWOD', 'GENESE', 'HUDVL', 'LONGIL',
+                  'MHKVL', 'MILLWD', 'NYC', 'NORTH', 'WEST', 'NYISO']
+
+# File types. For each:
+#   - columns: Canonical column names (after the time stamp) and their
+#       dtypes, where 'category' means categorical.
+#   - required: Columns a header must have to be of this type.
+#   - variants: Other names a canonical column has gone by.
+#   - drop: Columns which are skipped without being parsed.
+#   - zones: If True, column names are zones, and are spelled as by
+#       clean_zone.
+SCHEMAS = {
+    'lmp': {'columns': {'Name': 'category',
+                        'LBMP ($/MWHr)': VALUE_DTYPE,
+                        'Marginal Cost Losses ($/MWHr)': VALUE_DTYPE,
+                        'Marginal Cost Congestion ($/MWHr)': VALUE_DTYPE},
+            'required': ['Name', 'LBMP ($/MWHr)'],
+            'variants': {'Marginal Cost Congestion ($/MWH':
+                         'Marginal Cost Congestion ($/MWHr)'},
+            'drop': ['PTID'],
+            'zones': False},
+    'load': {'columns': {'Name': 'category', 'Load': VALUE_DTYPE},
+             'required': ['Name', 'Load'],
+             'variants': {},
+             'drop': ['Time Zone', 'PTID'],
+             'zones': False},
+    'forecast': {'columns': {z: VALUE_DTYPE for z in FORECAST_ZONES},
+                 'required': ['NYISO'],
+                 'variants': {},
+                 'drop': [],
+                 'zones': True}}
+
+
+def clean_name(name):
+    """Canonical spelling of a zone or node name: no spaces or periods,
+    e.g. 'N.Y.C.' -> 'NYC'.
+    """
+    return name.replace(' ', '').replace('.', '')
+
+
+def clean_zone(name):
+    """Canonical spelling of a zone used as a column name, e.g.
+    'Hud Vl' -> 'HUDVL'.
+    """
+    return clean_name(name).upper()
+
+
+def parse_header(line):
+    """Split the first line (bytes) of a NYISO CSV file into column
+    names.
+    """
+    return next(csv.reader([line.decode('utf-8')]))
+
+
+def match(header, file_type):
+    """Map a header's columns onto one file type.
+
+    :returns: Tuple (names, unknown): dictionary mapping each header
+        column to parse to its canonical name (time stamp first, under
+        its own name), and a list of columns the type doesn't know.
+    """
+    schema = SCHEMAS[file_type]
+    names = {header[0]: header[0]}
+    unknown = []
+    for col in header[1:]:
+        if col in schema['drop']:
+            continue
+        name = schema['variants'].get(col, col)
+        if schema['zones']:
+            name = clean_zone(name)
+        if name in schema['columns'] and name not in names.values():
+            names[col] = name
+        else:
+            unknown.append(col)
+
+    return names, unknown
+
+
+def resolve(header):
+    """Find the file type of a header and how to read it.
+
+    :param header: List of column names, time stamp first.
+
+    :returns: Dictionary with:
+        - type: Key of SCHEMAS.
+        - names: Dictionary mapping each header column to parse to its
+            canonical name, in header order.
+        - dtypes: read_csv dtypes of the columns to parse, by header
+            name. The time stamp is read as a string.
+
+    Raises ValueError if the header doesn't match any type.
+    """
+    best = None
+    for file_type, schema in SCHEMAS.items():
+        names, unknown = match(header, file_type)
+        missing = [c for c in schema['required'] if c not in names.values()]
+        if not unknown and not missing:
+            dtypes = {col: schema['columns'][name]
+                      for col, name in names.items() if col != header[0]}
+            dtypes[header[0]] = str
+            return {'type': file_type, 'names': names, 'dtypes': dtypes}
+
+        if best is None or len(unknown) + len(missing) < best[0]:
+            best = (len(unknown) + len(missing), file_type, unknown, missing)
+
+    _, file_type, unknown, missing = best
+    raise ValueError('Header {} matches no NYISO file type. Closest is {} '
+                     '(unknown columns: {}; missing columns: {}).'.format(
+                         header, file_type, unknown, missing))
+
+
+def read_headers(source):
+    """Read just the header of each file of a month.
+
+    :param source: List of CSV files, or a ZIP archive (see
+        combine_nyiso_data.get_month_sources).
+
+    :returns: List of (file name, header) tuples.
+    """
+    out = []
+    if isinstance(source, str):
+        with ZipFile(source) as z:
+            for name in sorted(n for n in z.namelist()
+                               if n.lower().endswith('.csv')):
+                with z.open(name) as f:
+                    out.append((os.path.join(source, name),
+                                parse_header(f.readline())))
+    else:
+        for path in source:
+            with open(path, 'rb') as f:
+                out.append((path, parse_header(f.readline())))
+
+    return out
+
+
+def header_variants(sources):
+    """Group files by header.
+
+    :param sources: List of sources (see read_headers).
+
+    :returns: List of dictionaries, one per distinct header in order of
+        first appearance, with keys 'header', 'type' and 'columns' (see
+        resolve, None if it doesn't match), 'error' (why it doesn't
+        match, or None), 'files' (number of files), 'first' and 'last'
+        (file names).
+    """
+    variants = {}
+    for source in sources:
+        for path, header in read_headers(source):
+            key = tuple(header)
+            if key not in variants:
+                try:
+                    schema = resolve(header)
+                    info = {'type': schema['type'],
+                            'columns': list(schema['names'].values())[1:],
+                            'error': None}
+                except ValueError as e:
+                    info = {'type': None, 'columns': None, 'error': str(e)}
+                variants[key] = dict(header=header, files=0, first=path,
+                                     **info)
+            variants[key]['files'] += 1
+            variants[key]['last'] = path
+
+    return list(variants.values())
+
+
+def check_headers(sources, name=''):
+    """Check the headers of a dataset's files before reading them.
+
+    Raises ValueError if any header doesn't match a file type, or if
+    the files are of more than one type. Headers which match but give
+    different canonical columns (e.g. a zone appearing) are printed as
+    drift, since the combined data will have NaNs where columns are
+    missing.
+
+    :param sources: List of sources (see read_headers).
+    :param name: String. Name of the dataset for messages.
+
+    :returns: List from header_variants.
+    """
+    variants = header_variants(sources)
+    bad = [v for v in variants if v['error'] is not None]
+    if bad:
+        raise ValueError('{}: {} unknown header(s), first seen in:\n{}'
+                         .format(name, len(bad), '\n'.join(
+                             '  {}: {}'.format(v['first'], v['error'])
+                             for v in bad)))
+
+    types = {v['type'] for v in variants}
+    if len(types) > 1:
+        raise ValueError('{}: Files of several types: {}'.format(
+            name, ', '.join(sorted(types))))
+
+    columns = {tuple(v['columns']) for v in variants}
+    if len(columns) > 1:
+        print('{}: Schema drift, columns vary between files:'.format(name))
+        print_variants(variants)
+
+    return variants
+
+
+def print_variants(variants):
+    """Print the output of header_variants."""
+    for v in variants:
+        print('  {} file(s), {} to {}:'.format(v['files'], v['first'],
+                                               v['last']))
+        print('    Header: {}'.format(v['header']))
+        if v['error'] is None:
+            print('    Read as {}: {}'.format(v['type'], v['columns']))
+        else:
+            print('    {}'.format(v['error']))
+
+
+def main():
+    # Imported here as combine_nyiso_data imports this module.
+    from get_nyiso_data import all_datasets
+    from combine_nyiso_data import get_month_sources
+
+    for data_dir, *_ in all_datasets():
+        if not os.path.isdir(data_dir):
+            continue
+        print('*' * 80)
+        print(data_dir)
+        print_variants(header_variants(
+            [s for _, s in get_month_sources(data_dir)]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,534 @@
+"""Module to run the pipeline, rebuilding only what's out of date.
+
+The stages form a small graph:
+
+    get_nyiso_data -> combine_lmp_day_ahead  \\
+                   -> combine_lmp_realtime    \\
+                   -> combine_load_forecast    -> combine_all_data -> data_prep
+                   -> combine_load_realtime   /
+    (Weather_Data) -> clean_weather_data     /
+
+plus rollups (after the realtime combines), and the generator LMP
+stages (combine_lmp_day_ahead_gen and combine_lmp_realtime_gen), which
+like data_prep only run if asked for.
+
+Each stage has a key: a hash of its inputs' contents, the module
+constants it depends on (e.g. START_YEAR, TIMEZONE, NAN_THRESHOLD), and
+the source of the modules it runs. A stage is rebuilt if its key has
+changed since it last ran, or if its outputs are missing or have been
+changed by hand. Since a stage's key includes the contents of what the
+stages before it wrote, rebuilding a stage which produces the same
+output as before doesn't cause the stages after it to be rebuilt.
+
+File hashes are remembered by (size, modification time), so a run where
+nothing changed only has to stat the files. Stages whose inputs are
+ready are run at the same time (up to MAX_PARALLEL), each in its own
+process. Stage output goes to STATE_DIR/<stage>.log, and every stage's
+steps are recorded under one run id (see instrumentation.py):
+
+    python pipeline.py                  # Everything except data_prep.
+    python pipeline.py combine_all_data --skip get_nyiso_data
+    python pipeline.py --with data_prep --dry-run
+    python instrumentation.py           # Where the time went.
+
+Downloads can't be checked without downloading, so get_nyiso_data runs
+every time it's selected (it only fetches what changed, see
+get_nyiso_data.py). Use --skip get_nyiso_data to work offline.
+
+Parameters are read from the module constants, so change them in the
+modules as before.
+"""
+# Built-in:
+import argparse
+import ast
+import hashlib
+import importlib
+import json
+import os
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+# Imports from this project (also sets the run id for the stages):
+from instrumentation import RUN_ID_VAR
+
+# This directory, so stage processes can import the pipeline modules.
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+ML_DIR = os.path.join(REPO_DIR, 'machine_learning')
+
+# Where stage keys, remembered hashes, and stage logs are kept
+# (relative to the data directory, i.e. where the stages run).
+STATE_DIR = '.pipeline'
+STATE_FILE = 'state.json'
+HASH_FILE = 'hashes.json'
+
+# Maximum number of stages to run at once. The combine stages start
+# their own worker processes, so there's little point in going higher.
+MAX_PARALLEL = 3
+
+# Files which aren't considered part of a directory's contents. Stores'
+# sources.json files record file times, which change without the data
+# changing.
+IGNORE_FILES = ('manifest.json', 'sources.json')
+IGNORE_SUFFIXES = ('.tmp', '.log')
+
+# Bump to rebuild everything (e.g. if the hashing changes).
+VERSION = 1
+
+
+class Stage:
+    """One stage of the pipeline.
+
+    :param name: String. Stage name.
+    :param func: String. 'module:function' to run.
+    :param deps: List of stage names which must run first.
+    :param inputs: List of file/directory paths read, or a function
+        returning them (called once the stage's dependencies are done).
+    :param outputs: List of file/directory paths written.
+    :param params: List of 'module.CONSTANT' names the stage depends on.
+    :param volatile: Boolean. Always run the stage.
+    :param opt_in: Boolean. Only run the stage if asked for by name
+        (see run).
+    """
+
+    def __init__(self, name, func, deps=(), inputs=(), outputs=(),
+                 params=(), volatile=False, opt_in=False):
+        self.name = name
+        self.func = func
+        self.deps = list(deps)
+        self.inputs = inputs
+        self.outputs = list(outputs)
+        self.params = list(params)
+        self.volatile = volatile
+        self.opt_in = opt_in
+
+    @property
+    def module(self):
+        return self.func.partition(':')[0]
+
+    def input_paths(self):
+        return list(self.inputs() if callable(self.inputs) else self.inputs)
+
+
+def get_stages():
+    """Build the list of stages, in an order they can be run in."""
+    # Imported here since they're slow to import, and so the stages are
+    # built from the constants as they currently are.
+    import get_nyiso_data as g
+    import combine_nyiso_data as c
+    import clean_weather_data as w
+    import combine_all_data as a
+    import rollups as r
+
+    years = ['get_nyiso_data.START_YEAR', 'get_nyiso_data.END_YEAR',
+             'get_nyiso_data.START_MONTH', 'get_nyiso_data.END_MONTH']
+    nyiso = years + ['combine_nyiso_data.TIMEZONE',
+                     'combine_nyiso_data.FROM_ZIP',
+                     'nyiso_schema.SCHEMAS',
+                     'nyiso_schema.VALUE_DTYPE',
+                     'combine_nyiso_data.TIME_FORMATS',
+                     'combine_nyiso_data.EXPORT_CSV']
+
+    stages = [Stage('get_nyiso_data', 'get_nyiso_data:main',
+                    outputs=[d[0] for d in g.all_datasets()],
+                    params=years + ['get_nyiso_data.DATASETS',
+                                    'get_nyiso_data.GEN_DATASETS',
+                                    'get_nyiso_data.GET_GEN',
+                                    'get_nyiso_data.KEEP_ZIP'],
+                    volatile=True)]
+
+    for name, raw, stores in (
+            ('combine_lmp_day_ahead', g.LMP_DAY_AHEAD_ZONAL,
+             [c.LMP_DAY_AHEAD_STORE]),
+            ('combine_lmp_realtime', g.LMP_REALTIME_ZONAL,
+             [c.LMP_REALTIME_STORE]),
+            ('combine_load_forecast', g.LOAD_FORECAST,
+             [c.LOAD_FORECAST_STORE, c.LOAD_FORECAST_VINTAGES_STORE]),
+            ('combine_load_realtime', g.LOAD_REALTIME,
+             [c.LOAD_REALTIME_STORE])):
+        stages.append(Stage(name, 'combine_nyiso_data:' + name,
+                            deps=['get_nyiso_data'], inputs=[raw],
+                            outputs=stores, params=nyiso))
+
+    # Generator LMPs aren't used downstream (yet), and need GET_GEN.
+    for name, raw, store in (
+            ('combine_lmp_day_ahead_gen', g.LMP_DAY_AHEAD_GEN,
+             c.LMP_DAY_AHEAD_GEN_STORE),
+            ('combine_lmp_realtime_gen', g.LMP_REALTIME_GEN,
+             c.LMP_REALTIME_GEN_STORE)):
+        stages.append(Stage(name, 'combine_nyiso_data:' + name,
+                            deps=['get_nyiso_data'], inputs=[raw],
+                            outputs=[store], params=nyiso, opt_in=True))
+
+    stages.append(Stage(
+        'clean_weather_data', 'clean_weather_data:main',
+        inputs=[w.WEATHER_DIR],
+        outputs=[w.OUT_STORE] + ([w.MASK_STORE] if w.FILL_GAPS else []),
+        params=['clean_weather_data.' + p for p in (
+            'ZONES', 'COLUMNS', 'TIMEZONE', 'NAN_THRESHOLD', 'FILL_GAPS',
+            'MAX_INTERPOLATE', 'FILL_LAGS', 'ZONE_NEIGHBORS',
+            'EXPORT_CSV')]))
+
+    stages.append(Stage(
+        'combine_all_data', 'combine_all_data:main',
+        deps=[s.name for s in stages[1:] if not s.opt_in],
+        inputs=[store for _, store, _ in a.INPUTS],
+        outputs=[a.OUT_STORE],
+        params=['combine_all_data.' + p for p in (
+            'START_YEAR', 'END_YEAR', 'INPUTS', 'ZONE_NAMES',
+            'EXPORT_CSV')]))
+
+    # Months whose source data didn't change are skipped by rollups
+    # itself, so it's cheap to re-run.
+    stages.append(Stage(
+        'rollups', 'rollups:main',
+        deps=['combine_lmp_realtime', 'combine_load_realtime'],
+        inputs=list(r.SOURCES.values()),
+        outputs=[r.rollup_store(n, res) for n in r.SOURCES
+                 for res in r.RESOLUTIONS],
+        params=['rollups.' + p for p in (
+            'SOURCES', 'RESOLUTIONS', 'STATS', 'TOTAL_NAME')]))
+
+    stages.append(Stage(
+        'data_prep', 'pipeline:run_data_prep', deps=['combine_all_data'],
+        inputs=[a.OUT_STORE, os.path.join(ML_DIR, 'data_prep.ipynb'),
+                os.path.join(ML_DIR, 'dataset.py')],
+        outputs=[os.path.join(ML_DIR, 'dataset')], opt_in=True))
+
+    return stages
+
+
+def run_data_prep():
+    """Run the data_prep notebook, which reads all_data from its store
+    (see combine_all_data.OUT_STORE).
+    """
+    # The executed copy (with outputs) goes in STATE_DIR, leaving the
+    # notebook itself alone. Notebooks are run from their directory.
+    subprocess.run(['jupyter', 'nbconvert', '--to', 'notebook', '--execute',
+                    '--ExecutePreprocessor.timeout=-1',
+                    '--output-dir', os.path.abspath(STATE_DIR),
+                    os.path.join(ML_DIR, 'data_prep.ipynb')], check=True)
+
+
+class HashCache:
+    """Content hashes of files, remembered by (size, modification
+    time) so unchanged files aren't read again.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.hashes = read_json(path, {})
+        self.changed = False
+
+    def file_hash(self, path):
+        st = os.stat(path)
+        key = os.path.abspath(path)
+        known = self.hashes.get(key)
+        if known is not None and known[:2] == [st.st_size, st.st_mtime_ns]:
+            return known[2]
+
+        h = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(2**20), b''):
+                h.update(block)
+        digest = h.hexdigest()
+        self.hashes[key] = [st.st_size, st.st_mtime_ns, digest]
+        self.changed = True
+        return digest
+
+    def path_hash(self, path):
+        """Hash of a file, or of every file in a directory (with their
+        relative paths). None if the path doesn't exist.
+        """
+        if os.path.isfile(path):
+            return self.file_hash(path)
+        if not os.path.isdir(path):
+            return None
+
+        h = hashlib.sha256()
+        for d, dirs, files in os.walk(path):
+            dirs.sort()
+            for f in sorted(files):
+                if f in IGNORE_FILES or f.endswith(IGNORE_SUFFIXES):
+                    continue
+                full = os.path.join(d, f)
+                h.update(os.path.relpath(full, path).encode())
+                h.update(self.file_hash(full).encode())
+        return h.hexdigest()
+
+    def save(self):
+        if self.changed:
+            write_json(self.path, self.hashes)
+            self.changed = False
+
+
+def read_json(path, default):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return default
+
+
+def write_json(path, obj):
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(obj, f, indent=1, sort_keys=True)
+    os.replace(tmp, path)
+
+
+def local_sources(module):
+    """Source files of a module and of the modules in this directory it
+    imports (directly or not).
+    """
+    seen = set()
+    todo = [module]
+    while todo:
+        name = todo.pop()
+        path = os.path.join(REPO_DIR, name + '.py')
+        if name in seen or not os.path.isfile(path):
+            continue
+        seen.add(name)
+        with open(path) as f:
+            tree = ast.parse(f.read(), path)
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                todo.extend(a.name for a in node.names)
+            elif isinstance(node, ast.ImportFrom) and node.module:
+                todo.append(node.module)
+
+    return sorted(os.path.join(REPO_DIR, n + '.py') for n in seen)
+
+
+def param_values(params):
+    """Current values of 'module.CONSTANT' names, as strings."""
+    out = {}
+    for p in params:
+        module, _, name = p.rpartition('.')
+        out[p] = repr(getattr(importlib.import_module(module), name))
+    return out
+
+
+def stage_key(stage, cache):
+    """Hash everything a stage's output depends on (see module
+    docstring).
+    """
+    inputs = {p: cache.path_hash(p) for p in stage.input_paths()}
+    missing = [p for p, h in inputs.items() if h is None]
+    if missing:
+        raise UserWarning('Stage {} is missing inputs: {}'.format(
+            stage.name, ', '.join(missing)))
+
+    key = {'version': VERSION,
+           'func': stage.func,
+           'sources': {os.path.basename(p): cache.file_hash(p)
+                       for p in local_sources(stage.module)},
+           'params': param_values(stage.params),
+           'inputs': inputs}
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode()) \
+        .hexdigest()
+
+
+def output_hashes(stage, cache):
+    return {p: cache.path_hash(p) for p in stage.outputs}
+
+
+def why_stale(stage, key, state, cache):
+    """Reason a stage needs to run, or None if it's up to date."""
+    if stage.volatile:
+        return 'always runs'
+
+    last = state.get(stage.name)
+    if last is None:
+        return 'never run'
+    if last['key'] != key:
+        return 'inputs, parameters, or code changed'
+
+    for p, h in output_hashes(stage, cache).items():
+        if h is None:
+            return '{} is missing'.format(p)
+        if h != last['outputs'].get(p):
+            return '{} was changed'.format(p)
+
+    return None
+
+
+def select(stages, targets=None, opt_in=()):
+    """Names of the stages needed to build targets.
+
+    :param targets: List of stage names. Defaults to every stage which
+        isn't opt-in, plus those named in opt_in.
+    :param opt_in: List of opt-in stage names to include.
+    """
+    by_name = {s.name: s for s in stages}
+    unknown = set(targets or ()) | set(opt_in)
+    unknown -= set(by_name)
+    if unknown:
+        raise UserWarning('Unknown stages: {}'.format(', '.join(unknown)))
+
+    if targets is None:
+        targets = [s.name for s in stages
+                   if not s.opt_in or s.name in opt_in]
+
+    selected = set()
+    todo = list(targets)
+    while todo:
+        name = todo.pop()
+        if name not in selected:
+            selected.add(name)
+            todo.extend(by_name[name].deps)
+
+    return selected
+
+
+def start_stage(stage, log_file):
+    """Run a stage in a fresh process from the current directory.
+    Returns the process' exit code.
+    """
+    module, _, func = stage.func.partition(':')
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [REPO_DIR] + [p for p in [env.get('PYTHONPATH')] if p])
+    code = 'import {0}; {0}.{1}()'.format(module, func)
+
+    with open(log_file, 'w') as log:
+        return subprocess.run([sys.executable, '-c', code], env=env,
+                              stdout=log, stderr=subprocess.STDOUT).returncode
+
+
+def run(targets=None, opt_in=(), force=(), skip=(), dry_run=False,
+        max_parallel=MAX_PARALLEL):
+    """Bring the targets up to date.
+
+    :param targets: List of stage names (see select).
+    :param opt_in: List of opt-in stage names to include (see select).
+    :param force: List of stage names to run even if up to date.
+    :param skip: List of stage names to not run; their outputs are used
+        as they are.
+    :param dry_run: Boolean. Only print what would run (assuming the
+        stages before it change their outputs).
+    :param max_parallel: Integer. Maximum number of stages to run at
+        once.
+
+    :returns: Dictionary mapping stage name to what happened: 'ran',
+        'up to date', 'skipped', 'failed', or 'blocked' (a stage it
+        depends on failed).
+    """
+    stages = get_stages()
+    by_name = {s.name: s for s in stages}
+    selected = select(stages, targets, opt_in)
+
+    os.makedirs(STATE_DIR, exist_ok=True)
+    state_file = os.path.join(STATE_DIR, STATE_FILE)
+    state = read_json(state_file, {})
+    cache = HashCache(os.path.join(STATE_DIR, HASH_FILE))
+
+    print('Run {}'.format(os.environ[RUN_ID_VAR]), flush=True)
+
+    status = {}
+    # Stages which would run in a dry run.
+    planned = set()
+    pending = [s.name for s in stages if s.name in selected]
+    running = {}
+    t0 = time.perf_counter()
+
+    with ThreadPoolExecutor(max_workers=max_parallel) as pool:
+        while pending or running:
+            for name in list(pending):
+                s = by_name[name]
+                deps = [d for d in s.deps if d in selected]
+                if any(status.get(d) in ('failed', 'blocked') for d in deps):
+                    status[name] = 'blocked'
+                    pending.remove(name)
+                    print('{}: blocked'.format(name), flush=True)
+                    continue
+                if not all(d in status for d in deps):
+                    continue
+                pending.remove(name)
+
+                if name in skip:
+                    status[name] = 'skipped'
+                    continue
+
+                if dry_run and any(d in planned for d in deps):
+                    # Inputs will (probably) change.
+                    reason = 'inputs will change'
+                else:
+                    try:
+                        key = stage_key(s, cache)
+                    except UserWarning as e:
+                        if not dry_run:
+                            raise
+                        key, reason = None, str(e)
+                    else:
+                        reason = why_stale(s, key, state, cache)
+                    if name in force:
+                        reason = 'forced'
+
+                if reason is None:
+                    status[name] = 'up to date'
+                    print('{}: up to date'.format(name), flush=True)
+                elif dry_run:
+                    status[name] = 'would run'
+                    planned.add(name)
+                    print('{}: would run ({})'.format(name, reason),
+                          flush=True)
+                else:
+                    log_file = os.path.join(STATE_DIR, name + '.log')
+                    print('{}: out of date ({}), log in {}'.format(
+                        name, reason, log_file), flush=True)
+                    future = pool.submit(start_stage, s, log_file)
+                    running[future] = (name, key, time.perf_counter())
+
+            cache.save()
+            if not running:
+                continue
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name, key, start = running.pop(future)
+                seconds = time.perf_counter() - start
+                if future.result() != 0:
+                    status[name] = 'failed'
+                    print('{}: FAILED after {:.1f} s, see {}'.format(
+                        name, seconds, os.path.join(STATE_DIR, name + '.log')),
+                        flush=True)
+                    continue
+
+                status[name] = 'ran'
+                state[name] = {'key': key, 'time': time.strftime(
+                    '%Y-%m-%dT%H:%M:%S'), 'outputs': output_hashes(
+                    by_name[name], cache)}
+                write_json(state_file, state)
+                print('{}: done in {:.1f} s'.format(name, seconds),
+                      flush=True)
+
+    cache.save()
+    print('Finished in {:.1f} s'.format(time.perf_counter() - t0))
+    return status
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('targets', nargs='*',
+                        help='Stages to bring up to date (default all).')
+    parser.add_argument('--with', dest='opt_in', nargs='+', default=[],
+                        help='Opt-in stages to include, e.g. data_prep.')
+    parser.add_argument('--force', nargs='+', default=[],
+                        help='Stages to run even if up to date.')
+    parser.add_argument('--skip', nargs='+', default=[],
+                        help='Stages to not run, e.g. get_nyiso_data.')
+    parser.add_argument('--dry-run', action='store_true')
+    parser.add_argument('--jobs', type=int, default=MAX_PARALLEL,
+                        help='Maximum number of stages to run at once.')
+    args = parser.parse_args(argv)
+
+    status = run(targets=args.targets or None, opt_in=args.opt_in,
+                 force=args.force, skip=args.skip, dry_run=args.dry_run,
+                 max_parallel=args.jobs)
+    return int(any(s in ('failed', 'blocked') for s in status.values()))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,250 @@
+"""Module to serve recorded NYISO files as if they were being published
+live, for testing live_ingest.py without NYISO.
+
+The files are those downloaded by get_nyiso_data.py (or made by
+synthetic_data.py), either extracted or in monthly archives. They're
+served at the paths of NYISO's daily files (see nyiso_url with
+daily=True), on a replay clock which starts at a given local time and
+runs SPEED times faster than real time:
+
+    - The real-time files (realtime, pal) only hold the intervals up to
+        the replay time, so they grow through the day as NYISO's do.
+    - Other files appear whole once they'd have been published (see
+        PUBLISH): the day-ahead LMPs the morning before their day, and
+        the load forecast early on its first day.
+    - Files which aren't out yet are 404s.
+
+Each response has an ETag, and a request with a matching If-None-Match
+gets a 304, as from NYISO. GET /clock returns the replay time.
+
+The recording is read from root (the working directory by default), and
+is never written to. Whatever polls the replay must keep its files
+elsewhere (live_ingest.py does, see its REPLAY_ROOT): the replayed
+files are partial, and saved over the recording would cut it short.
+
+Usage:
+    python replay_server.py 2018-11-05T06:00 60 [port] [root]
+
+or, e.g. in a test:
+    server = start_server('2018-11-05T06:00', speed=60, port=0)
+    ...
+    server.shutdown()
+"""
+# Third-party:
+import pandas as pd
+
+# Standard library:
+import hashlib
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+from zipfile import ZipFile
+
+# Imports from get_nyiso_data.py
+from get_nyiso_data import all_datasets, nyiso_url, get_date_str, \
+    archive_path
+
+# Imports from combine_nyiso_data.py
+from combine_nyiso_data import TIMEZONE, LOAD_FORECAST_PUBLISH, parse_times
+
+# Replay speed (replay seconds per real second), and the port to serve
+# on.
+SPEED = 60
+PORT = 8000
+
+# When each kind of daily file (by its URL's middle part, see nyiso_url)
+# is published whole, relative to the start of its day. Kinds which
+# aren't listed are real-time, and grow interval by interval. The load
+# forecasts come out when the vintages store takes them to be issued.
+PUBLISH = {'damlbmp': pd.Timedelta(hours=-13),
+           'isolf': LOAD_FORECAST_PUBLISH}
+
+
+class ReplayClock:
+    """Local time on the replay, starting at start and running speed
+    times faster than real time.
+    """
+
+    def __init__(self, start, speed=SPEED):
+        start = pd.Timestamp(start)
+        if start.tz is None:
+            start = start.tz_localize(TIMEZONE)
+        self.start = start.tz_convert(TIMEZONE)
+        self.speed = speed
+        self._t0 = time.monotonic()
+
+    def now(self):
+        return self.start + pd.Timedelta(
+            seconds=(time.monotonic() - self._t0) * self.speed)
+
+
+def file_kinds(root='.'):
+    """Map the ending of each daily file name (after the date, e.g.
+    'realtime_zone.csv') to (data directory, kind), for every dataset
+    get_nyiso_data downloads.
+    """
+    kinds = {}
+    for data_dir, data_type, day_ahead, zonal in all_datasets():
+        url = nyiso_url(data_type=data_type, day_ahead=day_ahead,
+                        date_str='', zonal=zonal, daily=True)
+        kind = url.rstrip('/').split('/')[-2]
+        kinds[url.rsplit('/', 1)[-1]] = (os.path.join(root, data_dir), kind)
+
+    return kinds
+
+
+def read_recorded(data_dir, name):
+    """Read a recorded daily file, from its month's directory or
+    archive. Returns None if it wasn't recorded.
+    """
+    month = get_date_str(year=int(name[:4]), month=int(name[4:6]))
+    path = os.path.join(data_dir, month, name)
+    if os.path.isfile(path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    path = archive_path(data_dir, month)
+    if os.path.isfile(path):
+        with ZipFile(path) as z:
+            if name in z.namelist():
+                return z.read(name)
+
+    return None
+
+
+class Replay:
+    """The recorded files and the replay clock (see module docstring).
+
+    :param clock: ReplayClock.
+    :param root: String. Directory the data directories are in.
+    """
+
+    def __init__(self, clock, root='.'):
+        self.clock = clock
+        self.kinds = file_kinds(root)
+        self._files = {}
+        self._lock = threading.Lock()
+
+    def lines(self, name):
+        """Split a recorded file into (lines, times): its lines (header
+        first) and the (naive, local) time of each line after the
+        header. Cached. None if it wasn't recorded.
+        """
+        with self._lock:
+            if name not in self._files:
+                data_dir, _ = self.kinds[name[8:]]
+                content = read_recorded(data_dir, name)
+                if content is None:
+                    self._files[name] = None
+                else:
+                    lines = content.splitlines(keepends=True)
+                    times = pd.Series([l.split(b',', 1)[0].strip(b'"\r\n ')
+                                       .decode() for l in lines[1:]])
+                    self._files[name] = (lines, parse_times(times))
+            return self._files[name]
+
+    def content(self, name):
+        """What a daily file holds at the replay time, or None if it
+        isn't out yet (or wasn't recorded).
+        """
+        if len(name) < 9 or name[8:] not in self.kinds \
+                or not name[:8].isdigit():
+            return None
+
+        now = self.clock.now()
+        day = pd.Timestamp(name[:8])
+        kind = self.kinds[name[8:]][1]
+        if kind in PUBLISH:
+            # Local (wall clock) publish time, as for the vintages.
+            if now < (day + PUBLISH[kind]).tz_localize(TIMEZONE):
+                return None
+            cutoff = None
+        else:
+            if now < day.tz_localize(TIMEZONE):
+                return None
+            cutoff = now.tz_localize(None)
+
+        recorded = self.lines(name)
+        if recorded is None:
+            return None
+        lines, times = recorded
+        if cutoff is None:
+            return b''.join(lines)
+
+        keep = (times <= cutoff).sum()
+        return b''.join(lines[:1 + keep])
+
+
+class ReplayHandler(BaseHTTPRequestHandler):
+    """Serve a Replay (set as the server's replay attribute)."""
+
+    def do_GET(self):
+        replay = self.server.replay
+        parts = [p for p in urlsplit(self.path).path.split('/') if p]
+
+        if parts == ['clock']:
+            body = replay.clock.now().isoformat().encode()
+        else:
+            body = replay.content(parts[-1]) if len(parts) == 2 else None
+            if body is None:
+                self.send_error(404)
+                return
+
+        etag = '"{}"'.format(hashlib.sha256(body).hexdigest()[:32])
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/csv')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Polling is chatty. Only log errors.
+        pass
+
+
+def start_server(start, speed=SPEED, port=PORT, host='127.0.0.1', root='.'):
+    """Serve a replay from a background thread.
+
+    :param start: Local time to start the replay at (Timestamp or
+        string).
+    :param speed: Float. Replay seconds per real second.
+    :param port: Integer. 0 picks a free port (see server_address).
+    :param host: String. Address to listen on.
+    :param root: String. Directory the data directories are in.
+
+    :returns: The ThreadingHTTPServer. Its base URL is
+        'http://{}:{}'.format(*server.server_address), and shutdown()
+        stops it.
+    """
+    server = ThreadingHTTPServer((host, port), ReplayHandler)
+    server.replay = Replay(ReplayClock(start, speed=speed), root=root)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main(start, speed=SPEED, port=PORT, root='.'):
+    server = start_server(start, speed=speed, port=port, root=root)
+    print('Replaying from {} at {}x on http://{}:{}'.format(
+        server.replay.clock.start, speed, *server.server_address),
+        flush=True)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1], speed=float(sys.argv[2]) if len(sys.argv) > 2
+         else SPEED, port=int(sys.argv[3]) if len(sys.argv) > 3 else PORT,
+         root=sys.argv[4] if len(sys.argv) > 4 else '.')
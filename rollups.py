@@ -0,0 +1,392 @@
+"""Module to pre-aggregate the 5 minute realtime data to hourly and daily.
+
+Hourly studies shouldn't have to scan (and forward fill the hourly data
+to match) tens of millions of 5 minute cells. Instead, run this after
+combine_nyiso_data.py to write hourly and daily rollups of the realtime
+LMP and load data. Each rollup holds, for every column of its source:
+    - mean, min, max: Of the 5 minute values in the period, ignoring
+        NaNs.
+    - last: The last non-NaN value in the period.
+The LMP rollups also have the load weighted price (load_weighted) of
+each price component for each zone with load data, plus the whole of
+NYISO (Name 'NYISO').
+
+Rollups are month-partitioned stores (see columnar_store.py) with
+(stat, component, Name) columns, labeled by the start of each period.
+Hours are real (UTC) hours, so the repeated hour when daylight saving
+ends is two rows; days are local days.
+
+Each rollup remembers a fingerprint of the source rows behind each
+month, so re-running only recomputes months whose source data changed.
+
+Use read_rollup to read data at any resolution, including the original
+5 minutes, or load_hourly for everything at its native hourly
+resolution:
+
+    df = read_rollup('lmp_realtime', 'hourly', stats=['mean'],
+                     start='2018-07-01', end='2018-08-01')
+"""
+# Third-party:
+import numpy as np
+import pandas as pd
+
+# Standard library:
+import hashlib
+import json
+import os
+import shutil
+
+# Imports from this project:
+from combine_nyiso_data import LMP_DAY_AHEAD_STORE, LMP_REALTIME_STORE, \
+    LOAD_FORECAST_STORE, LOAD_REALTIME_STORE
+from columnar_store import read_frame, write_partitioned, open_columns, \
+    column_labels, month_rows, fingerprint, read_sources, write_sources
+from instrumentation import stage, step, count_read
+
+# Data to roll up: name -> source store.
+SOURCES = {'lmp_realtime': LMP_REALTIME_STORE,
+           'load_realtime': LOAD_REALTIME_STORE}
+
+# Resolutions to roll up to: name -> period length.
+RESOLUTIONS = {'hourly': pd.Timedelta(hours=1),
+               'daily': pd.Timedelta(days=1)}
+
+# Resolution name for the source data itself (see read_rollup).
+NATIVE = '5min'
+
+STATS = ('mean', 'min', 'max', 'last')
+LOAD_WEIGHTED = 'load_weighted'
+
+# Name used for the NYISO-wide load weighted price.
+TOTAL_NAME = 'NYISO'
+
+# Bump to rebuild every rollup (e.g. if the stats change).
+VERSION = 1
+
+
+def rollup_store(name, resolution):
+    """Path of the store for a rollup, e.g. lmp_realtime_hourly.store."""
+    return '{}_{}.store'.format(name, resolution)
+
+
+def read_rows(path, first, last):
+    """Read rows [first, last) of a (plain) store as (index values,
+    float64 array of shape (rows, columns)).
+    """
+    _, index_values, arrays = open_columns(path)
+    values = np.empty((last - first, len(arrays)))
+    for i, a in enumerate(arrays.values()):
+        values[:, i] = a[first:last]
+
+    count_read(rows=last - first, nbytes=(last - first) * (
+        8 + sum(a.itemsize for a in arrays.values())), files=path)
+    return np.array(index_values[first:last]), values
+
+
+def period_starts(index_values, tz, period):
+    """Find the periods (e.g. hours) a sorted index falls in.
+
+    :param index_values: int64 nanoseconds (UTC), sorted.
+    :param tz: String. Time zone of the data.
+    :param period: Timedelta. Periods of a day or more are local days;
+        shorter periods are counted in UTC.
+
+    :returns: Tuple (labels, starts): a DatetimeIndex with the start of
+        each period present, and the row where each period starts.
+    """
+    index = pd.DatetimeIndex(index_values.view('M8[ns]')).tz_localize('UTC')
+    step = period.value
+    if period >= pd.Timedelta(days=1):
+        local = index.tz_convert(tz).tz_localize(None).asi8
+        periods = local // step
+        labels = pd.DatetimeIndex(
+            np.unique(periods) * step).tz_localize(tz)
+    else:
+        periods = index_values // step
+        labels = pd.DatetimeIndex(
+            np.unique(periods) * step).tz_localize('UTC').tz_convert(tz)
+
+    starts = np.flatnonzero(np.diff(periods, prepend=periods[0] - 1))
+    return labels, starts
+
+
+def aggregate(values, starts):
+    """Compute STATS of each period's rows, ignoring NaNs.
+
+    :param values: 2-D float array, shape (rows, columns).
+    :param starts: Row where each period starts (see period_starts).
+
+    :returns: Dictionary mapping stat to an array of shape (periods,
+        columns). Periods with no data are NaN.
+    """
+    valid = ~np.isnan(values)
+    count = np.add.reduceat(valid.astype(np.int32), starts, axis=0)
+    empty = count == 0
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.add.reduceat(np.where(valid, values, 0), starts,
+                               axis=0) / count
+    lo = np.minimum.reduceat(np.where(valid, values, np.inf), starts, axis=0)
+    hi = np.maximum.reduceat(np.where(valid, values, -np.inf), starts,
+                             axis=0)
+
+    # Row of the last non-NaN value in each period.
+    rows = np.arange(len(values))[:, np.newaxis]
+    pos = np.maximum.reduceat(np.where(valid, rows, -1), starts, axis=0)
+    last = values[np.maximum(pos, 0), np.arange(values.shape[1])]
+
+    out = {'mean': mean, 'min': lo, 'max': hi, 'last': last}
+    for a in out.values():
+        a[empty] = np.nan
+    return out
+
+
+def load_weighted(prices, loads, starts, pairs, groups, n_groups):
+    """Load weighted prices of each period.
+
+    :param prices: 2-D array of prices, shape (rows, price columns).
+    :param loads: 2-D array of loads, same rows as prices.
+    :param starts: Row where each period starts (see period_starts).
+    :param pairs: List of (price column, load column) to weight.
+    :param groups: Integer array, the group (e.g. price component) of
+        each pair. Each group also gets a total over all its pairs.
+    :param n_groups: Integer. Number of groups.
+
+    :returns: Tuple (per pair, per group) of arrays with a row per
+        period.
+    """
+    p = prices[:, [a for a, _ in pairs]]
+    w = loads[:, [b for _, b in pairs]]
+    ok = ~(np.isnan(p) | np.isnan(w))
+    num = np.add.reduceat(np.where(ok, p * w, 0), starts, axis=0)
+    den = np.add.reduceat(np.where(ok, w, 0), starts, axis=0)
+
+    num_total = np.zeros((len(starts), n_groups))
+    den_total = np.zeros((len(starts), n_groups))
+    np.add.at(num_total.T, groups, num.T)
+    np.add.at(den_total.T, groups, den.T)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return num / den, num_total / den_total
+
+
+def weight_pairs(lmp_columns, load_columns):
+    """Match LMP columns to the load column of the same zone.
+
+    :returns: Tuple (pairs, groups, labels): (LMP column, load column)
+        positions, the component number of each pair, and the
+        (component, Name) labels of the outputs (per pair, then per
+        component total).
+    """
+    loads = {name: i for i, (_, name) in enumerate(load_columns)}
+    components = list(dict.fromkeys(c for c, _ in lmp_columns))
+
+    pairs, groups, labels = [], [], []
+    for i, (component, name) in enumerate(lmp_columns):
+        if name in loads:
+            pairs.append((i, loads[name]))
+            groups.append(components.index(component))
+            labels.append((component, name))
+
+    labels += [(c, TOTAL_NAME) for c in components]
+    return pairs, np.array(groups, dtype=int), labels
+
+
+def rollup_frames(labels, stats, columns, extra=None):
+    """Build a rollup DataFrame with (stat, component, Name) columns.
+
+    :param labels: DatetimeIndex of period starts.
+    :param stats: Dictionary from aggregate.
+    :param columns: (component, Name) labels of the source columns.
+    :param extra: Optional list of (stat, labels, array) to add.
+    """
+    keys = []
+    blocks = []
+    for stat in STATS:
+        keys.extend((stat,) + c for c in columns)
+        blocks.append(stats[stat])
+    for stat, cols, a in extra or []:
+        keys.extend((stat,) + c for c in cols)
+        blocks.append(a)
+
+    df = pd.DataFrame(np.hstack(blocks).astype(np.float32), index=labels)
+    df.columns = pd.MultiIndex.from_tuples(keys, names=['stat', None, 'Name'])
+    df.index.name = 'Time Stamp'
+    return df
+
+
+def rollup_month(lmp, load, tz, lmp_columns, load_columns, pairs, groups,
+                 weighted_labels):
+    """Roll up one month to every resolution.
+
+    :param lmp: Tuple (index values, values) from read_rows.
+    :param load: Like lmp, for the load.
+    :param tz: String. Time zone of the data.
+
+    Other inputs are column labels and weight_pairs outputs.
+
+    :returns: Dictionary mapping (source name, resolution) to
+        DataFrame.
+    """
+    lmp_t, lmp_values = lmp
+    load_t, load_values = load
+
+    # Line the load up with the LMP times.
+    pos = np.minimum(np.searchsorted(load_t, lmp_t), max(len(load_t) - 1, 0))
+    match = (load_t[pos] == lmp_t) if len(load_t) else \
+        np.zeros(len(lmp_t), dtype=bool)
+    weights = np.full((len(lmp_t), load_values.shape[1]), np.nan)
+    weights[match] = load_values[pos[match]]
+
+    out = {}
+    for resolution, period in RESOLUTIONS.items():
+        if len(lmp_t):
+            labels, starts = period_starts(lmp_t, tz, period)
+            per_pair, per_group = load_weighted(
+                lmp_values, weights, starts, pairs, groups,
+                n_groups=len(weighted_labels) - len(pairs))
+            out[('lmp_realtime', resolution)] = rollup_frames(
+                labels, aggregate(lmp_values, starts), lmp_columns,
+                extra=[(LOAD_WEIGHTED, weighted_labels,
+                        np.hstack([per_pair, per_group]))])
+        if len(load_t):
+            labels, starts = period_starts(load_t, tz, period)
+            out[('load_realtime', resolution)] = rollup_frames(
+                labels, aggregate(load_values, starts), load_columns)
+
+    return out
+
+
+@stage('rollups')
+def main(force=False):
+    """Bring the rollups up to date.
+
+    :param force: Boolean. Rebuild every month, not just those whose
+        source data changed.
+    """
+    lmp_path = SOURCES['lmp_realtime']
+    load_path = SOURCES['load_realtime']
+    for path in (lmp_path, load_path):
+        if not os.path.exists(path):
+            raise ValueError('{} does not exist. Run the combine stages '
+                             'first (see combine_nyiso_data.py).'
+                             .format(path))
+    lmp_columns = column_labels(lmp_path)
+    load_columns = column_labels(load_path)
+    pairs, groups, weighted_labels = weight_pairs(lmp_columns, load_columns)
+
+    with step('fingerprint'):
+        meta, lmp_months = month_rows(lmp_path)
+        _, load_months = month_rows(load_path)
+        if not load_months:
+            raise ValueError('{} has no data to weight {} by.'.format(
+                load_path, lmp_path))
+        # Months without load data read no rows of some load month.
+        no_load = (load_months[0][1], 0, 0)
+        load_months = {k: (p, a, b) for k, p, a, b in load_months}
+        keys = [k for k, _, _, _ in lmp_months]
+        if set(load_months) - set(keys):
+            raise UserWarning('{} has months {} does not.'.format(
+                load_path, lmp_path))
+
+        months = {}
+        for key, p, a, b in lmp_months:
+            months[key] = fingerprint(p, a, b) \
+                + fingerprint(*load_months.get(key, no_load))
+
+    # Anything which changes every month's output means a rebuild.
+    layout = hashlib.sha256(json.dumps(
+        [VERSION, STATS, [str(p) for p in RESOLUTIONS.values()],
+         [list(c) for c in lmp_columns], [list(c) for c in load_columns]])
+        .encode()).hexdigest()
+
+    stores = [(name, resolution, rollup_store(name, resolution))
+              for name in SOURCES for resolution in RESOLUTIONS]
+    done = {}
+    for _, _, path in stores:
+        sources = read_sources(path)
+        if force or sources is None or sources['layout'] != layout \
+                or set(sources['months']) - set(months):
+            if os.path.exists(path):
+                shutil.rmtree(path)
+            sources = {'layout': layout, 'months': {}}
+        done[path] = sources
+
+    todo = [(key, p, a, b) for key, p, a, b in lmp_months
+            if any(done[p]['months'].get(key) != months[key]
+                   for _, _, p in stores)]
+    print('Rolling up {} of {} months.'.format(len(todo), len(lmp_months)),
+          flush=True)
+
+    for key, p, a, b in todo:
+        with step('month') as s:
+            s.note(month=key)
+            with step('read'):
+                lmp = read_rows(p, a, b)
+                load = read_rows(*load_months.get(key, no_load))
+
+            with step('aggregate'):
+                frames = rollup_month(lmp, load, meta['index']['tz'],
+                                      lmp_columns, load_columns, pairs,
+                                      groups, weighted_labels)
+
+            with step('write'):
+                for name, resolution, path in stores:
+                    df = frames.get((name, resolution))
+                    if df is not None:
+                        write_partitioned(df, path, update=True)
+                    os.makedirs(path, exist_ok=True)
+                    done[path]['months'][key] = months[key]
+                    write_sources(path, done[path])
+
+
+def read_rollup(name, resolution='hourly', stats=None, start=None,
+                end=None):
+    """Read realtime data at a given resolution.
+
+    :param name: String. Key of SOURCES, e.g. 'lmp_realtime'.
+    :param resolution: String. Key of RESOLUTIONS, or NATIVE for the
+        original 5 minute data.
+    :param stats: List of stats (see STATS and LOAD_WEIGHTED) to read,
+        or None for all of them. Ignored for NATIVE.
+    :param start: See columnar_store.read_frame.
+    :param end: See columnar_store.read_frame.
+    """
+    if resolution == NATIVE:
+        return read_frame(SOURCES[name], start=start, end=end)
+
+    if resolution not in RESOLUTIONS:
+        raise ValueError('Unknown resolution {}.'.format(resolution))
+
+    return read_frame(rollup_store(name, resolution), columns=stats,
+                      start=start, end=end)
+
+
+def load_hourly(start=None, end=None, stat='mean'):
+    """Load the NYISO data at an hourly resolution, without resampling
+    anything to 5 minutes: the day ahead LMPs and load forecast as they
+    are, and one stat of the hourly realtime rollups.
+
+    :param start: See columnar_store.read_frame.
+    :param end: See columnar_store.read_frame.
+    :param stat: String. Stat to take from the rollups (see STATS).
+
+    :returns: DataFrame with a UTC index and combine_all_data's column
+        names (e.g. realtime_lbmp__nyc).
+    """
+    # Imported here as combine_all_data imports the weather module.
+    from combine_all_data import prepare
+
+    frames = [prepare('lmp_forecast', read_frame(LMP_DAY_AHEAD_STORE,
+                                                 start=start, end=end)),
+              prepare('load_forecast', read_frame(LOAD_FORECAST_STORE,
+                                                  start=start, end=end))]
+    for name in SOURCES:
+        df = read_rollup(name, 'hourly', stats=[stat], start=start, end=end)
+        frames.append(prepare(name, df[stat]))
+
+    return frames[0].join(frames[1:], how='outer')
+
+
+if __name__ == '__main__':
+    main()
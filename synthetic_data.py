@@ -0,0 +1,394 @@
+"""Module to generate synthetic NYISO and weather data.
+
+The data is written in exactly the layout get_nyiso_data.py and the
+weather download leave behind, so the rest of the pipeline can be run
+(and timed, see benchmark.py) without downloading anything:
+    - <data_dir>/<YYYYMM01>/<YYYYMMDD><mid><end>.csv for each NYISO
+        dataset (or <data_dir>/<YYYYMM01>.zip with keep_zip=True).
+    - Weather_Data/Weather Data/Zone<X>.csv for each weather zone.
+
+The quirks of the real data which the pipeline has to deal with are
+reproduced:
+    - Local (America/New_York) time stamps, so the hour after the fall
+        DST change shows up twice and the spring one is missing.
+    - The "Time Zone" column in the realtime load data.
+    - Some day-ahead LMP files with the congestion column split off as
+        'Marginal Cost Congestion ($/MWH'.
+    - Six days of hourly forecast in each load forecast file.
+    - The odd missing realtime interval.
+    - Weather files with non-numeric values ('45s', '*'), duplicate and
+        off-the-hour reports, and some long outages.
+
+LMP data can be generated for the real zones or for some number of
+made-up generators, to see how the pipeline scales with node count.
+
+Usage:
+    generate('bench_data', start_year=2018, end_year=2018)
+"""
+# Third-party:
+import numpy as np
+import pandas as pd
+
+# Built-in:
+import os
+import zipfile
+
+# Imports from get_nyiso_data.py
+from get_nyiso_data import LMP_DAY_AHEAD_ZONAL, LMP_REALTIME_ZONAL, \
+    LOAD_FORECAST, LOAD_REALTIME, get_date_str, archive_path
+
+# Imports from clean_weather_data.py
+from clean_weather_data import WEATHER_DIR, ZONES, COLUMNS
+
+# Local time zone of the NYISO data.
+TIMEZONE = 'America/New_York'
+
+# Zones (and their PTIDs) in the zonal LMP files.
+LMP_ZONES = {'CAPITL': 61757, 'CENTRL': 61754, 'DUNWOD': 61760,
+             'GENESE': 61753, 'H Q': 61844, 'HUD VL': 61758,
+             'LONGIL': 61762, 'MHK VL': 61756, 'MILLWD': 61759,
+             'N.Y.C.': 61761, 'NORTH': 61755, 'NPX': 61845, 'O H': 61846,
+             'PJM': 61847, 'WEST': 61752}
+
+# Zones in the realtime load files (no external zones).
+LOAD_ZONES = ['CAPITL', 'CENTRL', 'DUNWOD', 'GENESE', 'HUD VL', 'LONGIL',
+              'MHK VL', 'MILLWD', 'N.Y.C.', 'NORTH', 'WEST']
+
+# Columns of the load forecast files.
+FORECAST_COLUMNS = ['Capitl', 'Centrl', 'Dunwod', 'Genese', 'Hud Vl',
+                    'Longil', 'Mhk Vl', 'Millwd', 'N.Y.C.', 'North', 'West',
+                    'NYISO']
+
+# Typical number of generators in the generator LMP files.
+GEN_NODES = 500
+GEN_PTID_START = 23500
+
+# Days of forecast in each load forecast file.
+FORECAST_DAYS = 6
+
+# Time stamp formats.
+HOURLY_FORMAT = '%m/%d/%Y %H:%M'
+FIVE_MIN_FORMAT = '%m/%d/%Y %H:%M:%S'
+
+# LMP column names.
+LBMP = 'LBMP ($/MWHr)'
+LOSSES = 'Marginal Cost Losses ($/MWHr)'
+CONGESTION = 'Marginal Cost Congestion ($/MWHr)'
+CONGESTION_SPLIT = 'Marginal Cost Congestion ($/MWH'
+
+# Fraction of day-ahead files with the split congestion column.
+SPLIT_RATE = 0.1
+
+# Fraction of realtime intervals which are missing.
+MISSING_RATE = 0.0005
+
+# Weather quirks: fraction of values with a trailing 's' (suspect),
+# fraction which are '*' (missing), fraction of special (off the hour)
+# reports, and (per zone and year) number of multi-day outages of
+# one column.
+SUSPECT_RATE = 0.01
+STAR_RATE = 0.005
+SPECIAL_RATE = 0.05
+OUTAGES_PER_YEAR = 2
+
+
+def node_names(nodes):
+    """Get the (names, ptids) of the LMP nodes.
+
+    :param nodes: 'zonal' for the real zones, or an integer number of
+        generators.
+    """
+    if nodes == 'zonal':
+        return list(LMP_ZONES.keys()), list(LMP_ZONES.values())
+
+    names = ['GEN {:04d}'.format(i) for i in range(nodes)]
+    return names, list(range(GEN_PTID_START, GEN_PTID_START + nodes))
+
+
+def month_times(year, month, freq):
+    """All the local times in a month, as a tz-aware DatetimeIndex."""
+    start = pd.Timestamp(year=year, month=month, day=1)
+    end = start + pd.offsets.MonthBegin(1)
+    return pd.date_range(start.tz_localize(TIMEZONE),
+                         end.tz_localize(TIMEZONE), freq=freq)[:-1]
+
+
+def daily_shape(times, peak_hour=17):
+    """A smooth daily cycle in [-1, 1], peaking at peak_hour."""
+    hours = times.hour + times.minute / 60
+    return np.cos(2 * np.pi * (np.asarray(hours) - peak_hour) / 24)
+
+
+def format_times(times, fmt):
+    """Format times as wall-clock strings, one per time."""
+    return np.asarray(times.tz_localize(None).strftime(fmt), dtype=object)
+
+
+def long_frame(times, names, ptids, fmt):
+    """Frame with one row per (time, node), in the NYISO ordering (all
+    nodes for a time, then the next time).
+    """
+    n = len(names)
+    return pd.DataFrame({'Time Stamp': np.repeat(format_times(times, fmt), n),
+                         'Name': np.tile(np.asarray(names, dtype=object),
+                                         len(times)),
+                         'PTID': np.tile(ptids, len(times))})
+
+
+def lmp_values(times, n_nodes, rng):
+    """Synthetic (lbmp, losses, congestion), shape (times, nodes)."""
+    shape = (len(times), n_nodes)
+    base = 35 + 12 * daily_shape(times)[:, np.newaxis]
+    losses = rng.normal(0, 1.5, shape)
+    congestion = -np.abs(rng.normal(0, 4, shape)) \
+        * (rng.random(shape) < 0.3)
+    lbmp = base + rng.normal(0, 5, shape) + losses - congestion
+    return (np.round(lbmp, 2), np.round(losses, 2), np.round(congestion, 2))
+
+
+def lmp_month(year, month, freq, fmt, names, ptids, rng, missing_rate=0.0):
+    """Long-format LMP frame for a month."""
+    times = month_times(year, month, freq)
+    if missing_rate:
+        times = times[rng.random(len(times)) >= missing_rate]
+
+    df = long_frame(times, names, ptids, fmt)
+    lbmp, losses, congestion = lmp_values(times, len(names), rng)
+    df[LBMP] = lbmp.ravel()
+    df[LOSSES] = losses.ravel()
+    df[CONGESTION] = congestion.ravel()
+    return times, df
+
+
+def load_month(year, month, rng):
+    """Long-format realtime load frame for a month."""
+    times = month_times(year, month, '5min')
+    times = times[rng.random(len(times)) >= MISSING_RATE]
+
+    ptids = [LMP_ZONES[z] for z in LOAD_ZONES]
+    df = long_frame(times, LOAD_ZONES, ptids, FIVE_MIN_FORMAT)
+
+    # Realtime load has a column saying which side of the DST change
+    # each time is on.
+    utc_offset = times.tz_localize(None) - times.tz_convert(None)
+    tz = np.where(utc_offset == pd.Timedelta(hours=-4), 'EDT', 'EST')
+    df.insert(1, 'Time Zone', np.repeat(tz, len(LOAD_ZONES)))
+
+    base = rng.uniform(500, 6000, len(LOAD_ZONES))
+    load = base * (1 + 0.25 * daily_shape(times)[:, np.newaxis]) \
+        + rng.normal(0, 20, (len(times), len(LOAD_ZONES)))
+    df['Load'] = np.round(load, 1).ravel()
+    return times, df
+
+
+def forecast_day(day, rng):
+    """Load forecast file for one day: FORECAST_DAYS days of hourly
+    forecast starting at midnight.
+    """
+    start = pd.Timestamp(day).tz_localize(TIMEZONE)
+    end = (pd.Timestamp(day) + pd.Timedelta(days=FORECAST_DAYS)) \
+        .tz_localize(TIMEZONE)
+    times = pd.date_range(start, end, freq='H')[:-1]
+
+    base = np.linspace(800, 3000, len(FORECAST_COLUMNS) - 1)
+    load = base * (1 + 0.25 * daily_shape(times)[:, np.newaxis]) \
+        + rng.normal(0, 30, (len(times), len(base)))
+    load = np.round(load).astype(np.int64)
+
+    df = pd.DataFrame(load, columns=FORECAST_COLUMNS[:-1])
+    df['NYISO'] = load.sum(axis=1)
+    df.insert(0, 'Time Stamp', format_times(times, HOURLY_FORMAT))
+    return df
+
+
+def split_days(times, df):
+    """Split a month's long frame into (date, frame) per local day."""
+    days = np.asarray(times.tz_localize(None).normalize())
+    rows_per_time = len(df) // len(times)
+    row_days = np.repeat(days, rows_per_time)
+    bounds = np.flatnonzero(row_days[1:] != row_days[:-1]) + 1
+    starts = np.concatenate([[0], bounds])
+    stops = np.concatenate([bounds, [len(df)]])
+    return [(pd.Timestamp(row_days[a]), df.iloc[a:b])
+            for a, b in zip(starts, stops)]
+
+
+class MonthWriter:
+    """Write the daily files for one month of one dataset, either into a
+    month directory or a month archive (see get_nyiso_data.KEEP_ZIP).
+    """
+
+    def __init__(self, data_dir, date_str, keep_zip=False):
+        self.keep_zip = keep_zip
+        if keep_zip:
+            os.makedirs(data_dir, exist_ok=True)
+            self.zf = zipfile.ZipFile(archive_path(data_dir, date_str), 'w',
+                                      compression=zipfile.ZIP_DEFLATED)
+        else:
+            self.dir = os.path.join(data_dir, date_str)
+            os.makedirs(self.dir, exist_ok=True)
+
+    def write(self, name, df):
+        if self.keep_zip:
+            self.zf.writestr(name, df.to_csv(index=False))
+        else:
+            df.to_csv(os.path.join(self.dir, name), index=False)
+
+    def close(self):
+        if self.keep_zip:
+            self.zf.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def months(start_year, end_year):
+    """(year, month) for every month in [start_year, end_year]."""
+    return [(y, m) for y in range(start_year, end_year + 1)
+            for m in range(1, 13)]
+
+
+def write_lmp(root, start_year, end_year, day_ahead, nodes='zonal',
+              keep_zip=False, seed=0):
+    """Write day-ahead or realtime LMP files."""
+    rng = np.random.default_rng(seed)
+    names, ptids = node_names(nodes)
+    if day_ahead:
+        data_dir, mid = LMP_DAY_AHEAD_ZONAL, 'damlbmp'
+        freq, fmt, missing = 'H', HOURLY_FORMAT, 0.0
+    else:
+        data_dir, mid = LMP_REALTIME_ZONAL, 'realtime'
+        freq, fmt, missing = '5min', FIVE_MIN_FORMAT, MISSING_RATE
+    end = '_zone' if nodes == 'zonal' else '_gen'
+
+    for year, month in months(start_year, end_year):
+        date_str = get_date_str(year=year, month=month)
+        times, df = lmp_month(year, month, freq, fmt, names, ptids, rng,
+                              missing_rate=missing)
+        with MonthWriter(os.path.join(root, data_dir), date_str,
+                         keep_zip) as w:
+            for day, day_df in split_days(times, df):
+                if day_ahead and rng.random() < SPLIT_RATE:
+                    day_df = day_df.rename(
+                        columns={CONGESTION: CONGESTION_SPLIT})
+                w.write('{:%Y%m%d}{}{}.csv'.format(day, mid, end), day_df)
+
+
+def write_load_realtime(root, start_year, end_year, keep_zip=False, seed=1):
+    """Write realtime load files."""
+    rng = np.random.default_rng(seed)
+    for year, month in months(start_year, end_year):
+        date_str = get_date_str(year=year, month=month)
+        times, df = load_month(year, month, rng)
+        with MonthWriter(os.path.join(root, LOAD_REALTIME), date_str,
+                         keep_zip) as w:
+            for day, day_df in split_days(times, df):
+                w.write('{:%Y%m%d}pal.csv'.format(day), day_df)
+
+
+def write_load_forecast(root, start_year, end_year, keep_zip=False, seed=2):
+    """Write load forecast files."""
+    rng = np.random.default_rng(seed)
+    for year, month in months(start_year, end_year):
+        date_str = get_date_str(year=year, month=month)
+        start = pd.Timestamp(year=year, month=month, day=1)
+        days = pd.date_range(start, start + pd.offsets.MonthBegin(1),
+                             freq='D')[:-1]
+        with MonthWriter(os.path.join(root, LOAD_FORECAST), date_str,
+                         keep_zip) as w:
+            for day in days:
+                w.write('{:%Y%m%d}isolf.csv'.format(day),
+                        forecast_day(day, rng))
+
+
+def weather_zone(times, rng):
+    """Synthetic weather for one zone, in the layout of the downloaded
+    files.
+    """
+    n = len(times)
+    shape = daily_shape(times, peak_hour=15)
+    season = np.cos(2 * np.pi * (np.asarray(times.dayofyear) - 200) / 365)
+    values = {
+        'HourlyDryBulbTemperature': np.round(50 + 25 * season + 8 * shape
+                                             + rng.normal(0, 3, n)),
+        'HourlyRelativeHumidity': np.clip(np.round(
+            65 - 15 * shape + rng.normal(0, 8, n)), 5, 100),
+        'HourlyWindSpeed': np.clip(np.round(rng.gamma(2, 4, n)), 0, None)}
+
+    years = max(1, n // (24 * 365))
+    df = pd.DataFrame({'STATION': '725180', 'REPORT_TYPE': 'FM-15'},
+                      index=np.arange(n))
+    for c in COLUMNS[1:]:
+        v = values[c]
+        # Multi-day outages.
+        for _ in range(OUTAGES_PER_YEAR * years):
+            start = rng.integers(0, n)
+            v[start:start + rng.integers(24, 24 * 4)] = np.nan
+
+        col = pd.Series(v).map('{:.0f}'.format).astype(object)
+        col[np.isnan(v)] = ''
+        suspect = rng.random(n) < SUSPECT_RATE
+        col[suspect] = col[suspect] + 's'
+        col[rng.random(n) < STAR_RATE] = '*'
+        df[c] = col.values
+
+    # Special reports: off the hour, and sometimes duplicating a time.
+    special = rng.random(n) < SPECIAL_RATE
+    offsets = pd.to_timedelta(rng.integers(0, 60, special.sum()), unit='m')
+    extra = df[special].copy()
+    extra['REPORT_TYPE'] = 'FM-16'
+
+    dates = np.concatenate([np.asarray(times),
+                            np.asarray(times[special] + offsets)])
+    df = pd.concat([df, extra], ignore_index=True)
+    df['DATE'] = pd.DatetimeIndex(dates).strftime('%Y-%m-%dT%H:%M:%S')
+    df = df.iloc[np.argsort(dates, kind='stable')]
+
+    return df[['STATION', 'DATE', 'REPORT_TYPE'] + COLUMNS[1:]]
+
+
+def write_weather(root, start_year, end_year, seed=3):
+    """Write a weather file for each zone. Like the real ones, they run
+    a little past each end of the NYISO data.
+    """
+    rng = np.random.default_rng(seed)
+    weather_dir = os.path.join(root, WEATHER_DIR)
+    os.makedirs(weather_dir, exist_ok=True)
+
+    times = pd.date_range('{}-12-31'.format(start_year - 1),
+                          '{}-01-02'.format(end_year + 1), freq='H')
+    for z in ZONES:
+        weather_zone(times, rng).to_csv(
+            os.path.join(weather_dir, 'Zone{}.csv'.format(z)), index=False)
+
+
+def generate(root, start_year, end_year, nodes='zonal', keep_zip=False,
+             seed=0):
+    """Generate all the raw data the pipeline reads.
+
+    :param root: Directory to write to. The pipeline stages should be run
+        from here.
+    :param start_year: Integer. First year to generate.
+    :param end_year: Integer. Last year to generate (inclusive).
+    :param nodes: 'zonal' for zonal LMP data, or an integer number of
+        generator nodes. Generator data is written where the pipeline
+        reads the zonal data from.
+    :param keep_zip: Boolean. Write monthly archives rather than month
+        directories (see get_nyiso_data.KEEP_ZIP).
+    :param seed: Integer. Base random seed.
+    """
+    for day_ahead in (True, False):
+        write_lmp(root, start_year, end_year, day_ahead=day_ahead,
+                  nodes=nodes, keep_zip=keep_zip, seed=seed + day_ahead)
+    write_load_realtime(root, start_year, end_year, keep_zip=keep_zip,
+                        seed=seed + 2)
+    write_load_forecast(root, start_year, end_year, keep_zip=keep_zip,
+                        seed=seed + 3)
+    write_weather(root, start_year, end_year, seed=seed + 4)
+
+
+if __name__ == '__main__':
+    generate('synthetic_data', start_year=2018, end_year=2018)
@@ -0,0 +1,183 @@
+"""Tests for the download engine in get_nyiso_data.py, run against a
+local stand-in for NYISO's server.
+
+Run with:
+    python -m pytest test_get_nyiso_data.py
+"""
+# Third-party:
+import pytest
+
+# Built-in:
+import hashlib
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from zipfile import ZipFile
+
+# Imports from get_nyiso_data.py
+from get_nyiso_data import NYISO_BASE_URL, MANIFEST_FILE, MAX_PER_HOST, \
+    download_jobs, get_date_str, nyiso_url
+
+# Times the stand-in server fails each URL with a 503 before serving it.
+FAILURES = 2
+
+# Seconds the stand-in server takes over each response, so that
+# requests overlap.
+DELAY = 0.02
+
+
+def make_archive(date_str):
+    """A small monthly archive with one daily file."""
+    buf = BytesIO()
+    with ZipFile(buf, 'w') as z:
+        z.writestr(date_str + 'pal.csv',
+                   '"Time Stamp","Name","Load"\n'
+                   '"{}/{}/{} 00:00:00","N.Y.C.",5000.0\n'.format(
+                       date_str[4:6], date_str[6:], date_str[:4]))
+    return buf.getvalue()
+
+
+class StandIn(BaseHTTPRequestHandler):
+    """Serve the server's files, failing each FAILURES times first and
+    honouring If-None-Match.
+    """
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight,
+                                       server.in_flight)
+            server.requests.append(self.path)
+            tries = server.tries[self.path] = \
+                server.tries.get(self.path, 0) + 1
+        try:
+            time.sleep(DELAY)
+            body = server.files.get(self.path)
+            if body is None:
+                self.send_error(404)
+                return
+            if tries <= FAILURES:
+                self.send_error(503)
+                return
+
+            etag = '"{}"'.format(hashlib.sha256(body).hexdigest())
+            if self.headers.get('If-None-Match') == etag:
+                self.send_response(304)
+                self.end_headers()
+                return
+
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.send_header('ETag', etag)
+            self.end_headers()
+            self.wfile.write(body)
+        finally:
+            with server.lock:
+                server.in_flight -= 1
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture(autouse=True)
+def log_file(tmp_path, monkeypatch):
+    """Keep the downloads' step log (see instrumentation.py) out of the
+    working directory.
+    """
+    monkeypatch.setenv('PIPELINE_LOG', str(tmp_path / 'pipeline_log.jsonl'))
+
+
+@pytest.fixture
+def server():
+    """Stand-in server with a year of load archives, at the paths NYISO
+    serves them from.
+    """
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StandIn)
+    base_url = 'http://{}:{}/'.format(*server.server_address)
+    server.lock = threading.Lock()
+    server.in_flight = 0
+    server.max_in_flight = 0
+    server.requests = []
+    server.tries = {}
+    server.files = {}
+    server.jobs = []
+    for month in range(1, 13):
+        date_str = get_date_str(2018, month)
+        path = nyiso_url(data_type='load', day_ahead=False,
+                         date_str=date_str)[len(NYISO_BASE_URL):].lstrip('/')
+        server.files['/' + path] = make_archive(date_str)
+        server.jobs.append((base_url + path, date_str))
+
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def run(server, data_dir, **kwargs):
+    jobs = [(data_dir, url, date_str) for url, date_str in server.jobs]
+    return download_jobs(jobs, max_workers=2 * MAX_PER_HOST,
+                         max_per_host=MAX_PER_HOST, backoff=0.01, **kwargs)
+
+
+@pytest.mark.parametrize('keep_zip', [False, True])
+def test_download_jobs(server, tmp_path, keep_zip):
+    data_dir = str(tmp_path / 'nyiso_load_realtime')
+    res = run(server, data_dir, keep_zip=keep_zip)
+
+    assert len(res['new']) == len(server.jobs)
+    # The downloads overlapped, but never past the per-host cap.
+    assert 1 < server.max_in_flight <= MAX_PER_HOST
+    # Every URL was retried past its 503s.
+    assert all(n == FAILURES + 1 for n in server.tries.values())
+
+    for url, date_str in server.jobs:
+        if keep_zip:
+            with ZipFile(os.path.join(data_dir, date_str + '.zip')) as z:
+                assert z.namelist() == [date_str + 'pal.csv']
+        else:
+            assert os.path.isfile(os.path.join(data_dir, date_str,
+                                               date_str + 'pal.csv'))
+
+    with open(os.path.join(data_dir, MANIFEST_FILE)) as f:
+        manifest = json.load(f)
+    assert sorted(manifest) == sorted(url for url, _ in server.jobs)
+    for url, date_str in server.jobs:
+        assert manifest[url]['date_str'] == date_str
+        assert manifest[url]['etag'] is not None
+
+    # A rerun sends the ETags, gets 304s, and changes nothing.
+    server.requests.clear()
+    res = run(server, data_dir, keep_zip=keep_zip)
+    assert len(res['unchanged']) == len(server.jobs)
+    assert len(server.requests) == len(server.jobs)
+    assert server.max_in_flight <= MAX_PER_HOST
+
+
+def test_download_jobs_bad_archive(server, tmp_path):
+    data_dir = str(tmp_path / 'nyiso_load_realtime')
+    bad_url, bad_date = server.jobs[3]
+    server.files['/' + bad_url.split('/', 3)[3]] = b'not a zip file'
+
+    # The corrupt archive fails on its own; the rest are still saved.
+    with pytest.raises(UserWarning, match=bad_date):
+        run(server, data_dir)
+
+    with open(os.path.join(data_dir, MANIFEST_FILE)) as f:
+        manifest = json.load(f)
+    assert bad_url not in manifest
+    assert len(manifest) == len(server.jobs) - 1
+    assert not os.path.isdir(os.path.join(data_dir, bad_date))
+
+
+def test_download_gives_up(server, tmp_path):
+    data_dir = str(tmp_path / 'nyiso_load_realtime')
+
+    # Not enough retries to get past the 503s.
+    with pytest.raises(UserWarning, match='Failed to download 12 of 12'):
+        run(server, data_dir, max_retries=FAILURES - 1)
+    assert all(n == FAILURES for n in server.tries.values())